@@ -1,12 +1,30 @@
-"""Start the bot and set up logging."""
+"""
+Start the bot and set up logging.
+
+Only one process may run the bot at a time, whether it polls for updates or receives
+them through a webhook - see `SupperApplication.hold_lease`.
+"""
 from datetime import datetime
+from urllib.parse import urlsplit
+import asyncio
 import logging
 import os
 
 from supperbot.bot import application
+from supperbot.webhook import DEFAULT_STOP_SIGNALS, run_webhook
 
 from config import LOGGING_LEVEL
 
+# If set, updates are received through a webhook at this URL instead of by polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+
+# The address the webhook server listens on, in the form "host:port"
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1:8443")
+
+# The token Telegram sends with every update. If not set, a random token is picked
+# every time the bot starts
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+
 
 def main():
     # Create a logs file if it does not exist
@@ -25,7 +43,24 @@ def main():
     )
     logging.info("Hello world, initializing bot!")
 
-    if os.name == "nt":
+    if WEBHOOK_URL:
+        host, _, port = WEBHOOK_LISTEN.rpartition(":")
+        webhook = run_webhook(
+            application,
+            WEBHOOK_URL,
+            listen=host,
+            port=int(port),
+            # The server is assumed to be reached at the same path as the URL
+            url_path=urlsplit(WEBHOOK_URL).path,
+            secret_token=WEBHOOK_SECRET,
+            # See the comment on `run_polling` below
+            stop_signals=None if os.name == "nt" else DEFAULT_STOP_SIGNALS,
+        )
+        try:
+            asyncio.run(webhook)
+        except KeyboardInterrupt:
+            pass
+    elif os.name == "nt":
         # Required on Windows systems so that the bot won't throw warnings on init
         # For more information, read
         # https://docs.python-telegram-bot.org/en/latest/telegram.ext.application.html#telegram.ext.Application.run_polling.params.stop_signals
@@ -0,0 +1,200 @@
+"""
+Checks that no query made by `supperbot.db.db` does a full table scan.
+
+Every public function in the `db` module is called against a scratch SQLite database.
+The statements they issue are captured, and each is run through
+`EXPLAIN QUERY PLAN`. The script exits with a non-zero status if any statement scans
+a whole table, or if a function in the `db` module is not exercised by this script.
+
+Usage: python scripts/check_query_plans.py
+"""
+from __future__ import annotations
+
+import asyncio
+import inspect
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "query_plans.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import event  # noqa: E402
+
+from supperbot.db import db  # noqa: E402
+from supperbot.db.models import create_tables, engine  # noqa: E402
+from supperbot.db.migrations import upgrade_schema  # noqa: E402
+from supperbot.db.search import create_search_index  # noqa: E402
+
+
+# Functions which are not expected to issue any queries
+UNCHECKED = {"delete_jio"}
+
+# A step of a query plan which reads a whole table, eg "SCAN orders". Scans of a
+# full-text index with a MATCH constraint ("M" in the index string) only read matches
+FULL_SCAN = re.compile(
+    r"^SCAN (?!CONSTANT ROW)(\S+)(?!\S| VIRTUAL TABLE INDEX \d+:\S*M)"
+)
+
+_current_function: str | None = None
+_statements: list[tuple[str, str, tuple]] = []
+
+
+def _capture(conn, cursor, statement, parameters, context, executemany):
+    if executemany:
+        parameters = parameters[0]
+    if statement.lstrip().split(" ", 1)[0].upper() in {
+        "SELECT",
+        "INSERT",
+        "UPDATE",
+        "DELETE",
+    }:
+        _statements.append((_current_function, statement, tuple(parameters)))
+
+
+async def call(function, *args, **kwargs):
+    global _current_function
+    _current_function = function.__name__
+    try:
+        return await function(*args, **kwargs)
+    finally:
+        _current_function = None
+
+
+async def exercise() -> None:
+    """Calls every function in the `db` module, on a database with some data in it."""
+
+    # Some background data, so that the tables are not trivially small
+    for user_id in range(1, 21):
+        await db.upsert_user(user_id, f"User {user_id}", user_id)
+    for owner_id in range(1, 6):
+        for _ in range(4):
+            jio = await db.create_jio(owner_id, f"Restaurant {owner_id}", "")
+            for user_id in range(1, 21, owner_id):
+                await db.create_order(jio.id, user_id)
+                await db.add_food_order(jio.id, user_id, "Fries")
+
+    user = await call(db.upsert_user, 100, "Host", 100)
+    await call(db.get_user_name, user.id)
+
+    jio = await call(db.create_jio, user.id, "McDonalds", "Description")
+    await call(db.get_jio, jio.id)
+    await call(db.update_jio_message_id, jio.id, user.id, 1)
+    await call(db.update_jio_message_page, jio.id, 1)
+    await call(db.edit_jio_description, jio, "New description")
+    await call(db.new_msg, jio.id, "inline message id")
+    await call(db.get_msg_id, jio.id)
+    await call(db.get_msg_pages, jio.id)
+    await call(db.update_msg_page, "inline message id", 1)
+    await call(db.record_msg_failure, "inline message id", "BadRequest", False)
+    await call(db.record_msg_successes, ["inline message id"])
+    await call(db.record_msg_failure, "inline message id", "Forbidden", True)
+    await call(db.delete_tombstoned_msgs, datetime.now())
+
+    await call(db.create_order, jio.id, user.id)
+    await call(db.add_food_order, jio.id, user.id, "Fries")
+    await call(db.add_food_order, jio.id, user.id, "Fries")
+    await call(db.add_food_order, jio.id, user.id, "Coke")
+    await call(db.update_order_message_id, jio.id, user.id, 2)
+    order = await call(db.get_order, jio.id, user.id)
+    await call(db.delete_food_order, order, 0)
+    await call(db.get_list_complete_orders, jio.id)
+    await call(db.get_jio_order_lines, jio.id)
+    await call(db.get_jio_order_lines, jio.id, [user.id])
+    await call(db.get_list_all_orders, jio.id)
+    await call(db.get_food_counts, jio.id)
+    await call(db.get_unpaid_orders, jio.id)
+    await call(db.update_order_message_ids, jio.id, {user.id: 3})
+    await call(db.update_order_payment, jio.id, user.id, db.PaidStatus.PAID)
+
+    db.enqueue_refresh(jio.id, db.RefreshKind.CONSOLIDATED)
+    db.enqueue_refresh(jio.id, db.RefreshKind.INDIVIDUALS)
+    await call(db.update_jio_status, jio.id, db.Stage.CLOSED)
+    await call(db.get_next_outbox_time, datetime.now())
+    await call(db.get_due_outbox_entries, 10, [(jio.id, db.RefreshKind.INDIVIDUALS)])
+    entries = await call(db.get_due_outbox_entries, 10)
+    await call(db.retry_outbox_entries, [entries[0].id], datetime.now())
+    await call(db.delete_outbox_entries, [entry.id for entry in entries])
+    await call(db.get_user_jios, user.id)
+    await call(db.get_user_jios, user.id, limit=None, allow_closed=True, desc=False)
+    await call(db.get_joined_jios, user.id)
+    cursor = (jio.timestamp, jio.id)
+    await call(db.get_user_jios, user.id, allow_closed=True, after=cursor)
+    await call(db.get_user_jios, user.id, allow_closed=True, desc=False, after=cursor)
+    await call(db.get_joined_jios, 1, after=cursor)
+    await call(db.get_joined_jios, 1, desc=False, after=cursor)
+    await call(db.search_jios, user.id, "mcdonald fries", limit=5, offset=5)
+
+    await call(db.add_favourite_order, user.id, "McDonalds", "Fries")
+    await call(db.get_favourite_restaurants, user.id)
+    await call(db.get_favourite_orders, user.id, "McDonalds")
+    fav_id = await call(db.get_fav_id, user.id, "McDonalds", "Fries")
+    await call(db.get_favourite, fav_id)
+    await call(db.remove_favourite_order, fav_id, user.id)
+
+    await call(db.set_food_aliases, "mcdonalds", {"m": "medium"}, ["l"])
+    await call(db.get_food_aliases, "mcdonalds")
+
+    await call(db.acquire_lease, "bot", "host:1", timedelta(minutes=1))
+    await call(db.acquire_lease, "bot", "host:2", timedelta(minutes=1))
+    await call(db.get_lease_holder, "bot")
+    await call(db.acquire_lease, "bot", "host:2", timedelta(minutes=1), "host:1")
+    await call(db.release_lease, "bot", "host:2")
+
+
+async def run() -> None:
+    await create_tables()
+    await upgrade_schema()
+    await create_search_index()
+    event.listen(engine.sync_engine, "before_cursor_execute", _capture)
+
+    async with db.session_scope():
+        await exercise()
+
+    await engine.dispose()
+
+
+def main() -> int:
+    asyncio.run(run())
+
+    failed = False
+
+    public = {
+        name
+        for name, function in inspect.getmembers(db, inspect.iscoroutinefunction)
+        if not name.startswith("_") and function.__module__ == db.__name__
+    }
+    missing = public - UNCHECKED - {name for name, _, _ in _statements}
+    for name in sorted(missing):
+        print(f"NOT CHECKED: db.{name} was not exercised by this script")
+        failed = True
+
+    conn = sqlite3.connect(DB_PATH)
+    checked = set()
+    for name, statement, parameters in _statements:
+        if name is None or (statement, parameters) in checked:
+            continue
+        checked.add((statement, parameters))
+
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+        details = [row[-1] for row in plan]
+        scans = [detail for detail in details if FULL_SCAN.match(detail)]
+
+        status = "FULL SCAN" if scans else "ok"
+        failed = failed or bool(scans)
+
+        print(f"[{status}] db.{name}: {' '.join(statement.split())}")
+        for detail in details:
+            print(f"    {detail}")
+
+    conn.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+Checks behaviour which has been broken before, against a scratch SQLite database.
+
+Each check prints whether it passed, and the script exits with a non-zero status if any
+of them failed.
+
+Usage: python scripts/check_regressions.py
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "regressions.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import delete, update  # noqa: E402
+from telegram.error import BadRequest, TimedOut  # noqa: E402
+
+from supperbot.commands import helper  # noqa: E402
+from supperbot.db import db  # noqa: E402
+from supperbot.db.migrations import (  # noqa: E402
+    backfill_food_counts,
+    backfill_order_jios,
+)
+from supperbot.db.models import (  # noqa: E402
+    FoodCount,
+    Order,
+    Session,
+    create_tables,
+    engine,
+)
+from supperbot.db import search  # noqa: E402
+from supperbot.db.search import create_search_index  # noqa: E402
+from supperbot.normalize import AliasIndex  # noqa: E402
+
+_passed = True
+
+
+def check(name: str, ok: bool, detail: object = "") -> None:
+    global _passed
+    _passed = _passed and ok
+    print(f"[{'ok' if ok else 'FAIL'}] {name}" + (f": {detail}" if detail else ""))
+
+
+async def check_search_backfill() -> None:
+    # Jios created before the search index exists are added to it when it is created
+    async with db.session_scope():
+        for user_id in (1, 2):
+            await db.upsert_user(user_id, f"User {user_id}", user_id)
+        first = await db.create_jio(1, "Amaan", "")
+        second = await db.create_jio(2, "Amaan", "")
+
+    await create_search_index()
+
+    async with db.session_scope():
+        for user_id, jio in ((1, first), (2, second)):
+            found = [jio.id for jio in await db.search_jios(user_id, "amaan")]
+            check(
+                f"backfilled search index only finds user {user_id}'s jio",
+                found == [jio.id],
+                found,
+            )
+
+
+async def check_search_fallback() -> None:
+    # Databases without a search index find the same jios, including by food items
+    async with db.session_scope():
+        await db.upsert_user(5, "User 5", 5)
+        jio = await db.create_jio(5, "Pizza Hut", "")
+        await db.create_order(jio.id, 5)
+        await db.add_food_order(jio.id, 5, "Garlic bread")
+
+        indexed = [jio.id for jio in await db.search_jios(5, "garlic")]
+        is_indexed, search.is_indexed = search.is_indexed, lambda: False
+        try:
+            fallback = [jio.id for jio in await db.search_jios(5, "garlic")]
+        finally:
+            search.is_indexed = is_indexed
+
+    check(
+        "search without an index finds jios by food",
+        fallback == indexed == [jio.id],
+        fallback,
+    )
+
+
+async def check_food_counts_backfill() -> None:
+    # Foods are counted under the same key by the backfill and by later changes, even
+    # where SQLite's `lower()` differs from Python's
+    async with db.session_scope():
+        await db.upsert_user(3, "User 3", 3)
+        jio = await db.create_jio(3, "Cafe", "")
+        await db.create_order(jio.id, 3)
+        await db.add_food_order(jio.id, 3, "Café latte")
+        await db.add_food_order(jio.id, 3, "CAFÉ latte")
+
+    async with Session() as session:
+        await session.execute(delete(FoodCount))
+        await session.commit()
+    await backfill_food_counts()
+
+    async with db.session_scope():
+        counts = await db.get_food_counts(jio.id)
+        check("backfilled non-ASCII food counts", counts == [("café latte", 2)], counts)
+
+        order = await db.get_order(jio.id, 3)
+        await db.delete_food_order(order, 1)
+        counts = await db.get_food_counts(jio.id)
+        check(
+            "non-ASCII food count after deleting a backfilled item",
+            counts == [("café latte", 1)],
+            counts,
+        )
+
+
+async def check_untracked_jio_render() -> None:
+    # Changes to a jio which is no longer tracked are still rendered, and tracking stops
+    # once the jio is closed
+    async with db.session_scope():
+        await db.upsert_user(4, "User 4", 4)
+        jio = await db.create_jio(4, "Subway", "")
+        await db.create_order(jio.id, 4)
+        await db.add_food_order(jio.id, 4, "Cookie")
+        before = db.get_jio_version(jio.id)
+        await helper.render_jio_page(jio)
+
+        await db.update_jio_status(jio.id, db.Stage.CLOSED)
+        check("closed jio is not tracked", jio.id not in db._jio_versions)
+        check("closed jio has a new version", db.get_jio_version(jio.id) > before)
+
+        await db.update_order_payment(jio.id, 4, db.PaidStatus.PAID)
+        jio = await db.get_jio(jio.id)
+        text, _, _ = await helper.render_jio_page(jio)
+        helper._order_lines.clear()
+        expected, _, _ = await helper.render_jio_page(jio)
+        check("render after tracking restarts matches a full render", text == expected)
+
+
+async def check_jio_list_versions() -> None:
+    # Only the host's own jios being created or closed lists their jios again
+    async with db.session_scope():
+        for user_id in (6, 7):
+            await db.upsert_user(user_id, f"User {user_id}", user_id)
+        jio = await db.create_jio(6, "KFC", "")
+        before = db.get_jio_list_version(6)
+
+        other = await db.create_jio(7, "KFC", "")
+        await db.update_jio_status(other.id, db.Stage.CLOSED)
+        check(
+            "other hosts' jios do not change the list version",
+            db.get_jio_list_version(6) == before,
+        )
+
+        await db.update_jio_status(jio.id, db.Stage.CLOSED)
+        check(
+            "closing a jio changes its host's list version",
+            db.get_jio_list_version(6) > before,
+        )
+
+
+async def check_transient_msg_failures() -> None:
+    # Shared messages are only tombstoned by errors which are not transient
+    async with db.session_scope():
+        await db.upsert_user(8, "User 8", 8)
+        jio = await db.create_jio(8, "Jollibee", "")
+        await db.new_msg(jio.id, "outage")
+        await db.new_msg(jio.id, "deleted")
+
+        for _ in range(db.MAX_MSG_FAILURES + 1):
+            await helper.record_shared_message_results(["outage"], [TimedOut()])
+        await helper.record_shared_message_results(
+            ["deleted"], [BadRequest("Message to edit not found")]
+        )
+
+        message_ids = await db.get_msg_id(jio.id)
+    check(
+        "timeouts do not tombstone a shared message",
+        message_ids == ["outage"],
+        message_ids,
+    )
+
+
+async def check_joined_jios() -> None:
+    # Joined jios are listed from the orders' copies of their status and timestamp,
+    # which are filled in for old orders and follow the jio when it is closed
+    async with db.session_scope():
+        for user_id in (9, 10):
+            await db.upsert_user(user_id, f"User {user_id}", user_id)
+        first = await db.create_jio(9, "Mala", "")
+        second = await db.create_jio(9, "Mala", "")
+        for jio in (first, second):
+            await db.create_order(jio.id, 10)
+
+    async with Session() as session:
+        await session.execute(
+            update(Order).filter_by(jio_id=first.id).values(jio_status=None)
+        )
+        await session.commit()
+    await backfill_order_jios()
+
+    async with db.session_scope():
+        joined = [jio.id for jio in await db.get_joined_jios(10)]
+        check(
+            "joined jios include backfilled orders",
+            joined == [second.id, first.id],
+            joined,
+        )
+
+        await db.update_jio_status(second.id, db.Stage.CLOSED)
+        joined = [jio.id for jio in await db.get_joined_jios(10)]
+        check("closed jios are not listed as joined", joined == [first.id], joined)
+
+        await db.update_jio_status(second.id, db.Stage.CREATED)
+        joined = [jio.id for jio in await db.get_joined_jios(10, limit=1)]
+        check("reopened jios are listed as joined", joined == [second.id], joined)
+
+
+async def check_refreshed_pages() -> None:
+    # Refreshes keep every message on the page of the jio it shows
+    async with db.session_scope():
+        await db.upsert_user(11, "User 11", 11)
+        jio = await db.create_jio(11, "Saizeriya", "")
+        await db.new_msg(jio.id, "second page")
+        await db.update_msg_page("second page", 1)
+        await db.update_jio_message_page(jio.id, 1)
+
+        rendered = []
+        render_jio_page = helper.render_jio_page
+
+        async def record_render(jio, page=0):
+            rendered.append(page)
+            return await render_jio_page(jio, page)
+
+        bot = SimpleNamespace(bot=SimpleNamespace(username="supperbot"))
+        helper.render_jio_page = record_render
+        try:
+            edits, _ = await helper.consolidated_order_edits(bot, jio.id)
+        finally:
+            helper.render_jio_page = render_jio_page
+        for edit in edits:
+            edit.close()
+
+    check("refreshes render the pages the messages show", rendered == [1], rendered)
+
+
+def check_possessives() -> None:
+    # Letters after an apostrophe are not taken for a size alias
+    index = AliasIndex()
+    for food, name in (
+        ("McDonald's fries", "mcdonald's fries"),
+        ("McDonald’s fries", "mcdonald's fries"),
+        ("Duck l'orange", "duck l'orange"),
+        ("M fries", "medium fries"),
+    ):
+        normalized = index.normalize(food)[1]
+        check(f'"{food}" is normalized to "{name}"', normalized == name, normalized)
+
+
+async def run() -> bool:
+    await create_tables()
+
+    await check_search_backfill()
+    await check_search_fallback()
+    await check_food_counts_backfill()
+    await check_untracked_jio_render()
+    await check_jio_list_versions()
+    await check_transient_msg_failures()
+    await check_joined_jios()
+    await check_refreshed_pages()
+    check_possessives()
+
+    await engine.dispose()
+    return _passed
+
+
+def main() -> int:
+    return 0 if asyncio.run(run()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""
+Checks the number of queries needed to render the messages of a large jio.
+
+Each render path is run against a scratch SQLite database holding a jio with many
+participants, in a fresh session. The script exits with a non-zero status if any path
+issues more queries than its budget, which would usually mean that an N+1 query was
+introduced (eg lazy loading `Order.user` for every order).
+
+The jio message is then rendered again after changing one order, which should only load
+that order, and must give the same text as rendering the whole jio from scratch.
+
+Usage: python scripts/check_render_queries.py
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "render_queries.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import event  # noqa: E402
+
+from supperbot.db import db  # noqa: E402
+from supperbot.db.models import create_tables, engine  # noqa: E402
+from supperbot.commands import helper  # noqa: E402
+from supperbot.commands.helper import (  # noqa: E402
+    format_jio_message,
+    format_order_message,
+    order_message_keyboard_markup,
+)
+
+PARTICIPANTS = 60
+HOST_ID = 1
+
+_queries = 0
+
+
+def _count(*_):
+    global _queries
+    _queries += 1
+
+
+async def render_jio_message(jio_id: int) -> None:
+    jio = await db.get_jio(jio_id)
+    await format_jio_message(jio)
+
+
+async def render_order_message(jio_id: int) -> None:
+    order = await db.get_order(jio_id, HOST_ID)
+    format_order_message(order)
+    order_message_keyboard_markup(order)
+
+
+async def render_all_order_messages(jio_id: int) -> None:
+    for order in await db.get_list_all_orders(jio_id):
+        format_order_message(order)
+        order_message_keyboard_markup(order)
+
+
+# Render path, and the maximum number of queries it may issue
+BUDGETS = [
+    (render_jio_message, 2),
+    (render_order_message, 2),
+    (render_all_order_messages, 2),
+]
+
+
+async def setup() -> int:
+    await create_tables()
+
+    async with db.session_scope():
+        jio = await db.create_jio(HOST_ID, "McDonalds", "Description")
+        for user_id in range(HOST_ID, HOST_ID + PARTICIPANTS):
+            await db.upsert_user(user_id, f"User {user_id}", user_id)
+            await db.create_order(jio.id, user_id)
+            for food in ("Fries", "Coke", "McSpicy"):
+                await db.add_food_order(jio.id, user_id, food)
+
+    return jio.id
+
+
+async def run() -> bool:
+    global _queries
+
+    jio_id = await setup()
+    event.listen(engine.sync_engine, "before_cursor_execute", _count)
+
+    passed = True
+    for render, budget in BUDGETS:
+        _queries = 0
+        async with db.session_scope():
+            await render(jio_id)
+
+        ok = _queries <= budget
+        passed = passed and ok
+        print(
+            f"[{'ok' if ok else 'FAIL'}] {render.__name__}: "
+            f"{_queries} queries for {PARTICIPANTS} orders (budget {budget})"
+        )
+
+    passed = await check_incremental_render(jio_id) and passed
+
+    await engine.dispose()
+    return passed
+
+
+async def check_incremental_render(jio_id: int) -> bool:
+    global _queries
+
+    async with db.session_scope():
+        await db.add_food_order(jio_id, HOST_ID + 1, "Coke")
+        await db.update_order_payment(jio_id, HOST_ID + 2, db.PaidStatus.PAID)
+        order = await db.get_order(jio_id, HOST_ID + 3)
+        for _ in order.items[:]:
+            await db.delete_food_order(order, 0)
+
+        jio = await db.get_jio(jio_id)
+        _queries = 0
+        incremental = await format_jio_message(jio)
+        queries = _queries
+
+        helper._order_lines.clear()
+        full = await format_jio_message(jio)
+
+    ok = queries <= 1 and incremental == full
+    print(
+        f"[{'ok' if ok else 'FAIL'}] incremental render_jio_message: {queries} queries "
+        f"after changing 3 orders (budget 1), "
+        f"{'same as' if incremental == full else 'DIFFERENT from'} full render"
+    )
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(run()) else 1)
@@ -0,0 +1,242 @@
+"""
+A fake Telegram Bot API server, to test and load test the bot's webhook offline.
+
+The server answers the Bot API methods the bot uses with plausible results, without
+sending anything anywhere. Once the bot sets its webhook, the server acts as Telegram:
+it sends `/start` messages from `--users` users to the webhook, each user sending the
+next one once the bot has replied to the last, with the secret token the bot gave.
+
+Before the load test, an update with a wrong secret token is sent, which the webhook
+must reject. Updates refused because the bot's update queue is full are sent again
+after the delay the webhook asks for, like Telegram does.
+
+Once every user has sent `--messages` messages, the latency from sending each update
+to receiving the bot's reply is printed, and the script exits with a non-zero status if
+any update did not get a reply.
+
+Usage:
+    python scripts/fake_bot_api.py [--port 8081] [--users 100] [--messages 10]
+
+    BOT_API_URL=http://127.0.0.1:8081/bot \\
+    WEBHOOK_URL=http://127.0.0.1:8443/telegram \\
+    python main.py
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import statistics
+import sys
+import time
+from http import HTTPStatus
+
+import httpx
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+# Header which Telegram sends the secret token in
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Seconds to wait for the bot to reply to an update
+REPLY_TIMEOUT = 30
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "fake_bot"}
+
+# The first user id, so that users are not mistaken for the bot
+FIRST_USER_ID = 1000
+
+
+class FakeTelegram:
+    """The state of the fake server, and the load test run against the webhook."""
+
+    def __init__(self, users: int, messages: int, latency: float):
+        self.users = users
+        self.messages = messages
+        self.latency = latency
+
+        self.calls: dict[str, int] = {}
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+
+        # Futures resolved by the bot's next message to each chat
+        self._replies: dict[int, asyncio.Future] = {}
+
+        self.latencies: list[float] = []
+        self.resent = 0
+        self.missing = 0
+        self.done = asyncio.Event()
+        self._load_test: asyncio.Task | None = None
+
+    def call(self, method: str, params: dict) -> object:
+        """Returns the result of a Bot API method."""
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            if self._load_test is None:
+                self._load_test = asyncio.create_task(
+                    self._run(params["url"], params.get("secret_token", ""))
+                )
+            return True
+        if method == "getUpdates":
+            # Updates are only sent through the webhook
+            return []
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            reply = self._replies.get(chat_id)
+            if reply is not None and not reply.done():
+                reply.set_result(time.monotonic())
+            return self._message(chat_id, params.get("text", ""))
+        if method.startswith("edit") and "inline_message_id" not in params:
+            return self._message(int(params["chat_id"]), params.get("text", ""))
+        return True
+
+    def _message(self, chat_id: int, text: str) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": BOT_USER,
+            "text": text,
+        }
+
+    def _start_update(self, user_id: int) -> dict:
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": user,
+                "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            },
+        }
+
+    async def _run(self, url: str, secret_token: str) -> None:
+        # Let the bot finish starting up, as Telegram would not send updates right away
+        await asyncio.sleep(0.5)
+
+        async with httpx.AsyncClient(timeout=REPLY_TIMEOUT) as client:
+            response = await client.post(
+                url,
+                json=self._start_update(FIRST_USER_ID),
+                headers={SECRET_TOKEN_HEADER: secret_token + "wrong"},
+            )
+            if response.status_code != HTTPStatus.FORBIDDEN:
+                print(f"Update with a wrong secret token got {response.status_code}")
+                self.missing += 1
+
+            start = time.monotonic()
+            await asyncio.gather(
+                *(
+                    self._user(client, url, secret_token, FIRST_USER_ID + i)
+                    for i in range(self.users)
+                )
+            )
+            elapsed = time.monotonic() - start
+
+        self._report(elapsed)
+        self.done.set()
+
+    async def _user(
+        self, client: httpx.AsyncClient, url: str, secret_token: str, user_id: int
+    ) -> None:
+        for _ in range(self.messages):
+            reply = asyncio.get_running_loop().create_future()
+            self._replies[user_id] = reply
+            update = self._start_update(user_id)
+
+            sent = time.monotonic()
+            while True:
+                response = await client.post(
+                    url, json=update, headers={SECRET_TOKEN_HEADER: secret_token}
+                )
+                if response.status_code == HTTPStatus.OK:
+                    break
+
+                self.resent += 1
+                await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+
+            try:
+                received = await asyncio.wait_for(reply, REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.missing += 1
+                continue
+            self.latencies.append(received - sent)
+
+    def _report(self, elapsed: float) -> None:
+        count = len(self.latencies)
+        print(f"{count} updates answered in {elapsed:.2f}s ({count / elapsed:.1f}/s)")
+        if count:
+            quantiles = statistics.quantiles(self.latencies, n=100)
+            print(
+                f"Latency: avg {statistics.mean(self.latencies) * 1000:.0f}ms, "
+                f"p50 {quantiles[49] * 1000:.0f}ms, p95 {quantiles[94] * 1000:.0f}ms, "
+                f"p99 {quantiles[98] * 1000:.0f}ms, max {max(self.latencies) * 1000:.0f}ms"
+            )
+        print(f"{self.resent} updates resent, {self.missing} failed")
+        print("Bot API calls: " + ", ".join(f"{m} {n}" for m, n in self.calls.items()))
+
+
+class BotApiHandler(tornado.web.RequestHandler):
+    def initialize(self, telegram: FakeTelegram) -> None:
+        self.telegram = telegram
+
+    async def get(self, method: str) -> None:
+        await self.post(method)
+
+    async def post(self, method: str) -> None:
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(self.request.body or b"{}")
+        else:
+            params = {
+                name: self.get_body_argument(name)
+                for name in self.request.body_arguments
+            }
+
+        if self.telegram.latency:
+            await asyncio.sleep(self.telegram.latency)
+
+        result = self.telegram.call(method, params)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"ok": True, "result": result}))
+
+
+class _App(tornado.web.Application):
+    def log_request(self, handler: tornado.web.RequestHandler) -> None:
+        pass
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="seconds taken to answer each Bot API request",
+    )
+    args = parser.parse_args()
+
+    telegram = FakeTelegram(args.users, args.messages, args.latency)
+    server = HTTPServer(
+        _App([(r"/bot[^/]+/(\w+)", BotApiHandler, {"telegram": telegram})])
+    )
+    server.listen(args.port, args.listen)
+    print(f"Fake Bot API listening on http://{args.listen}:{args.port}/bot")
+
+    await telegram.done.wait()
+    server.stop()
+    return 1 if telegram.missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,243 @@
+"""The `Application` subclass used to run the bot."""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+from datetime import timedelta
+from typing import Hashable
+
+from telegram import Update
+from telegram.ext import Application
+
+# Put on the update queue to stop the update fetcher. Private, but needed to replace the
+# fetcher, and python-telegram-bot is pinned to a version where it exists
+from telegram.ext._application import _STOP_SIGNAL
+
+from supperbot.db import db
+from supperbot.enums import CallbackType, parse_callback_data
+
+
+# Callbacks whose first argument is the id of the jio they act on
+JIO_CALLBACKS = frozenset(
+    {
+        CallbackType.AMEND_DESCRIPTION,
+        CallbackType.CLOSE_JIO,
+        CallbackType.RESEND_MAIN_MESSAGE,
+        CallbackType.OWNER_ADD_ORDER,
+        CallbackType.VIEW_JIO_PAGE,
+        CallbackType.ADD_ORDER,
+        CallbackType.DELETE_ORDER,
+        CallbackType.CANCEL_ORDER_ACTION,
+        CallbackType.DELETE_ORDER_ITEM,
+        CallbackType.REOPEN_JIO,
+        CallbackType.CREATE_ORDERING_LIST,
+        CallbackType.BACK,
+        CallbackType.EDIT_FOOD_ALIASES,
+        CallbackType.PING_ALL_UNPAID,
+        CallbackType.DECLARE_PAYMENT,
+        CallbackType.UNDO_PAYMENT,
+        CallbackType.FAVOURITE_ITEM,
+        CallbackType.CONFIRM_FAVOURITE_ITEM,
+        CallbackType.REMOVE_FAVOURITE_ITEM,
+    }
+)
+
+
+# The lease which the process running the bot holds, how long it lasts, and how often
+# it is renewed. A process which stops without releasing it holds it until it expires
+LEASE_NAME = "bot"
+LEASE_TTL = timedelta(seconds=60)
+LEASE_RENEW_INTERVAL = 15
+
+
+def _parse_jio_id(text: str, prefix: str = "order") -> int | None:
+    if text.startswith(prefix) and text[len(prefix) :].isdigit():
+        return int(text[len(prefix) :])
+    return None
+
+
+def _is_stopped_local_process(holder: str) -> bool:
+    # Whether the lease holder is a process on this machine which no longer runs
+    host, _, pid = holder.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit() or os.name == "nt":
+        # Signal 0 cannot be used to check for a process on Windows
+        return False
+
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class SupperApplication(Application):
+    """
+    Processes updates concurrently, while keeping updates that touch the same user or
+    the same jio in the order they were received.
+
+    Every update is assigned a set of shard keys (see `shard_keys`). An update only
+    starts being processed once all earlier updates sharing any of its keys have
+    finished, so independent jios and users are handled in parallel. Updates only take
+    one of the `concurrent_updates` slots once they stop waiting for their shards, so a
+    burst of updates for one jio does not hold up the updates for other jios.
+
+    Every update is also processed within its own database session. The session is
+    opened before any handler runs and closed once all handlers for the update have
+    finished, so objects loaded while handling one update do not outlive it.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        # The future of the last scheduled update for each shard key
+        self._shard_tails: dict[Hashable, asyncio.Future] = {}
+
+        self._lease_holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._lease_task: asyncio.Task | None = None
+
+    def shard_keys(self, update: object) -> set[Hashable]:
+        if not isinstance(update, Update):
+            return set()
+
+        keys = set()
+        jio_id = None
+
+        # Keys are only taken from the update itself. `user_data` is loaded lazily by
+        # the persistence, only once the update is processed, so keys taken from it
+        # could differ between the first and later updates of a user. Messages sent in
+        # the middle of a conversation are therefore only kept in order with the
+        # user's other updates, not with other users' updates to the same jio
+        if update.effective_user is not None:
+            keys.add(("user", update.effective_user.id))
+
+        if update.callback_query and update.callback_query.data:
+            args = parse_callback_data(update.callback_query.data)
+            if args[0] in JIO_CALLBACKS and len(args) > 1 and args[1].isdigit():
+                jio_id = int(args[1])
+        elif update.chosen_inline_result:
+            jio_id = _parse_jio_id(update.chosen_inline_result.result_id)
+        elif update.message and update.message.text:
+            # Deep links to a jio are in the form "/start order<jio_id>"
+            command, _, argument = update.message.text.partition(" ")
+            if command == "/start":
+                jio_id = _parse_jio_id(argument)
+
+        if jio_id is not None:
+            keys.add(("jio", jio_id))
+
+        return keys
+
+    async def _update_fetcher(self) -> None:
+        # Replaces the fetcher of `Application`, which takes a slot before the update
+        # could wait for its shards
+        if not self.concurrent_updates:
+            await super()._update_fetcher()
+            return
+
+        while True:
+            update = await self.update_queue.get()
+
+            if update is _STOP_SIGNAL:
+                logging.debug("Dropping pending updates")
+                while not self.update_queue.empty():
+                    self.update_queue.task_done()
+
+                # For the _STOP_SIGNAL
+                self.update_queue.task_done()
+                return
+
+            # Tasks start in the order they are created, so updates are registered with
+            # their shards in the order they arrived
+            self.create_task(self._process_sharded_update(update), update=update)
+
+    async def _process_sharded_update(self, update: object) -> None:
+        keys = self.shard_keys(update)
+
+        # Register this update as the last one for each of its keys *before* awaiting
+        # anything, so that the order of arrival is preserved
+        done = asyncio.get_running_loop().create_future()
+        pending = {self._shard_tails[key] for key in keys if key in self._shard_tails}
+        for key in keys:
+            self._shard_tails[key] = done
+
+        try:
+            if pending:
+                await asyncio.wait(pending)
+
+            async with self._concurrent_updates_sem:
+                await self.process_update(update)
+        finally:
+            done.set_result(None)
+            for key in keys:
+                if self._shard_tails.get(key) is done:
+                    del self._shard_tails[key]
+            self.update_queue.task_done()
+
+    async def process_update(self, update: object) -> None:
+        async with db.session_scope():
+            await super().process_update(update)
+
+    async def hold_lease(self) -> None:
+        """
+        Takes the lease on running the bot, and keeps renewing it until the application
+        stops.
+
+        The bot keeps state in memory which every change must go through, such as the
+        versions of jios (see `db.get_jio_version`), and the outbox is not safe to work
+        on from several processes. So only one process may run the bot at a time,
+        whether it polls or receives updates through a webhook.
+
+        :raises RuntimeError: If another process holds the lease.
+        """
+        async with db.session_scope():
+            held = await db.acquire_lease(LEASE_NAME, self._lease_holder, LEASE_TTL)
+
+            # A process on this machine which stopped without releasing the lease, eg
+            # as it crashed, need not be waited for, so that the bot restarts at once
+            if not held:
+                holder = await db.get_lease_holder(LEASE_NAME)
+                if holder is not None and _is_stopped_local_process(holder):
+                    logging.info(f"Taking over the lease of stopped process {holder}")
+                    held = await db.acquire_lease(
+                        LEASE_NAME, self._lease_holder, LEASE_TTL, replace=holder
+                    )
+
+        if not held:
+            raise RuntimeError(
+                "Another process is running the bot. Only one process may run it at a "
+                "time - stop the other process, or wait for its lease to expire"
+            )
+
+        self._lease_task = asyncio.create_task(self._renew_lease())
+
+    async def _renew_lease(self) -> None:
+        while True:
+            await asyncio.sleep(LEASE_RENEW_INTERVAL)
+            try:
+                async with db.session_scope():
+                    held = await db.acquire_lease(
+                        LEASE_NAME, self._lease_holder, LEASE_TTL
+                    )
+            except Exception:
+                logging.exception("Unable to renew the lease on running the bot")
+                continue
+
+            if not held:
+                # Another process took over after renewing failed for too long
+                logging.critical("Lost the lease on running the bot, stopping")
+                signal.raise_signal(signal.SIGTERM)
+                return
+
+    async def stop(self) -> None:
+        await super().stop()
+
+        if self._lease_task is not None:
+            self._lease_task.cancel()
+            self._lease_task = None
+            async with db.session_scope():
+                await db.release_lease(LEASE_NAME, self._lease_holder)
@@ -1,4 +1,7 @@
+import asyncio
 import logging
+import os
+from datetime import datetime, timedelta
 
 from telegram import Update
 from telegram.ext import (
@@ -12,15 +15,35 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-
-from supperbot.enums import CallbackType
+from telegram.request import HTTPXRequest
+
+from supperbot import payloads
+from supperbot.application import SupperApplication
+from supperbot.outbound import OutboundScheduler, ScheduledRequest
+from supperbot.outbox import OutboxWorker
+from supperbot.persistence import SQLPersistence
+from supperbot.enums import CallbackType, prefix_pattern
+from supperbot.router import CallbackRouter
+from supperbot.db import db
+from supperbot.db.models import create_tables
+from supperbot.db.migrations import (
+    backfill_food_counts,
+    backfill_order_items,
+    backfill_order_jios,
+    upgrade_schema,
+)
+from supperbot.db.search import create_search_index
 from supperbot.commands.start import (
     start_group,
     start,
     help_command,
     view_created_jios,
+    view_created_jios_page,
     cancel_view,
     view_joined_jios,
+    view_joined_jios_page,
+    jio_cursor,
+    page_direction,
     view_favourites,
     view_restaurant_favourites,
     main_menu_confirm_favourite_action,
@@ -34,6 +57,7 @@ from supperbot.commands.creation import (
     shared_jio,
     finished_creation,
     resend_main_message,
+    view_jio_page,
     amend_description,
     finish_amend_description,
     cancel_amend_description,
@@ -55,12 +79,39 @@ from supperbot.commands.close import (
     reopen_jio,
     create_ordering_list,
     back,
+    edit_food_aliases,
+    finish_edit_food_aliases,
+    cancel_edit_food_aliases,
     ping_unpaid_users,
 )
 from supperbot.commands.payment import declare_payment, undo_payment
+from supperbot.commands.search import search, view_search_page, inline_search
 
 from config import TOKEN
 
+# Maximum number of updates processed at the same time
+CONCURRENT_UPDATES = 64
+
+# Maximum number of updates received but not yet processed. Once the queue is full,
+# polling waits for it to drain, and the webhook asks Telegram to send updates again later
+UPDATE_QUEUE_SIZE = 1024
+
+# Maximum number of requests to the Bot API made at the same time
+CONNECTION_POOL_SIZE = 128
+
+# The Bot API server, which can be pointed at `scripts/fake_bot_api.py` for testing
+BOT_API_URL = os.environ.get("BOT_API_URL", "https://api.telegram.org/bot")
+
+# Tombstoned shared messages are kept for this long before they are deleted, and the
+# interval in seconds between deleting them
+TOMBSTONE_RETENTION = timedelta(days=7)
+SWEEP_INTERVAL = 60 * 60
+
+# Interval in seconds between logging the outbound scheduler's stats, and the number
+# of callback queries handled by each route
+SCHEDULER_STATS_INTERVAL = 300
+ROUTER_STATS_INTERVAL = 300
+
 
 async def not_implemented_callback(update: Update, _) -> None:
     query = update.callback_query
@@ -77,29 +128,86 @@ async def set_commands(context: CallbackContext) -> None:
         [
             ("/start", "Start the bot"),
             ("/favourites", "View your favourite items for each restaurant"),
+            ("/search", "Search your jios by restaurant, description or food"),
         ]
     )
     logging.info(f"Started as {context.bot.name}")
 
 
-application = ApplicationBuilder().concurrent_updates(False).token(TOKEN).build()
-application.job_queue.run_once(set_commands, 0)
+async def log_scheduler_stats(_: CallbackContext) -> None:
+    stats = scheduler.stats(reset=True)
+    logging.info(
+        f"Outbound requests: {stats['requests']} sent, {stats['retries']} retried, "
+        f"{stats['waiting']} waiting (max {stats['max_waiting']}), "
+        f"wait avg {stats['avg_wait']:.2f}s max {stats['max_wait']:.2f}s"
+    )
 
-# View previously created jios
-application.add_handler(
-    CallbackQueryHandler(view_created_jios, pattern=CallbackType.VIEW_CREATED_JIOS)
-)
 
-application.add_handler(
-    CallbackQueryHandler(view_joined_jios, pattern=CallbackType.VIEW_JOINED_JIOS)
-)
+async def log_router_stats(_: CallbackContext) -> None:
+    stats = router.stats(reset=True)
+    logging.info(
+        "Callback queries handled: "
+        + (", ".join(f"{name} {count}" for name, count in stats.items()))
+    )
 
-application.add_handler(
-    CallbackQueryHandler(cancel_view, pattern=CallbackType.CANCEL_VIEW)
+
+async def sweep_tombstoned_messages(_: CallbackContext) -> None:
+    async with db.session_scope():
+        deleted = await db.delete_tombstoned_msgs(datetime.now() - TOMBSTONE_RETENTION)
+
+    if deleted:
+        logging.info(f"Deleted {deleted} tombstoned shared messages")
+
+
+async def post_init(app: SupperApplication) -> None:
+    await create_tables()
+    await upgrade_schema()
+
+    # Nothing may be changed while another process is running the bot
+    await app.hold_lease()
+
+    await backfill_order_items()
+    await backfill_food_counts()
+    await backfill_order_jios()
+    await create_search_index()
+
+    # Refreshes left in the outbox when the bot last stopped are made right away
+    outbox_worker.start()
+
+
+# Every request to the Bot API, other than polling for updates, goes through the
+# scheduler, which keeps them within Telegram's rate limits
+scheduler = OutboundScheduler()
+
+# Updates are processed concurrently, but `SupperApplication` keeps updates for the
+# same user or jio in order - see `SupperApplication.shard_keys`
+application = (
+    ApplicationBuilder()
+    .application_class(SupperApplication)
+    .concurrent_updates(CONCURRENT_UPDATES)
+    .update_queue(asyncio.Queue(UPDATE_QUEUE_SIZE))
+    .request(
+        ScheduledRequest(
+            HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE), scheduler
+        )
+    )
+    .token(TOKEN)
+    .base_url(BOT_API_URL)
+    .persistence(SQLPersistence())
+    .post_init(post_init)
+    .build()
 )
+application.job_queue.run_once(set_commands, 0)
+application.job_queue.run_repeating(log_scheduler_stats, SCHEDULER_STATS_INTERVAL)
+application.job_queue.run_repeating(log_router_stats, ROUTER_STATS_INTERVAL)
+application.job_queue.run_repeating(sweep_tombstoned_messages, SWEEP_INTERVAL)
+
+outbox_worker = OutboxWorker(application.bot)
 
 # Handler for the creation of a supper jio
-create_jio_handler = CallbackQueryHandler(create, pattern=CallbackType.CREATE_JIO)
+create_jio_handler = CallbackQueryHandler(
+    create, pattern=prefix_pattern(CallbackType.CREATE_JIO)
+)
 create_jio_conv_handler = ConversationHandler(
     entry_points=[create_jio_handler],
     states={
@@ -111,12 +219,14 @@ create_jio_conv_handler = ConversationHandler(
         ],
     },
     fallbacks=[create_jio_handler],
+    name="create_jio",
+    persistent=True,
 )
 application.add_handler(create_jio_conv_handler)
 
 # Handler for editing the description of a supper jio
 amend_description_handler = CallbackQueryHandler(
-    amend_description, pattern=CallbackType.AMEND_DESCRIPTION
+    amend_description, pattern=prefix_pattern(CallbackType.AMEND_DESCRIPTION)
 )
 amend_description_conv_handler = ConversationHandler(
     entry_points=[amend_description_handler],
@@ -128,24 +238,49 @@ amend_description_conv_handler = ConversationHandler(
     fallbacks=[
         amend_description_handler,
         CallbackQueryHandler(
-            cancel_amend_description, pattern=CallbackType.CANCEL_AMEND_DESCRIPTION
+            cancel_amend_description,
+            pattern=prefix_pattern(CallbackType.CANCEL_AMEND_DESCRIPTION),
         ),
     ],
+    name="amend_description",
+    persistent=True,
 )
 application.add_handler(amend_description_conv_handler)
 
+# Handler for the host editing which items are counted together in the ordering list
+edit_food_aliases_handler = CallbackQueryHandler(
+    edit_food_aliases, pattern=prefix_pattern(CallbackType.EDIT_FOOD_ALIASES)
+)
+edit_food_aliases_conv_handler = ConversationHandler(
+    entry_points=[edit_food_aliases_handler],
+    states={
+        CallbackType.FINISH_EDIT_FOOD_ALIASES: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, finish_edit_food_aliases)
+        ]
+    },
+    fallbacks=[
+        edit_food_aliases_handler,
+        CallbackQueryHandler(
+            cancel_edit_food_aliases,
+            pattern=prefix_pattern(CallbackType.CANCEL_EDIT_FOOD_ALIASES),
+        ),
+    ],
+    name="edit_food_aliases",
+    persistent=True,
+)
+application.add_handler(edit_food_aliases_conv_handler)
+
 
 # Handler for when a user clicks on the "Add Order" button on a jio
 application.add_handler(
     CommandHandler("start", interested_user, filters.Regex(r"order\d"))
 )
-application.add_handler(
-    CallbackQueryHandler(interested_owner, pattern=CallbackType.OWNER_ADD_ORDER)
-)
 
 
 # Handler for adding of orders to a jio
-add_order_handler = CallbackQueryHandler(add_order, pattern=CallbackType.ADD_ORDER)
+add_order_handler = CallbackQueryHandler(
+    add_order, pattern=prefix_pattern(CallbackType.ADD_ORDER)
+)
 add_order_conv_handler = ConversationHandler(
     entry_points=[add_order_handler],
     states={
@@ -156,116 +291,99 @@ add_order_conv_handler = ConversationHandler(
     # Allow users to press "add order" again - otherwise it'll show them
     # "not implemented" and I'm not sure why it's happening
     fallbacks=[add_order_handler],
+    name="add_order",
+    persistent=True,
 )
 application.add_handler(add_order_conv_handler)
-application.add_handler(
-    CallbackQueryHandler(resend_main_message, pattern=CallbackType.RESEND_MAIN_MESSAGE)
-)
 
-# Deleting orders handlers
-application.add_handler(
-    CallbackQueryHandler(delete_order, pattern=CallbackType.DELETE_ORDER)
-)
-application.add_handler(
-    CallbackQueryHandler(cancel_order_action, pattern=CallbackType.CANCEL_ORDER_ACTION)
-)
-application.add_handler(
-    CallbackQueryHandler(delete_order_item, pattern=CallbackType.DELETE_ORDER_ITEM)
-)
+# Every other callback query is dispatched by its callback type, see `CallbackRouter`
+router = CallbackRouter()
+
+# Viewing previously created and joined jios
+router.add_route(CallbackType.VIEW_CREATED_JIOS, view_created_jios)
+router.add_route(CallbackType.VIEW_JOINED_JIOS, view_joined_jios)
+router.add_route(
+    CallbackType.VIEW_CREATED_JIOS_PAGE,
+    view_created_jios_page,
+    page_direction,
+    jio_cursor,
+)
+router.add_route(
+    CallbackType.VIEW_JOINED_JIOS_PAGE,
+    view_joined_jios_page,
+    page_direction,
+    jio_cursor,
+)
+router.add_route(CallbackType.CANCEL_VIEW, cancel_view)
+router.add_route(CallbackType.SEARCH_JIOS, view_search_page, payloads.token, int)
+
+# Host actions on the jio message
+router.add_route(CallbackType.OWNER_ADD_ORDER, interested_owner, int)
+router.add_route(CallbackType.RESEND_MAIN_MESSAGE, resend_main_message, int)
+router.add_route(CallbackType.VIEW_JIO_PAGE, view_jio_page, int, int)
+
+# Deleting orders
+router.add_route(CallbackType.DELETE_ORDER, delete_order, int)
+router.add_route(CallbackType.CANCEL_ORDER_ACTION, cancel_order_action, int)
+router.add_route(CallbackType.DELETE_ORDER_ITEM, delete_order_item, int, int)
 
 # Adding favourite orders
-application.add_handler(
-    CallbackQueryHandler(add_favourite_item, pattern=CallbackType.FAVOURITE_ITEM)
-)
-application.add_handler(
-    CallbackQueryHandler(
-        confirm_favourite_item, pattern=CallbackType.CONFIRM_FAVOURITE_ITEM
-    )
-)
-application.add_handler(
-    CallbackQueryHandler(
-        delete_favourite_item, pattern=CallbackType.REMOVE_FAVOURITE_ITEM
-    )
-)
+router.add_route(CallbackType.FAVOURITE_ITEM, add_favourite_item, int)
+router.add_route(CallbackType.CONFIRM_FAVOURITE_ITEM, confirm_favourite_item, int, int)
+router.add_route(CallbackType.REMOVE_FAVOURITE_ITEM, delete_favourite_item, int, int)
 
-# Viewing favourites
-application.add_handler(
-    CallbackQueryHandler(view_favourites, pattern=CallbackType.MAIN_MENU_FAVOURITES)
+# Viewing and removing favourites in the main menu
+router.add_route(CallbackType.MAIN_MENU_FAVOURITES, view_favourites)
+router.add_route(
+    CallbackType.VIEW_FAVOURITE_ITEMS, view_restaurant_favourites, payloads.token
 )
-application.add_handler(
-    CommandHandler("favourites", view_favourites, filters.ChatType.PRIVATE)
+router.add_route(
+    CallbackType.MAIN_MENU_REMOVE_FAV_ITEM,
+    main_menu_confirm_favourite_action,
+    payloads.token,
+    int,
 )
-
-# Viewing favourite items in main menu
-application.add_handler(
-    CallbackQueryHandler(
-        view_restaurant_favourites, pattern=CallbackType.VIEW_FAVOURITE_ITEMS
-    )
+router.add_route(
+    CallbackType.MAIN_MENU_CONFIRM_DELETE_FAV_ITEM,
+    main_menu_confirm_delete_fav_item,
+    payloads.token,
+    int,
 )
 
-# Confirming whether to delete favourite item
-application.add_handler(
-    CallbackQueryHandler(
-        main_menu_confirm_favourite_action,
-        pattern=CallbackType.MAIN_MENU_REMOVE_FAV_ITEM,
-    )
-)
-application.add_handler(
-    CallbackQueryHandler(
-        main_menu_confirm_delete_fav_item,
-        pattern=CallbackType.MAIN_MENU_CONFIRM_DELETE_FAV_ITEM,
-    )
-)
+# Closing and reopening jios
+router.add_route(CallbackType.CLOSE_JIO, close_jio, int)
+router.add_route(CallbackType.REOPEN_JIO, reopen_jio, int)
+router.add_route(CallbackType.CREATE_ORDERING_LIST, create_ordering_list, int)
+router.add_route(CallbackType.BACK, back, int)
+router.add_route(CallbackType.PING_ALL_UNPAID, ping_unpaid_users, int)
 
-# Close and reopen jio handler
-application.add_handler(CallbackQueryHandler(close_jio, pattern=CallbackType.CLOSE_JIO))
-application.add_handler(
-    CallbackQueryHandler(reopen_jio, pattern=CallbackType.REOPEN_JIO)
-)
+# Payment
+router.add_route(CallbackType.DECLARE_PAYMENT, declare_payment, int)
+router.add_route(CallbackType.UNDO_PAYMENT, undo_payment, int)
 
-# Create ordering list handler
-application.add_handler(
-    CallbackQueryHandler(
-        create_ordering_list, pattern=CallbackType.CREATE_ORDERING_LIST
-    )
-)
-application.add_handler(CallbackQueryHandler(back, pattern=CallbackType.BACK))
+# No-Operation (empty buttons)
+router.add_route(CallbackType.NOP, nop)
 
-# Payment handlers
-application.add_handler(
-    CallbackQueryHandler(declare_payment, pattern=CallbackType.DECLARE_PAYMENT)
-)
-application.add_handler(
-    CallbackQueryHandler(undo_payment, pattern=CallbackType.UNDO_PAYMENT)
-)
+application.add_handler(router)
 
-# Ping unpaid users
+# Viewing favourites
 application.add_handler(
-    CallbackQueryHandler(ping_unpaid_users, pattern=CallbackType.PING_ALL_UNPAID)
+    CommandHandler("favourites", view_favourites, filters.ChatType.PRIVATE)
 )
 
+# Searching created and joined jios
+application.add_handler(CommandHandler("search", search, filters.ChatType.PRIVATE))
+
 # /start and /help command handler
 application.add_handler(CommandHandler("start", start_group, ~filters.ChatType.PRIVATE))
 application.add_handler(CommandHandler("start", start))
 application.add_handler(CommandHandler("help", help_command))
 
-# InlineQuery and InlineQuery result handler
+# InlineQuery and InlineQuery result handler. Queries other than "order" or
+# "order<jio_id>" search the user's jios, including other words starting with "order"
+application.add_handler(InlineQueryHandler(inline_search, r"^(?!order\d*\Z)\W*[^\W_]"))
 application.add_handler(InlineQueryHandler(inline_query))
 application.add_handler(ChosenInlineResultHandler(shared_jio, pattern="order"))
 
-# No-Operation (empty buttons)
-application.add_handler(CallbackQueryHandler(nop, pattern=CallbackType.NOP))
-
-# Not yet implemented callbacks
-unimplemented_callbacks = "|".join(
-    (
-        CallbackType.AMEND_DESCRIPTION,
-        CallbackType.PING_ALL_UNPAID,
-    )
-)
-application.add_handler(
-    CallbackQueryHandler(not_implemented_callback, unimplemented_callbacks)
-)
-
 # Fall through for any callbacks
 application.add_handler(CallbackQueryHandler(unrecognized_callback))
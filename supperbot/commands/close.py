@@ -1,64 +1,262 @@
 """
 Coroutines for when the user decides to close a supper jio
 """
-from collections import Counter
+import asyncio
 import logging
+import time
 
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.error import BadRequest
-from telegram.ext import ContextTypes
+from telegram import Bot, Message, Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import ContextTypes, ConversationHandler
 
-from supperbot.enums import parse_callback_data, join, CallbackType
+from supperbot.enums import join, parse_callback_data, CallbackType
 from supperbot.db import db
-from supperbot.commands.ordering import format_and_send_user_orders
-from supperbot.commands.helper import update_all_jio_messages, update_main_jio_message
+from supperbot.db.models import Order, SupperJio
+from supperbot.normalize import (
+    MAX_ALIAS_LENGTH,
+    MAX_ALIASES,
+    forget_aliases,
+    get_alias_index,
+    normalize_name,
+)
+from supperbot.outbound import Priority, priority
+from supperbot.commands.helper import (
+    edit_if_changed,
+    forget_message,
+    format_order_message,
+    gather_bounded,
+    order_message_keyboard_markup,
+    update_main_jio_message,
+)
 
 
-async def close_jio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+# Maximum number of users pinged at the same time. The rate limits in
+# `supperbot.outbound` still apply, this only bounds the number of waiting requests
+MAX_CONCURRENT_PINGS = 16
+
+# Minimum number of seconds between edits of the progress message shown while pinging
+PING_PROGRESS_INTERVAL = 2
+
+# Pings being sent, by jio
+_running_pings: dict[int, asyncio.Task] = {}
+
+
+async def update_jio_status(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, status: db.Stage
+) -> None:
+    """
+    Closes or reopens the jio of the callback query.
+
+    Only the host's message is edited before answering the query, so the host does not
+    wait longer for bigger jios. The shared messages and then the participants' messages
+    are refreshed in the background, see `supperbot.outbox`.
+    """
     query = update.callback_query
-    jio_id = int(parse_callback_data(query.data)[1])
+    (jio_id,) = context.args
+
+    db.enqueue_refresh(jio_id, db.RefreshKind.SHARED)
+    db.enqueue_refresh(jio_id, db.RefreshKind.INDIVIDUALS)
+    await db.update_jio_status(jio_id, status)
+
+    jio = await db.get_jio(jio_id)
+    with priority(Priority.HIGH):
+        await update_main_jio_message(context.bot, jio)
+    await query.answer()
+
 
+async def close_jio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # TODO: Check if already closed. Possible if original message was duplicated
-    db.update_jio_status(jio_id, db.Stage.CLOSED)
-    await update_all_jio_messages(context.bot, jio_id)
+    await update_jio_status(update, context, db.Stage.CLOSED)
 
 
 async def reopen_jio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    jio_id = int(parse_callback_data(query.data)[1])
+    await update_jio_status(update, context, db.Stage.CREATED)
+
+
+async def format_ordering_list(jio: SupperJio) -> str:
+    """
+    Returns the total quantity of each food ordered for the jio. The same food written
+    in different ways is counted together, see `supperbot.normalize`.
+    """
+    index = await get_alias_index(jio.restaurant)
+    counts = index.count(await db.get_food_counts(jio.id))
 
-    db.update_jio_status(jio_id, db.Stage.CREATED)
-    await update_all_jio_messages(context.bot, jio_id)
+    text = "Orders:\n\n"
+
+    text += "\n".join(f"{k}: {v}" for k, v in counts)
+    return text
 
 
-async def create_ordering_list(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+def ordering_list_keyboard_markup(jio_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    "✏ Merge items",
+                    callback_data=join(CallbackType.EDIT_FOOD_ALIASES, str(jio_id)),
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "Back", callback_data=join(CallbackType.BACK, str(jio_id))
+                )
+            ],
+        ]
+    )
+
+
+async def create_ordering_list(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
     query = update.callback_query
-    jio_id = int(parse_callback_data(query.data)[1])
+    (jio_id,) = context.args
+    jio = await db.get_jio(jio_id)
+
+    text = await format_ordering_list(jio)
+    keyboard = ordering_list_keyboard_markup(jio_id)
+
+    forget_message(update.effective_message)
+    await update.effective_message.edit_text(text, reply_markup=keyboard)
+    await query.answer()
 
-    counter = Counter()
-    for order in db.get_list_complete_orders(jio_id):
-        # Reduce to lower case so that we can match similar orders
 
-        # TODO: Create a way to combine two different orders together for convenience
-        #       eg so can combine "m fries" and "medium fries" together
-        counter.update(map(str.lower, order.food_list))
+def format_food_aliases(aliases: list[tuple[str, str]]) -> str:
+    return "\n".join(f"{alias} = {name}" for alias, name in aliases) or "None"
 
-    text = "Orders:\n\n"
 
-    text += "\n".join(f"{k}: {v}" for k, v in counter.items())
+def parse_food_aliases(text: str) -> tuple[dict[str, str], list[str], list[str]]:
+    """
+    Parses the aliases sent by a host, one per line, either as "alias = name" or as
+    "- alias" to remove the alias.
+
+    :return: The aliases to set, the aliases to remove, and the lines which are neither.
+    """
+    aliases, removed, invalid = {}, [], []
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
 
-    keyboard = InlineKeyboardMarkup.from_button(
-        InlineKeyboardButton("Back", callback_data=join(CallbackType.BACK, str(jio_id)))
+        alias, sep, name = line.partition("=")
+        alias, name = normalize_name(alias), normalize_name(name)
+
+        if not sep and line.startswith("-") and alias:
+            removed.append(alias)
+        elif (
+            sep
+            and alias
+            and name
+            and alias != name
+            and len(alias) <= MAX_ALIAS_LENGTH
+            and len(name) <= MAX_ALIAS_LENGTH
+        ):
+            aliases[alias] = name
+        else:
+            invalid.append(line)
+
+    return aliases, removed, invalid
+
+
+async def edit_food_aliases(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    jio_id = int(parse_callback_data(query.data)[1])
+    jio = await db.get_jio(jio_id)
+
+    # Only ids are kept in `user_data`, see `SQLPersistence`
+    context.user_data["alias_jio"] = jio_id
+
+    aliases = await db.get_food_aliases(normalize_name(jio.restaurant))
+    message = (
+        f"Merging items for {jio.restaurant}, in this and future jios.\n\n"
+        "Send the names to merge, one per line, followed by the name to count them "
+        "as, eg\n"
+        "m fries = medium fries\n\n"
+        'Send "- m fries" to stop merging a name. Sizes such as "m" for "medium" are '
+        "always merged.\n\n"
+        f"Names merged now:\n{format_food_aliases(aliases)}"
     )
 
-    await update.effective_message.edit_text(text, reply_markup=keyboard)
+    msg = await update.effective_chat.send_message(
+        text=message,
+        reply_markup=InlineKeyboardMarkup.from_button(
+            InlineKeyboardButton(
+                text="↩ Cancel",
+                callback_data=CallbackType.CANCEL_EDIT_FOOD_ALIASES,
+            )
+        ),
+    )
+    context.user_data["alias_msg"] = [msg.chat_id, msg.message_id]
+
     await query.answer()
+    return CallbackType.FINISH_EDIT_FOOD_ALIASES
+
+
+async def finish_edit_food_aliases(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    jio = await db.get_jio(context.user_data.pop("alias_jio"))
+    restaurant = normalize_name(jio.restaurant)
+
+    aliases, removed, invalid = parse_food_aliases(update.message.text)
+
+    existing = dict(await db.get_food_aliases(restaurant))
+    for alias in removed:
+        existing.pop(alias, None)
+    existing.update(aliases)
+
+    if len(existing) > MAX_ALIASES:
+        message = f"Each restaurant can have at most {MAX_ALIASES} merged names."
+    else:
+        await db.set_food_aliases(restaurant, aliases, removed)
+        forget_aliases(jio.restaurant)
+
+        message = f"Names merged for {jio.restaurant}:\n"
+        message += format_food_aliases(sorted(existing.items()))
+        if invalid:
+            message += "\n\nLines not understood:\n" + "\n".join(invalid)
+
+    await _end_edit_food_aliases(context, jio)
+    await update.effective_chat.send_message(message)
+
+    # The host's jio message shows the ordering list which the conversation was
+    # started from
+    try:
+        await edit_if_changed(
+            context.bot,
+            await format_ordering_list(jio),
+            ordering_list_keyboard_markup(jio.id),
+            chat_id=jio.chat_id,
+            message_id=jio.message_id,
+        )
+    except BadRequest as e:
+        logging.error(f"Unable to edit ordering list for jio {jio.id}: {e}")
+
+    return ConversationHandler.END
+
+
+async def cancel_edit_food_aliases(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    jio = await db.get_jio(context.user_data.pop("alias_jio"))
+    await _end_edit_food_aliases(context, jio)
+
+    await update.callback_query.answer()
+    return ConversationHandler.END
+
+
+async def _end_edit_food_aliases(
+    context: ContextTypes.DEFAULT_TYPE, jio: SupperJio
+) -> None:
+    # Removes the cancel button
+    try:
+        chat_id, message_id = context.user_data.pop("alias_msg")
+        await context.bot.edit_message_reply_markup(chat_id, message_id, None)
+    except BadRequest as e:
+        logging.error(f"Unable to edit merge items message for jio {jio}: {e}")
 
 
 async def back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    jio_id = int(parse_callback_data(query.data)[1])
-    jio = db.get_jio(jio_id)
+    (jio_id,) = context.args
+    jio = await db.get_jio(jio_id)
 
     await update_main_jio_message(context.bot, jio)
     await query.answer()
@@ -66,45 +264,119 @@ async def back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def ping_unpaid_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    jio_id = int(parse_callback_data(query.data)[1])
+    (jio_id,) = context.args
 
-    bot = context.bot
+    if jio_id in _running_pings:
+        await query.answer("Still pinging the previous batch of users!")
+        return
 
     # TODO: Ensure a minimum timeframe before allowing to ping again?
-    orders = db.get_list_all_orders(jio_id)
+    orders = await db.get_unpaid_orders(jio_id)
+    await query.answer(f"Pinging {len(orders)} unpaid users...")
 
-    pinged = []
-    not_pinged = []
+    progress = await update.effective_chat.send_message(
+        format_ping_progress(0, len(orders))
+    )
 
-    for order in orders:
-        if not order.has_paid():
-            try:
-                await bot.edit_message_reply_markup(
-                    order.user.chat_id, order.message_id, reply_markup=None
-                )
-            except BadRequest as e:
-                logging.error(
-                    f"Unable to edit message {order.message_id} for "
-                    f"{order.user.display_name} (Chat id {order.user.chat_id}): {e}"
-                )
+    # The pings are sent in the background, so that other updates to the jio are not
+    # held up while waiting for the rate limits
+    task = context.application.create_task(
+        ping_orders(context.bot, jio_id, orders, progress), update=update
+    )
+    _running_pings[jio_id] = task
+    task.add_done_callback(lambda _: _running_pings.pop(jio_id, None))
 
-            try:
-                await bot.send_message(
-                    order.user.chat_id, "Reminder to pay for your food!"
-                )
-                await format_and_send_user_orders(
-                    order.user_id, order.user.chat_id, jio_id, bot
-                )
-            except BadRequest as e:
-                logging.error(f"Unable to ping user {order.user.display_name}: {e}")
-                not_pinged.append(order.user.display_name)
-            else:
-                pinged.append(order.user.display_name)
 
-    await query.answer()
+def format_ping_progress(done: int, total: int) -> str:
+    return f"Pinging unpaid users... ({done}/{total})"
 
+
+def format_ping_results(pinged: list[str], not_pinged: list[str]) -> str:
     text = "Pinged users:\n"
     text += "\n".join(pinged) or "None"
     text += "\n\nUsers not pinged:\n"
     text += "\n".join(not_pinged) or "None"
-    await update.effective_chat.send_message(text)
+    return text
+
+
+async def ping_order(bot: Bot, order: Order) -> int:
+    """
+    Reminds the user of the order to pay, and sends them their order again.
+
+    :return: The id of the message the user's order was sent in.
+    """
+    user = order.user
+
+    try:
+        await bot.edit_message_reply_markup(
+            user.chat_id, order.message_id, reply_markup=None
+        )
+    except BadRequest as e:
+        logging.error(
+            f"Unable to edit message {order.message_id} for "
+            f"{user.display_name} (Chat id {user.chat_id}): {e}"
+        )
+
+    # The reminder is sent together with the order, halving the messages sent to
+    # each user
+    msg = await bot.send_message(
+        user.chat_id,
+        "Reminder to pay for your food!\n\n" + format_order_message(order),
+        reply_markup=order_message_keyboard_markup(order),
+        parse_mode=ParseMode.HTML,
+    )
+    return msg.message_id
+
+
+async def ping_orders(
+    bot: Bot, jio_id: int, orders: list[Order], progress: Message
+) -> None:
+    """
+    Pings the users of all the orders concurrently, editing the progress message as
+    the pings finish, and then replacing it with the results.
+    """
+    total = len(orders)
+    done = 0
+    last_edit = time.monotonic()
+
+    message_ids = {}
+
+    async def ping(order: Order) -> None:
+        nonlocal done, last_edit
+
+        try:
+            message_ids[order.user_id] = await ping_order(bot, order)
+        except TelegramError as e:
+            logging.error(f"Unable to ping user {order.user.display_name}: {e}")
+
+        done += 1
+        now = time.monotonic()
+        if done < total and now - last_edit >= PING_PROGRESS_INTERVAL:
+            last_edit = now
+            await edit_if_changed(
+                bot,
+                format_ping_progress(done, total),
+                None,
+                chat_id=progress.chat_id,
+                message_id=progress.message_id,
+                parse_mode=None,
+            )
+
+    await gather_bounded((ping(order) for order in orders), MAX_CONCURRENT_PINGS)
+
+    # Runs after the update which started the pings, so it needs a session of its own
+    async with db.session_scope():
+        await db.update_order_message_ids(jio_id, message_ids)
+
+    pinged = [o.user.display_name for o in orders if o.user_id in message_ids]
+    not_pinged = [o.user.display_name for o in orders if o.user_id not in message_ids]
+    # Display names are not escaped, so the results are sent as plain text, like the
+    # progress message they replace
+    await edit_if_changed(
+        bot,
+        format_ping_results(pinged, not_pinged),
+        None,
+        chat_id=progress.chat_id,
+        message_id=progress.message_id,
+        parse_mode=None,
+    )
@@ -1,7 +1,11 @@
 """Coroutines and helper functions relating to creation and sharing of a supper jio"""
+from __future__ import annotations
+
 import logging
+from collections import OrderedDict
 
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -18,14 +22,32 @@ from telegram.helpers import create_deep_linked_url
 from sqlalchemy.exc import NoResultFound
 
 from supperbot.db import db
+from supperbot.db.models import RefreshKind, SupperJio
 from supperbot.enums import CallbackType, parse_callback_data
 from supperbot.commands.helper import (
+    forget_message,
     format_jio_message,
     main_message_keyboard_markup,
-    update_consolidated_orders,
+    render_jio_page,
+    update_main_jio_message,
+    update_shared_jio_message,
 )
 
 
+# Number of jios in each page of inline query results, and the number of seconds
+# Telegram may cache each page for. Jios shared from results which are out of date are
+# refreshed once they are shared, see `shared_jio`
+INLINE_PAGE_SIZE = 10
+INLINE_CACHE_TIME = 30
+
+# Maximum number of inline queries whose answers are kept
+MAX_INLINE_ANSWERS = 1024
+
+# Answers to inline queries by user id and query, least recently used first. See
+# `inline_query`
+_inline_answers: OrderedDict[tuple[int, str], InlineAnswer] = OrderedDict()
+
+
 async def create(update: Update, context: ContextTypes.DEFAULT_TYPE) -> CallbackType:
     """Main command for creating a new jio."""
 
@@ -88,95 +110,132 @@ async def finished_creation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Presents the final jio text after finishing the initialisation process."""
 
     information = update.message.text
-    jio = db.create_jio(
+    jio = await db.create_jio(
         update.effective_user.id, context.user_data["restaurant"], information
     )
 
     # TODO: The following part is repeated in `resend_main_message`. Maybe refactor?
-    message = format_jio_message(jio)
+    message = await format_jio_message(jio)
     keyboard = main_message_keyboard_markup(jio, context.bot)
 
     msg = await update.effective_chat.send_message(
         text=message, reply_markup=keyboard, parse_mode=ParseMode.HTML
     )
-    db.update_jio_message_id(jio.id, msg.chat_id, msg.message_id)
+    await db.update_jio_message_id(jio.id, msg.chat_id, msg.message_id)
 
     context.user_data["create"] = False
 
     return ConversationHandler.END
 
 
+class InlineAnswer:
+    """
+    The jios listed in answer to a user's inline query, and the results rendered for
+    them so far, as of the versions of the jios they were rendered at.
+    """
+
+    __slots__ = ("list_version", "jio_ids", "results")
+
+    def __init__(self, list_version: int, jio_ids: list[int]):
+        self.list_version = list_version
+        self.jio_ids = jio_ids
+        self.results: dict[int, tuple[int, InlineQueryResultArticle]] = {}
+
+
+async def _load_inline_jios(user_id: int, requested_id: str) -> list[SupperJio]:
+    # Only the user's own jios can be shared. Without an id, only open jios are listed
+    if not requested_id:
+        return await db.get_user_jios(user_id, limit=None)
+
+    try:
+        jio = await db.get_jio(int(requested_id))
+    except NoResultFound:
+        return []
+    return [jio] if jio.owner_id == user_id else []
+
+
+async def _inline_result(jio: SupperJio, bot: Bot) -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        id=f"order{jio.id}",
+        title=f"Order {jio.id}",
+        description=f"Jio for {jio.restaurant}",
+        input_message_content=InputTextMessageContent(
+            await format_jio_message(jio), parse_mode=ParseMode.HTML
+        ),
+        reply_markup=InlineKeyboardMarkup.from_button(
+            InlineKeyboardButton(
+                text="➕ Add Order",
+                url=create_deep_linked_url(bot.username, f"order{jio.id}"),
+            )
+        ),
+    )
+
+
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles the inline queries from sharing jios."""
+    """
+    Handles the inline queries from sharing jios.
+
+    Queries are sent on every keystroke, so the jios listed for each query, and the
+    results rendered for them, are cached. Results are only rendered again once their
+    jio changes, and the jios are only listed again once one of the user's jios is created
+    or closed.
+    Results are sent a page at a time, and only the jios on the page are rendered.
+    """
 
     query = update.inline_query.query
     logging.debug("Received an inline query: " + query)
 
-    if query == "" or not query.startswith("order"):
-        await update.inline_query.answer([])
+    requested_id = query[5:]
+    if not query.startswith("order") or (requested_id and not requested_id.isdigit()):
+        await update.inline_query.answer([], cache_time=INLINE_CACHE_TIME)
         return
 
-    # TODO: Abstract out this part
-    order_id_str = query[5:]
-
-    if order_id_str:
-        # An order id is provided
-
-        order_id = int(query[5:])
-
-        # Check if the order id is valid
-        try:
-            jio = db.get_jio(order_id)
-        except NoResultFound:
-            jio = None
-
-        if jio is None or jio.owner_id != update.effective_user.id:
-            await update.inline_query.answer([])
-            return
-
-        # User owns the supper jio
-        deep_link = create_deep_linked_url(context.bot.username, f"order{order_id}")
-
-        results = [
-            InlineQueryResultArticle(
-                id=f"order{jio.id}",
-                title=f"Order {jio.id}",
-                description=f"Jio for {jio.restaurant}",
-                input_message_content=InputTextMessageContent(
-                    format_jio_message(jio), parse_mode=ParseMode.HTML
-                ),
-                reply_markup=InlineKeyboardMarkup.from_button(
-                    InlineKeyboardButton(text="➕ Add Order", url=deep_link)
-                ),
-            )
-        ]
-
-        await update.inline_query.answer(results)
-        return
+    user_id = update.effective_user.id
+    key = user_id, query
+    list_version = db.get_jio_list_version(user_id)
+    jios = None
 
-    # An order id is not provided
-    jios = db.get_user_jios(update.effective_user.id)
-
-    results = [
-        InlineQueryResultArticle(
-            id=f"order{jio.id}",
-            title=f"Order {jio.id}",
-            description=f"Jio for {jio.restaurant}",
-            input_message_content=InputTextMessageContent(
-                format_jio_message(jio), parse_mode=ParseMode.HTML
-            ),
-            reply_markup=InlineKeyboardMarkup.from_button(
-                InlineKeyboardButton(
-                    text="➕ Add Order",
-                    url=create_deep_linked_url(context.bot.username, f"order{jio.id}"),
-                )
-            ),
+    answer = _inline_answers.get(key)
+    if answer is None or answer.list_version != list_version:
+        jios = await _load_inline_jios(user_id, requested_id)
+        answer = _inline_answers[key] = InlineAnswer(
+            list_version, [jio.id for jio in jios]
         )
-        for jio in jios
-    ]
 
-    await update.inline_query.answer(results)
-    return
+    _inline_answers.move_to_end(key)
+    if len(_inline_answers) > MAX_INLINE_ANSWERS:
+        _inline_answers.popitem(last=False)
+
+    offset = update.inline_query.offset
+    offset = int(offset) if offset.isdigit() else 0
+    page = answer.jio_ids[offset : offset + INLINE_PAGE_SIZE]
+
+    stale = [
+        jio_id
+        for jio_id in page
+        if answer.results.get(jio_id, (None,))[0] != db.get_jio_version(jio_id)
+    ]
+    if stale:
+        if jios is None:
+            jios = await _load_inline_jios(user_id, requested_id)
+        loaded = {jio.id: jio for jio in jios}
+
+        for jio_id in stale:
+            if jio_id in loaded:
+                # The version is read before rendering, so that a change made while
+                # rendering is picked up by the next query
+                version = db.get_jio_version(jio_id)
+                result = await _inline_result(loaded[jio_id], context.bot)
+                answer.results[jio_id] = version, result
+
+    results = [answer.results[jio_id][1] for jio_id in page if jio_id in answer.results]
+    next_offset = offset + INLINE_PAGE_SIZE
+    await update.inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=True,
+        next_offset=str(next_offset) if next_offset < len(answer.jio_ids) else "",
+    )
 
 
 async def shared_jio(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
@@ -190,7 +249,9 @@ async def shared_jio(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     jio_id = int(chosen_result.result_id[5:])
     msg_id = chosen_result.inline_message_id
 
-    db.new_msg(jio_id, msg_id)
+    # The result may have been cached by Telegram, and be out of date
+    db.enqueue_refresh(jio_id, RefreshKind.SHARED)
+    await db.new_msg(jio_id, msg_id)
 
 
 async def resend_main_message(
@@ -198,8 +259,8 @@ async def resend_main_message(
 ) -> None:
 
     query = update.callback_query
-    jio_id = int(parse_callback_data(query.data)[1])
-    jio = db.get_jio(jio_id)
+    (jio_id,) = context.args
+    jio = await db.get_jio(jio_id)
 
     # Try editing the previous main message
     try:
@@ -207,23 +268,46 @@ async def resend_main_message(
     except BadRequest as e:
         logging.error(f"Unable to edit main message for jio {jio}: {e}")
 
-    message = format_jio_message(jio)
-    keyboard = main_message_keyboard_markup(jio, context.bot)
+    message, page, pages = await render_jio_page(jio)
+    keyboard = main_message_keyboard_markup(jio, context.bot, page, pages)
 
     await query.answer()
 
     msg = await update.effective_chat.send_message(
         text=message, reply_markup=keyboard, parse_mode=ParseMode.HTML
     )
-    db.update_jio_message_id(jio.id, msg.chat_id, msg.message_id)
+    await db.update_jio_message_id(jio.id, msg.chat_id, msg.message_id)
+
+
+async def view_jio_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows another page of a jio message, for jios too large for one message."""
+    query = update.callback_query
+    jio_id, page = context.args
+    jio = await db.get_jio(jio_id)
+
+    # The page is recorded first, so that refreshes made meanwhile show it too
+    if query.inline_message_id:
+        await db.update_msg_page(query.inline_message_id, page)
+        await update_shared_jio_message(
+            context.bot, jio, query.inline_message_id, page=page
+        )
+    else:
+        await db.update_jio_message_page(jio.id, page)
+        await update_main_jio_message(context.bot, jio, page=page)
+
+    await query.answer()
 
 
 async def amend_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     jio_id = int(parse_callback_data(query.data)[1])
-    jio = context.user_data["jio"] = db.get_jio(jio_id)
+    jio = await db.get_jio(jio_id)
+
+    # Only ids are kept in `user_data`, see `SQLPersistence`
+    context.user_data["amend_jio"] = jio_id
 
     # Try removing the markup
+    forget_message(update.effective_message)
     try:
         await update.effective_message.edit_reply_markup(None)
     except BadRequest as e:
@@ -246,7 +330,7 @@ async def amend_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ),
         parse_mode=ParseMode.HTML,
     )
-    context.user_data["amend_msg"] = msg
+    context.user_data["amend_msg"] = [msg.chat_id, msg.message_id]
 
     await query.answer()
     return CallbackType.FINISH_AMEND_DESCRIPTION
@@ -254,51 +338,48 @@ async def amend_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def finish_amend_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
     information = update.message.text
-    jio = context.user_data["jio"]
-    del context.user_data["jio"]
+    jio = await db.get_jio(context.user_data.pop("amend_jio"))
 
-    db.edit_jio_description(jio, information)
+    # The host's jio message is sent again below, so only the shared messages are left
+    # to the outbox
+    db.enqueue_refresh(jio.id, RefreshKind.SHARED)
+    await db.edit_jio_description(jio, information)
 
     # TODO: Copied from `resend_main_message`. Try and refactor
     # Try editing the previous main message
     try:
-        await context.user_data["amend_msg"].edit_reply_markup(None)
-        del context.user_data["amend_msg"]
+        chat_id, message_id = context.user_data.pop("amend_msg")
+        await context.bot.edit_message_reply_markup(chat_id, message_id, None)
     except BadRequest as e:
         logging.error(f"Unable to edit amend message for jio {jio}: {e}")
 
-    message = format_jio_message(jio)
-    keyboard = main_message_keyboard_markup(jio, context.bot)
+    message, page, pages = await render_jio_page(jio)
+    keyboard = main_message_keyboard_markup(jio, context.bot, page, pages)
 
     msg = await update.effective_chat.send_message(
         text=message, reply_markup=keyboard, parse_mode=ParseMode.HTML
     )
-    db.update_jio_message_id(jio.id, msg.chat_id, msg.message_id)
-
-    # TODO: `update_consolidated_orders` tries to edit the host's jio message too.
-    #       Maybe consider refactoring? Else will throw error in logs
-    await update_consolidated_orders(context.bot, jio.id)
+    await db.update_jio_message_id(jio.id, msg.chat_id, msg.message_id)
 
     return ConversationHandler.END
 
 
 async def cancel_amend_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    jio = context.user_data["jio"]
-    del context.user_data["jio"]
+    jio = await db.get_jio(context.user_data.pop("amend_jio"))
 
     # TODO: Copied from `resend_main_message`. Try and refactor
     # Try editing the previous main message
     try:
-        await context.user_data["amend_msg"].edit_reply_markup(None)
-        del context.user_data["amend_msg"]
+        chat_id, message_id = context.user_data.pop("amend_msg")
+        await context.bot.edit_message_reply_markup(chat_id, message_id, None)
     except BadRequest as e:
         logging.error(f"Unable to edit amend message for jio {jio}: {e}")
 
-    message = format_jio_message(jio)
-    keyboard = main_message_keyboard_markup(jio, context.bot)
+    message, page, pages = await render_jio_page(jio)
+    keyboard = main_message_keyboard_markup(jio, context.bot, page, pages)
 
     msg = await update.effective_chat.send_message(
         text=message, reply_markup=keyboard, parse_mode=ParseMode.HTML
     )
-    db.update_jio_message_id(jio.id, msg.chat_id, msg.message_id)
+    await db.update_jio_message_id(jio.id, msg.chat_id, msg.message_id)
     return ConversationHandler.END
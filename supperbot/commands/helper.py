@@ -1,45 +1,356 @@
 from __future__ import annotations
 
+import asyncio
 import logging
-
-from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.constants import ParseMode
-from telegram.error import BadRequest
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Any, Coroutine, Hashable, Iterable
+
+from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton, Message
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import (
+    BadRequest,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+)
 from telegram.helpers import create_deep_linked_url
 
 from supperbot import enums
 from supperbot.enums import CallbackType, join
 from supperbot.db import db
-from supperbot.db.models import SupperJio, Order
+from supperbot.db.models import SupperJio, Order, PaidStatus, format_food
 
 
-def format_jio_message(jio: SupperJio) -> str:
-    """Helper function to format the text for the jio messages."""
+# Maximum number of messages edited at the same time when fanning out an update
+MAX_CONCURRENT_EDITS = 8
 
-    message = (
+# Descriptions of errors after which a shared message can never be edited again, eg
+# because it was deleted
+PERMANENT_EDIT_ERRORS = (
+    "message to edit not found",
+    "message_id_invalid",
+    "message can't be edited",
+    "chat not found",
+)
+
+# Maximum number of messages whose last sent content is remembered
+MAX_FINGERPRINTS = 10_000
+
+# Fingerprints of the text and markup last sent to messages edited through
+# `edit_if_changed`, keyed by message, least recently used first
+_fingerprints: OrderedDict[Hashable, int] = OrderedDict()
+
+# Room kept in long messages for the page number, or for a note on left out items, and
+# the least room left for orders on a page, however long the jio's description is
+PAGE_HEADER_LENGTH = 64
+MIN_PAGE_LENGTH = 1024
+
+# Maximum number of jios whose rendered order lines are kept
+MAX_RENDERED_JIOS = 256
+
+# Rendered order lines by jio, least recently used first. See `render_order_lines`
+_order_lines: OrderedDict[int, JioOrderLines] = OrderedDict()
+
+
+async def gather_bounded(
+    coroutines: Iterable[Coroutine[Any, Any, Any]], limit: int = MAX_CONCURRENT_EDITS
+) -> list:
+    """
+    Runs the coroutines concurrently, with at most `limit` of them running at once.
+
+    Errors are isolated per coroutine - an exception is logged and returned in place of
+    that coroutine's result, and does not affect the others.
+
+    The coroutines share the caller's database session, so they must not access the
+    database themselves. Load everything needed before fanning out.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine: Coroutine[Any, Any, Any]) -> Any:
+        async with semaphore:
+            try:
+                return await coroutine
+            except Exception as e:
+                logging.error("Error while fanning out message edits", exc_info=e)
+                return e
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+
+def message_length(text: str) -> int:
+    """Returns the length of the text as counted by Telegram, in UTF-16 code units."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _fingerprint(text: str, reply_markup: InlineKeyboardMarkup | None) -> int:
+    return hash((text, reply_markup.to_json() if reply_markup else None))
+
+
+def forget_message(message: Message) -> None:
+    """
+    Forgets the content last sent to a message. Must be called when a message that is
+    kept up to date by `edit_if_changed` is edited in any other way.
+    """
+    _fingerprints.pop((message.chat_id, message.message_id), None)
+
+
+async def edit_if_changed(
+    bot: Bot,
+    text: str,
+    reply_markup: InlineKeyboardMarkup | None,
+    *,
+    chat_id: int = None,
+    message_id: int = None,
+    inline_message_id: str = None,
+    parse_mode: str | None = ParseMode.HTML,
+) -> bool:
+    """
+    Edits the text and markup of a message, unless they are the same as what was last
+    sent to it. Telegram rejects edits that do not change a message, so skipping them
+    saves requests.
+
+    :param parse_mode: How the text is formatted, or None if it is plain text.
+    :return: Whether the message was edited.
+    """
+    key = inline_message_id if inline_message_id else (chat_id, message_id)
+    fingerprint = _fingerprint(text, reply_markup)
+
+    if _fingerprints.get(key) == fingerprint:
+        _fingerprints.move_to_end(key)
+        return False
+
+    try:
+        await bot.edit_message_text(
+            text,
+            chat_id=chat_id,
+            message_id=message_id,
+            inline_message_id=inline_message_id,
+            parse_mode=parse_mode,
+            reply_markup=reply_markup,
+        )
+    except BadRequest as e:
+        # The content was not remembered, but the message is already up to date
+        if "message is not modified" not in e.message.lower():
+            raise
+
+    _fingerprints[key] = fingerprint
+    _fingerprints.move_to_end(key)
+    if len(_fingerprints) > MAX_FINGERPRINTS:
+        _fingerprints.popitem(last=False)
+
+    return True
+
+
+class JioOrderLines:
+    """
+    The rendered order lines of a jio's message, one per user, as of `version`.
+
+    Each line is kept together with the id of the user's first food item, which is the
+    position of the line in the message. When some orders change, only their lines are
+    loaded and rendered again, and spliced into the rest.
+    """
+
+    def __init__(self):
+        self.version = -1
+        self.lock = asyncio.Lock()
+
+        # The position, text and length (see `message_length`) of each user's line
+        self._lines: dict[int, tuple[int, str, int]] = {}
+        self._positions: list[tuple[int, int]] = []
+        self.length = 0
+
+        # Index of the first line of each page, and the page length they were split by
+        self._page_starts: list[int] = []
+        self._page_length = 0
+
+    def clear(self) -> None:
+        """Removes every line."""
+        self._lines.clear()
+        self._positions.clear()
+        self.length = 0
+        self._page_starts = []
+
+    def update(self, rows: Iterable[tuple], user_ids: Iterable[int]) -> None:
+        """
+        Replaces the lines of the given users with the ones rendered from `rows`. Users
+        without rows no longer have a line.
+        """
+        orders = {}
+        for item_id, user_id, display_name, paid, food, quantity in rows:
+            if user_id not in orders:
+                orders[user_id] = (item_id, display_name, paid, [])
+            orders[user_id][3].append(format_food(food, quantity))
+
+        for user_id in user_ids:
+            if user_id in self._lines:
+                position, _, length = self._lines.pop(user_id)
+                del self._positions[bisect_left(self._positions, (position, user_id))]
+                self.length -= length
+
+        for user_id, (position, display_name, paid, foods) in orders.items():
+            line = f"{display_name} -- " + "; ".join(foods)
+
+            if paid == PaidStatus.PAID:
+                line = "<s>" + line + "</s> Paid"
+
+            line += "\n"
+            self._lines[user_id] = (position, line, message_length(line))
+            insort(self._positions, (position, user_id))
+            self.length += self._lines[user_id][2]
+
+        self._page_starts = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self._lines[user_id][1] for _, user_id in self._positions)
+
+    def page_count(self, page_length: int) -> int:
+        return len(self._split(page_length))
+
+    def page(self, page: int, page_length: int) -> str:
+        """Returns the lines on the page, when split into pages of `page_length`."""
+        starts = self._split(page_length)
+        end = starts[page + 1] if page + 1 < len(starts) else len(self._positions)
+        return "".join(
+            self._lines[user_id][1]
+            for _, user_id in self._positions[starts[page] : end]
+        )
+
+    def _split(self, page_length: int) -> list[int]:
+        # Pages are only split again after the lines or the page length change
+        if self._page_starts and self._page_length == page_length:
+            return self._page_starts
+
+        starts = [0]
+        length = 0
+        for index, (_, user_id) in enumerate(self._positions):
+            line_length = self._lines[user_id][2]
+            if length and length + line_length > page_length:
+                starts.append(index)
+                length = 0
+            length += line_length
+
+        self._page_starts = starts
+        self._page_length = page_length
+        return starts
+
+
+async def render_order_lines(jio_id: int) -> JioOrderLines:
+    """
+    Returns the order lines of the jio's message, rendering only the orders that
+    changed since the lines were last rendered. See `JioOrderLines`.
+    """
+    lines = _order_lines.get(jio_id)
+    if lines is None:
+        lines = _order_lines[jio_id] = JioOrderLines()
+
+    _order_lines.move_to_end(jio_id)
+    if len(_order_lines) > MAX_RENDERED_JIOS:
+        _order_lines.popitem(last=False)
+
+    # Renders of the same jio wait for each other, so that a render never returns
+    # lines which are older than those returned by an earlier render
+    async with lines.lock:
+        version = db.get_jio_version(jio_id)
+
+        if lines.version < version:
+            changed = (
+                db.get_changed_orders(jio_id, lines.version)
+                if lines.version >= 0
+                else None
+            )
+            if changed is None:
+                # Rendered for the first time, or the jio's changes were not tracked
+                # since the last render
+                rows = await db.get_jio_order_lines(jio_id)
+                lines.clear()
+                lines.update(rows, ())
+            elif changed:
+                rows = await db.get_jio_order_lines(jio_id, changed)
+                lines.update(rows, changed)
+
+        lines.version = version
+        return lines
+
+
+async def render_jio_page(jio: SupperJio, page: int = 0) -> tuple[str, int, int]:
+    """
+    Formats the text for the jio messages.
+
+    Jios whose orders do not fit in one message are split into pages, each showing
+    some of the orders. Only the requested page is put together.
+
+    :return: The text, the page shown (`page`, moved within the range of pages) and
+        the number of pages.
+    """
+    header = (
         f"Supper Jio Order #{jio.id}: <b>{jio.restaurant}</b>\n"
         f"Additional Information: \n{jio.description}\n\n"
-        "Current Orders:\n"
     )
+    footer = "\n🛑 Jio is closed! 🛑" if jio.is_closed() else ""
 
-    orders = db.get_list_complete_orders(jio.id)
+    lines = await render_order_lines(jio.id)
 
-    if not orders:
+    if not lines.length:
         # No orders yet
-        return message + "None"
+        return header + "Current Orders:\nNone", 0, 1
+
+    length = message_length(header + footer) + lines.length + PAGE_HEADER_LENGTH
+    if length <= MessageLimit.TEXT_LENGTH:
+        return header + "Current Orders:\n" + lines.text + footer, 0, 1
+
+    page_length = max(
+        MessageLimit.TEXT_LENGTH - message_length(header + footer) - PAGE_HEADER_LENGTH,
+        MIN_PAGE_LENGTH,
+    )
+    pages = lines.page_count(page_length)
+    page = min(max(page, 0), pages - 1)
+
+    text = (
+        header
+        + f"Current Orders (page {page + 1} of {pages}):\n"
+        + lines.page(page, page_length)
+        + footer
+    )
+    return text, page, pages
 
-    for order in orders:
-        temp = f"{order.user.display_name} -- " + "; ".join(order.food_list)
 
-        if order.has_paid():
-            temp = "<s>" + temp + "</s> Paid"
+async def format_jio_message(jio: SupperJio) -> str:
+    """Helper function to format the text for the jio messages."""
+    return (await render_jio_page(jio))[0]
 
-        message += temp + "\n"
 
-    if jio.is_closed():
-        message += "\n🛑 Jio is closed! 🛑"
+def page_buttons(jio_id: int, page: int, pages: int) -> list[InlineKeyboardButton]:
+    """Returns the buttons to move between the pages of a jio message, if any."""
+    if pages <= 1:
+        return []
+
+    jio_str = str(jio_id)
+    buttons = []
+
+    if page > 0:
+        buttons.append(
+            InlineKeyboardButton(
+                "◀ Previous",
+                callback_data=join(CallbackType.VIEW_JIO_PAGE, jio_str, str(page - 1)),
+            )
+        )
+
+    buttons.append(
+        InlineKeyboardButton(f"{page + 1} / {pages}", callback_data=CallbackType.NOP)
+    )
+
+    if page < pages - 1:
+        buttons.append(
+            InlineKeyboardButton(
+                "Next ▶",
+                callback_data=join(CallbackType.VIEW_JIO_PAGE, jio_str, str(page + 1)),
+            )
+        )
 
-    return message
+    return buttons
 
 
 #
@@ -49,33 +360,40 @@ def format_jio_message(jio: SupperJio) -> str:
 #
 
 
-def main_message_keyboard_markup(jio: SupperJio, bot: Bot) -> InlineKeyboardMarkup:
+def main_message_keyboard_markup(
+    jio: SupperJio, bot: Bot, page: int = 0, pages: int = 1
+) -> InlineKeyboardMarkup:
     jio_str = str(jio.id)
 
     if jio.is_closed():
-        return InlineKeyboardMarkup.from_column(
+        keyboard = [
             [
                 InlineKeyboardButton(
                     "🔓 Reopen the jio",
                     callback_data=join(CallbackType.REOPEN_JIO, jio_str),
-                ),
+                )
+            ],
+            [
                 InlineKeyboardButton(
                     "✍️Create Ordering List",
                     callback_data=join(CallbackType.CREATE_ORDERING_LIST, jio_str),
-                ),
+                )
+            ],
+            [
                 InlineKeyboardButton(
                     "🔔 Ping Unpaid",
                     callback_data=join(CallbackType.PING_ALL_UNPAID, jio_str),
-                ),
+                )
+            ],
+            [
                 InlineKeyboardButton(
                     "♻ Refresh Message",
                     callback_data=join(CallbackType.RESEND_MAIN_MESSAGE, jio_str),
-                ),
+                )
             ],
-        )
-
-    return InlineKeyboardMarkup(
-        [
+        ]
+    else:
+        keyboard = [
             [
                 InlineKeyboardButton(
                     "📢 Share this Jio!", switch_inline_query=f"order{jio_str}"
@@ -102,20 +420,32 @@ def main_message_keyboard_markup(jio: SupperJio, bot: Bot) -> InlineKeyboardMark
                 ),
             ],
         ]
-    )
 
+    navigation = page_buttons(jio.id, page, pages)
+    if navigation:
+        keyboard.insert(0, navigation)
+
+    return InlineKeyboardMarkup(keyboard)
 
-async def update_main_jio_message(bot: Bot, jio: SupperJio, text: str = None):
-    text = format_jio_message(jio) if text is None else text
-    keyboard = main_message_keyboard_markup(jio, bot)
+
+async def update_main_jio_message(
+    bot: Bot, jio: SupperJio, text: str = None, *, page: int = None, pages: int = 1
+):
+    """
+    Edits the host's jio message. If `text` is not given, the given page of the jio is
+    rendered, otherwise `text` should be that page, out of `pages`. If `page` is not
+    given either, the message stays on the page it shows.
+    """
+    if page is None:
+        page = jio.message_page or 0
+    if text is None:
+        text, page, pages = await render_jio_page(jio, page)
+
+    keyboard = main_message_keyboard_markup(jio, bot, page, pages)
 
     try:
-        await bot.edit_message_text(
-            text,
-            chat_id=jio.chat_id,
-            message_id=jio.message_id,
-            parse_mode=ParseMode.HTML,
-            reply_markup=keyboard,
+        await edit_if_changed(
+            bot, text, keyboard, chat_id=jio.chat_id, message_id=jio.message_id
         )
     except BadRequest as e:
         logging.error(f"Unable to edit original jio message for order {jio.id}: {e}")
@@ -129,18 +459,25 @@ async def update_main_jio_message(bot: Bot, jio: SupperJio, text: str = None):
 
 
 def shared_message_reply_markup(
-    bot: Bot, jio: SupperJio
+    bot: Bot, jio: SupperJio, page: int = 0, pages: int = 1
 ) -> InlineKeyboardMarkup | None:
+    keyboard = []
 
-    if jio.is_closed():
-        return None
+    navigation = page_buttons(jio.id, page, pages)
+    if navigation:
+        keyboard.append(navigation)
 
-    return InlineKeyboardMarkup.from_button(
-        InlineKeyboardButton(
-            text="Add Order",
-            url=create_deep_linked_url(bot.bot.username, f"order{jio.id}"),
+    if not jio.is_closed():
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    text="Add Order",
+                    url=create_deep_linked_url(bot.bot.username, f"order{jio.id}"),
+                )
+            ]
         )
-    )
+
+    return InlineKeyboardMarkup(keyboard) if keyboard else None
 
 
 async def update_shared_jio_message(
@@ -149,41 +486,119 @@ async def update_shared_jio_message(
     message_id: str,
     text: str = None,
     reply_markup: InlineKeyboardMarkup = None,
-):
+    *,
+    page: int = 0,
+) -> TelegramError | None:
+    """
+    Edits a shared message, returning the error if the edit failed. If `text` is not
+    given, the given page of the jio is rendered, together with its markup.
+    """
     if text is None:
-        text = format_jio_message(jio)
-
-    if reply_markup is None:
-        reply_markup = shared_message_reply_markup(bot, jio)
+        text, page, pages = await render_jio_page(jio, page)
+        reply_markup = shared_message_reply_markup(bot, jio, page, pages)
 
     try:
-        await bot.edit_message_text(
-            text,
-            inline_message_id=message_id,
-            parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup,
-        )
-    except BadRequest as e:
-        # TODO: If fails, then remove the message from storage?
+        await edit_if_changed(bot, text, reply_markup, inline_message_id=message_id)
+    except TelegramError as e:
         logging.error(f"Unable to edit message with message_id {message_id}: {e}")
+        return e
+
+    return None
+
+
+def is_transient_edit_error(error: object) -> bool:
+    """Whether an edit which failed with the error may succeed if tried again."""
+    return isinstance(error, (NetworkError, RetryAfter)) and not isinstance(
+        error, BadRequest
+    )
+
+
+def is_permanent_edit_error(error: Exception) -> bool:
+    if isinstance(error, Forbidden):
+        return True
+    if isinstance(error, BadRequest):
+        description = error.message.lower()
+        return any(message in description for message in PERMANENT_EDIT_ERRORS)
+    return False
 
 
-async def update_consolidated_orders(bot: Bot, jio_id: int) -> None:
+async def record_shared_message_results(
+    message_ids: list[str], results: list[Exception | None]
+) -> None:
     """
-    Updates all messages that are used to consolidate supper orders,
-    ie the one in the host DM and the group shared messages
+    Records the results of editing shared messages, so that messages which can no
+    longer be edited are tombstoned. See `db.record_msg_failure`.
+
+    Transient errors are not recorded, as they say nothing about the message itself,
+    and an outage of Telegram would otherwise tombstone every message edited during it.
+    """
+    succeeded = []
+    for message_id, result in zip(message_ids, results):
+        if result is None:
+            succeeded.append(message_id)
+        elif not is_transient_edit_error(result):
+            await db.record_msg_failure(
+                message_id, type(result).__name__, is_permanent_edit_error(result)
+            )
+
+    if succeeded:
+        await db.record_msg_successes(succeeded)
+
+
+async def consolidated_order_edits(
+    bot: Bot, jio_id: int, include_main: bool = True
+) -> tuple[list[Coroutine], list[str]]:
     """
+    Renders the messages that are used to consolidate supper orders, and returns the
+    coroutines editing them. See `update_consolidated_orders`.
 
-    jio = db.get_jio(jio_id)
-    text = format_jio_message(jio)
-    await update_main_jio_message(bot, jio, text)
+    Every message stays on the page of the jio it shows. Each page shown is only
+    rendered once, however many messages show it.
 
-    # Edit shared jio messages
-    messages_to_edit = db.get_msg_id(jio_id)
-    reply_markup = shared_message_reply_markup(bot, jio)
+    The ids of the shared messages are also returned. They are edited by the last
+    coroutines, in the same order.
+    """
+    jio = await db.get_jio(jio_id)
+    messages_to_edit = await db.get_msg_pages(jio_id)
+    main_page = jio.message_page or 0
+
+    shown = {page for _, page in messages_to_edit}
+    if include_main:
+        shown.add(main_page)
+    rendered = {page: await render_jio_page(jio, page) for page in shown}
+
+    markups = {}
+    edits = []
+    for message_id, shown_page in messages_to_edit:
+        text, page, pages = rendered[shown_page]
+        if shown_page not in markups:
+            markups[shown_page] = shared_message_reply_markup(bot, jio, page, pages)
+        edits.append(
+            update_shared_jio_message(bot, jio, message_id, text, markups[shown_page])
+        )
 
-    for message_id in messages_to_edit:
-        await update_shared_jio_message(bot, jio, message_id, text, reply_markup)
+    if include_main:
+        text, page, pages = rendered[main_page]
+        edits.insert(0, update_main_jio_message(bot, jio, text, page=page, pages=pages))
+    return edits, [message_id for message_id, _ in messages_to_edit]
+
+
+async def update_consolidated_orders(
+    bot: Bot, jio_id: int, include_main: bool = True
+) -> list:
+    """
+    Updates all messages that are used to consolidate supper orders,
+    ie the one in the host DM and the group shared messages
+
+    :param include_main: Whether to update the host's message, or only the shared ones.
+    :return: The results of the edits, see `gather_bounded`.
+    """
+    edits, message_ids = await consolidated_order_edits(bot, jio_id, include_main)
+    results = await gather_bounded(edits)
+    await record_shared_message_results(
+        message_ids, results[len(results) - len(message_ids) :]
+    )
+    return results
 
 
 #
@@ -201,15 +616,31 @@ def format_order_message(order: Order) -> str:
         "Your Orders:\n"
     )
 
-    message += "\n".join(order.food_list) if order.food_list else "None"
-
+    footer = ""
     if order.has_paid():
-        message += "\n\n💰 You have declared payment! 💰"
+        footer += "\n\n💰 You have declared payment! 💰"
 
     if jio.is_closed():
-        message += "\n\n🛑 Jio is closed! 🛑"
+        footer += "\n\n🛑 Jio is closed! 🛑"
+
+    if not order.items:
+        return message + "None" + footer
 
-    return message
+    # Leave out the last items if the message would be too long to send, keeping room
+    # to say how many were left out
+    length = message_length(message + footer) + PAGE_HEADER_LENGTH
+    items = []
+    for description in order.item_descriptions:
+        length += message_length(description) + 1
+        if length > MessageLimit.TEXT_LENGTH:
+            break
+        items.append(description)
+
+    message += "\n".join(items)
+    if len(items) < len(order.items):
+        message += f"\n... and {len(order.items) - len(items)} more"
+
+    return message + footer
 
 
 def order_message_keyboard_markup(order: Order) -> InlineKeyboardMarkup | None:
@@ -272,12 +703,12 @@ async def update_individual_order(bot: Bot, order: Order) -> None:
         text = format_order_message(order)
         markup = order_message_keyboard_markup(order)
 
-        await bot.edit_message_text(
+        await edit_if_changed(
+            bot,
             text,
+            markup,
             chat_id=order.user.chat_id,
             message_id=order.message_id,
-            parse_mode=ParseMode.HTML,
-            reply_markup=markup,
         )
     except BadRequest as e:
         logging.error(
@@ -285,17 +716,20 @@ async def update_individual_order(bot: Bot, order: Order) -> None:
         )
 
 
-async def update_individuals_order(bot: Bot, jio_id: int) -> None:
+async def individual_order_edits(bot: Bot, jio_id: int) -> list[Coroutine]:
     """
-    This coroutine updates all the individual message each user uses to add their
-    food orders.
+    Returns the coroutines editing the individual message each user uses to add their
+    food orders. See `update_individuals_order`.
     """
-    lst = db.get_list_all_orders(jio_id)
+    lst = await db.get_list_all_orders(jio_id)
+    return [update_individual_order(bot, order) for order in lst]
 
-    for order in lst:
-        await update_individual_order(bot, order)
 
+async def update_individuals_order(bot: Bot, jio_id: int) -> list:
+    """
+    This coroutine updates all the individual message each user uses to add their
+    food orders.
 
-async def update_all_jio_messages(bot: Bot, jio_id: int) -> None:
-    await update_consolidated_orders(bot, jio_id)
-    await update_individuals_order(bot, jio_id)
+    :return: The results of the edits, see `gather_bounded`.
+    """
+    return await gather_bounded(await individual_order_edits(bot, jio_id))
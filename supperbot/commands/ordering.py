@@ -12,10 +12,11 @@ from telegram.constants import ParseMode
 from telegram.ext import ConversationHandler, ContextTypes
 
 from supperbot.db import db
+from supperbot.outbox import REFRESH_DELAY
 from supperbot.enums import CallbackType, parse_callback_data, join
 
 from supperbot.commands.helper import (
-    update_consolidated_orders,
+    forget_message,
     format_order_message,
     order_message_keyboard_markup,
     update_individual_order,
@@ -36,14 +37,14 @@ async def interested_user(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     jio_id = int(context.args[0][5:])
 
     # Update user display name and chat id
-    db.upsert_user(
+    await db.upsert_user(
         update.effective_user.id,
         update.effective_user.first_name,
         update.effective_chat.id,
     )
 
     # Create an `Order` row for the user
-    db.create_order(jio_id=jio_id, user_id=update.effective_user.id)
+    await db.create_order(jio_id=jio_id, user_id=update.effective_user.id)
 
     await format_and_send_user_orders(
         update.effective_user.id, update.effective_chat.id, jio_id, context.bot
@@ -56,17 +57,17 @@ async def interested_owner(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     the owner of a jio wants to add in their own orders.
     """
     query = update.callback_query
-    jio_id = int(parse_callback_data(query.data)[1])
+    (jio_id,) = context.args
 
     # Update user display name and chat id
-    db.upsert_user(
+    await db.upsert_user(
         update.effective_user.id,
         update.effective_user.first_name,
         update.effective_chat.id,
     )
 
     # Create an `Order` row for the user
-    db.create_order(jio_id=jio_id, user_id=update.effective_user.id)
+    await db.create_order(jio_id=jio_id, user_id=update.effective_user.id)
 
     await format_and_send_user_orders(
         update.effective_user.id, update.effective_chat.id, jio_id, context.bot
@@ -83,7 +84,7 @@ async def format_and_send_user_orders(
     remove_reply_markup: bool = False,
 ):
     # TODO: check if order even exists
-    order = db.get_order(jio_id, user_id)
+    order = await db.get_order(jio_id, user_id)
 
     message = format_order_message(order)
     keyboard = order_message_keyboard_markup(order)
@@ -105,7 +106,7 @@ async def format_and_send_user_orders(
         reply_markup=keyboard,
         parse_mode=ParseMode.HTML,
     )
-    db.update_order_message_id(order.jio.id, order.user_id, msg.message_id)
+    await db.update_order_message_id(order.jio.id, order.user_id, msg.message_id)
 
 
 async def add_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -114,7 +115,7 @@ async def add_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     query = update.callback_query
     jio_id = int(parse_callback_data(query.data)[1])
-    jio = db.get_jio(jio_id)
+    jio = await db.get_jio(jio_id)
 
     if jio.is_closed():
         await query.answer("The jio is closed!")
@@ -128,7 +129,7 @@ async def add_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Get all favourite orders
     favourite_orders = list(
-        db.get_favourite_orders(update.effective_user.id, jio.restaurant)
+        await db.get_favourite_orders(update.effective_user.id, jio.restaurant)
     )
 
     markup = [["↩ Cancel"]]
@@ -153,8 +154,8 @@ async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     del context.user_data["current_order"]
 
     if food != "↩ Cancel":
-        db.add_food_order(jio_id, update.effective_user.id, food)
-        await update_consolidated_orders(context.bot, jio_id)
+        db.enqueue_refresh(jio_id, db.RefreshKind.CONSOLIDATED, REFRESH_DELAY)
+        await db.add_food_order(jio_id, update.effective_user.id, food)
 
     await format_and_send_user_orders(
         update.effective_user.id,
@@ -167,16 +168,16 @@ async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-async def delete_order(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+async def delete_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Callback for when the user wishes to delete one food order
     """
     query = update.callback_query
-    jio_id = int(parse_callback_data(query.data)[1])
+    (jio_id,) = context.args
     jio_str = str(jio_id)
 
     # Check if jio is closed
-    jio = db.get_jio(jio_id)
+    jio = await db.get_jio(jio_id)
 
     if jio.is_closed():
         await query.answer("The jio is closed!")
@@ -184,7 +185,7 @@ async def delete_order(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Obtain all user orders and display in a column
     text = "Please select which food order to delete:"
-    order = db.get_order(jio_id, update.effective_user.id)
+    order = await db.get_order(jio_id, update.effective_user.id)
 
     keyboard = InlineKeyboardMarkup.from_column(
         [
@@ -200,10 +201,11 @@ async def delete_order(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
                 food,
                 callback_data=join(CallbackType.DELETE_ORDER_ITEM, jio_str, str(idx)),
             )
-            for idx, food in enumerate(order.food_list)
+            for idx, food in enumerate(order.item_descriptions)
         ]
     )
 
+    forget_message(update.effective_message)
     await update.effective_message.edit_text(text, reply_markup=keyboard)
     await query.answer()
 
@@ -212,8 +214,8 @@ async def cancel_order_action(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     query = update.callback_query
-    jio_id = int(parse_callback_data(query.data)[1])
-    order = db.get_order(jio_id, update.effective_user.id)
+    (jio_id,) = context.args
+    order = await db.get_order(jio_id, update.effective_user.id)
 
     await update_individual_order(context.bot, order)
     await query.answer()
@@ -221,25 +223,33 @@ async def cancel_order_action(
 
 async def delete_order_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    _, jio_str, idx = parse_callback_data(query.data)
-    order = db.get_order(int(jio_str), update.effective_user.id)
+    jio_id, idx = context.args
+    order = await db.get_order(jio_id, update.effective_user.id)
 
     # TODO: Low priority: Check if jio is closed. Typically message should be overriden
     #       But it's possible that someone send the message elsewhere
 
-    db.delete_food_order(order, int(idx))
+    db.enqueue_refresh(jio_id, db.RefreshKind.CONSOLIDATED, REFRESH_DELAY)
+    await db.delete_food_order(order, idx)
 
     await update_individual_order(context.bot, order)
     await query.answer()
-    await update_consolidated_orders(context.bot, int(jio_str))
 
 
-async def add_favourite_item(update: Update, _):
+async def add_favourite_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    (jio_id,) = context.args
+    await show_favourite_item_menu(update, jio_id)
+
+
+async def show_favourite_item_menu(update: Update, jio_id: int) -> None:
+    """
+    Replaces the user's order message with a menu to toggle whether each of their
+    orders is a favourite item.
+    """
     query = update.callback_query
-    jio_str = parse_callback_data(query.data)[1]
-    jio_id = int(jio_str)
-    jio = db.get_jio(jio_id)
-    order = db.get_order(jio_id, update.effective_user.id)
+    jio_str = str(jio_id)
+    jio = await db.get_jio(jio_id)
+    order = await db.get_order(jio_id, update.effective_user.id)
 
     if not order.food_list:
         await update.effective_chat.send_message(
@@ -259,7 +269,7 @@ async def add_favourite_item(update: Update, _):
         "Orders which are already favourite'd are marked with a ⭐."
     )
 
-    favourites = db.get_favourite_orders(update.effective_user.id, jio.restaurant)
+    favourites = await db.get_favourite_orders(update.effective_user.id, jio.restaurant)
 
     markup = [
         InlineKeyboardButton(
@@ -275,7 +285,11 @@ async def add_favourite_item(update: Update, _):
                 callback_data=join(
                     CallbackType.REMOVE_FAVOURITE_ITEM,
                     jio_str,
-                    str(db.get_fav_id(update.effective_user.id, jio.restaurant, food)),
+                    str(
+                        await db.get_fav_id(
+                            update.effective_user.id, jio.restaurant, food
+                        )
+                    ),
                 ),
             )
 
@@ -283,10 +297,7 @@ async def add_favourite_item(update: Update, _):
             row = InlineKeyboardButton(
                 text=food,
                 callback_data=join(
-                    CallbackType.CONFIRM_FAVOURITE_ITEM,
-                    jio_str,
-                    jio.restaurant,
-                    str(idx),
+                    CallbackType.CONFIRM_FAVOURITE_ITEM, jio_str, str(idx)
                 ),
             )
 
@@ -295,34 +306,33 @@ async def add_favourite_item(update: Update, _):
     keyboard = InlineKeyboardMarkup.from_column(markup)
 
     await query.answer()
+    forget_message(update.effective_message)
     await update.effective_message.edit_text(text, reply_markup=keyboard)
 
 
-async def confirm_favourite_item(update: Update, _):
-    query = update.callback_query
-    _, jio_str, restaurant, idx_str = parse_callback_data(query.data)
-    idx = int(idx_str)
+async def confirm_favourite_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    jio_id, idx = context.args
 
-    # Get food name
-    jio_id = int(jio_str)
-    order = db.get_order(jio_id, update.effective_user.id)
+    # Get food name. The restaurant is not sent in the callback data, as restaurant
+    # names can be too long for it
+    order = await db.get_order(jio_id, update.effective_user.id)
     food = order.food_list[idx]
 
     # Update database
     # TODO: What if too many - need check
-    if not db.add_favourite_order(update.effective_user.id, restaurant, food):
+    restaurant = order.jio.restaurant
+    if not await db.add_favourite_order(update.effective_user.id, restaurant, food):
         await update.effective_chat.send_message(
             "You have too many favourite items for this restaurant. "
             "Please remove some by going to /start and viewing your favourite orders."
         )
         return
 
-    await add_favourite_item(update, _)
+    await show_favourite_item_menu(update, jio_id)
 
 
-async def delete_favourite_item(update: Update, _):
-    query = update.callback_query
-    fav_id = int(parse_callback_data(query.data)[2])
+async def delete_favourite_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    jio_id, fav_id = context.args
 
-    db.remove_favourite_order(fav_id, update.effective_user.id)
-    await add_favourite_item(update, _)
+    await db.remove_favourite_order(fav_id, update.effective_user.id)
+    await show_favourite_item_menu(update, jio_id)
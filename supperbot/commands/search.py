@@ -0,0 +1,154 @@
+"""Coroutines relating to searching past jios and orders."""
+from __future__ import annotations
+
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
+from telegram.constants import ParseMode
+from telegram.ext import ContextTypes
+
+from supperbot.db import db
+from supperbot.db.models import SupperJio
+from supperbot.db.search import query_words
+from supperbot.enums import CallbackType, join
+from supperbot.payloads import pack
+from supperbot.commands.creation import INLINE_CACHE_TIME, INLINE_PAGE_SIZE
+from supperbot.commands.helper import format_jio_message
+
+# Number of jios in each page of results of `/search`, and the number of characters
+# of the query shown with them
+SEARCH_PAGE_SIZE = 10
+MAX_QUERY_SHOWN = 64
+
+SEARCH_USAGE = (
+    "Search your jios by their restaurant, description or food items, eg\n"
+    "/search mcdonalds fries"
+)
+
+
+async def search_page(
+    user_id: int, query: str, page: int
+) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Returns the text and the keyboard of a page of the results of a search."""
+
+    # One more jio is loaded to know if there is a next page
+    jios = await db.search_jios(
+        user_id,
+        query,
+        limit=SEARCH_PAGE_SIZE + 1,
+        offset=page * SEARCH_PAGE_SIZE,
+    )
+
+    shown = (
+        query if len(query) <= MAX_QUERY_SHOWN else query[: MAX_QUERY_SHOWN - 1] + "…"
+    )
+    if not jios:
+        if page == 0:
+            return f'No jios found for "{shown}".\n\n' + SEARCH_USAGE, None
+        return f'No more jios found for "{shown}".', None
+
+    buttons = [
+        [
+            InlineKeyboardButton(
+                str(jio),
+                # Same as when viewing created and joined jios
+                callback_data=join(
+                    CallbackType.RESEND_MAIN_MESSAGE
+                    if jio.owner_id == user_id
+                    else CallbackType.OWNER_ADD_ORDER,
+                    str(jio.id),
+                ),
+            )
+        ]
+        for jio in jios[:SEARCH_PAGE_SIZE]
+    ]
+
+    # The query can be of any length, so it is packed into a token
+    navigation = []
+    if page > 0:
+        navigation.append(
+            InlineKeyboardButton(
+                "◀ Previous",
+                callback_data=join(
+                    CallbackType.SEARCH_JIOS, pack(query), str(page - 1)
+                ),
+            )
+        )
+    if len(jios) > SEARCH_PAGE_SIZE:
+        navigation.append(
+            InlineKeyboardButton(
+                "Next ▶",
+                callback_data=join(
+                    CallbackType.SEARCH_JIOS, pack(query), str(page + 1)
+                ),
+            )
+        )
+    if navigation:
+        buttons.append(navigation)
+
+    text = f'Jios found for "{shown}", best matches first (page {page + 1}):'
+    return text, InlineKeyboardMarkup(buttons)
+
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Searches the user's created and joined jios, eg "/search mcdonalds fries"."""
+
+    query = " ".join(context.args)
+    if not query_words(query):
+        await update.effective_chat.send_message(SEARCH_USAGE)
+        return
+
+    text, keyboard = await search_page(update.effective_user.id, query, 0)
+    await update.effective_chat.send_message(text, reply_markup=keyboard)
+
+
+async def view_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows another page of the results of a search, in place of the current one."""
+
+    query, page = context.args
+    text, keyboard = await search_page(update.effective_user.id, query, page)
+
+    await update.callback_query.answer()
+    await update.effective_message.edit_text(text, reply_markup=keyboard)
+
+
+async def _inline_search_result(jio: SupperJio) -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        id=f"search{jio.id}",
+        title=str(jio),
+        description=jio.description,
+        input_message_content=InputTextMessageContent(
+            await format_jio_message(jio), parse_mode=ParseMode.HTML
+        ),
+    )
+
+
+async def inline_search(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Searches the user's created and joined jios from inline mode. Choosing a result
+    sends the jio's message as it is now, which is not kept up to date.
+    """
+
+    inline_query = update.inline_query
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+
+    jios = await db.search_jios(
+        update.effective_user.id,
+        inline_query.query,
+        limit=INLINE_PAGE_SIZE + 1,
+        offset=offset,
+    )
+    results = [await _inline_search_result(jio) for jio in jios[:INLINE_PAGE_SIZE]]
+
+    await inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=True,
+        next_offset=(
+            str(offset + INLINE_PAGE_SIZE) if len(jios) > INLINE_PAGE_SIZE else ""
+        ),
+    )
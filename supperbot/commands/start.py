@@ -1,12 +1,30 @@
 """File containing the start and help commands for the bot"""
+from __future__ import annotations
+
 import logging
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Awaitable, Callable
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.constants import InlineKeyboardMarkupLimit, ParseMode
+from telegram.constants import ParseMode
 from telegram.error import BadRequest
+from telegram.ext import ContextTypes
 
 from supperbot.db import db
-from supperbot.enums import CallbackType, join, parse_callback_data
+from supperbot.db.models import SupperJio
+from supperbot.enums import CallbackType, join
+from supperbot.payloads import pack
+
+# Number of jios on each page when viewing created or joined jios
+JIO_PAGE_SIZE = 10
+
+# Directions of the pages of jios from the position they come with
+OLDER = "o"
+NEWER = "n"
+
+# Timestamps of jios are sent as the number of microseconds since this
+EPOCH = datetime(1970, 1, 1)
 
 
 async def help_command(update: Update, _) -> None:
@@ -48,47 +66,146 @@ async def start(update: Update, _) -> None:
     await update.effective_chat.send_message(text=message, reply_markup=reply_markup)
 
 
+def encode_jio_cursor(jio: SupperJio) -> str:
+    """Returns the position of the jio in a list of jios, as a callback argument."""
+    micros = (jio.timestamp - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}.{jio.id}"
+
+
+def jio_cursor(argument: str) -> tuple[datetime, int]:
+    """
+    Returns the `(timestamp, id)` of a jio from a position encoded with
+    `encode_jio_cursor`. Used as the type of an argument in `CallbackRouter.add_route`.
+    """
+    micros, jio_id = argument.split(".")
+    return EPOCH + timedelta(microseconds=int(micros)), int(jio_id)
+
+
+def page_direction(argument: str) -> bool:
+    """
+    Returns whether a page of jios lists older jios than the position it comes with.
+    Used as the type of an argument in `CallbackRouter.add_route`.
+    """
+    if argument not in (OLDER, NEWER):
+        raise ValueError(f"unknown direction {argument!r}")
+    return argument == OLDER
+
+
+async def jio_list_keyboard(
+    load: Callable[..., Awaitable[list[SupperJio]]],
+    page_type: CallbackType,
+    jio_type: CallbackType,
+    cursor: tuple[datetime, int] | None = None,
+    older: bool = True,
+) -> InlineKeyboardMarkup | None:
+    """
+    Returns the keyboard of a page of a list of jios, latest first, or `None` if there
+    are no jios at all.
+
+    :param load: Loads the jios, given the `limit`, `desc` and `after` arguments of
+        `db.get_user_jios`.
+    :param page_type: The callback type of the buttons moving between pages.
+    :param jio_type: The callback type of the buttons of the jios.
+    :param cursor: The position of the jio the page starts after, or `None` for the
+        first page.
+    :param older: Whether the page lists the jios older than `cursor`, or newer.
+    """
+    # One more jio is loaded to know if there is another page in the same direction
+    jios = await load(limit=JIO_PAGE_SIZE + 1, desc=older, after=cursor)
+    more = len(jios) > JIO_PAGE_SIZE
+    jios = jios[:JIO_PAGE_SIZE]
+
+    if not jios:
+        # The jios past the cursor were closed since the page before was shown
+        if cursor is not None:
+            return await jio_list_keyboard(load, page_type, jio_type)
+        return None
+
+    if not older:
+        jios.reverse()
+
+    # The jios on the other side of the cursor are those of the page which led here
+    if older:
+        has_newer, has_older = cursor is not None, more
+    else:
+        has_newer, has_older = more, cursor is not None
+
+    navigation = []
+    if has_newer:
+        navigation.append(
+            InlineKeyboardButton(
+                "◀ Newer",
+                callback_data=join(page_type, NEWER, encode_jio_cursor(jios[0])),
+            )
+        )
+    if has_older:
+        navigation.append(
+            InlineKeyboardButton(
+                "Older ▶",
+                callback_data=join(page_type, OLDER, encode_jio_cursor(jios[-1])),
+            )
+        )
+
+    keyboard = [
+        [InlineKeyboardButton("↩ Cancel", callback_data=CallbackType.CANCEL_VIEW)]
+    ]
+    keyboard += [
+        [InlineKeyboardButton(str(jio), callback_data=join(jio_type, str(jio.id)))]
+        for jio in jios
+    ]
+    if navigation:
+        keyboard.append(navigation)
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+def _created_jios(user_id: int) -> Callable[..., Awaitable[list[SupperJio]]]:
+    return partial(db.get_user_jios, user_id, allow_closed=True)
+
+
+def _joined_jios(user_id: int) -> Callable[..., Awaitable[list[SupperJio]]]:
+    return partial(db.get_joined_jios, user_id)
+
+
 async def view_created_jios(update: Update, _) -> None:
     """
     Allow the user to view the jios that they have created
     """
 
     query = update.callback_query
-
-    # TODO: Create a next page functionality for the buttons so that more can be viewed
-    # Telegram has a limitation on how many buttons there can be. Currently, it's 100.
-    # However, 100 buttons is still too many. Right now the limit is 50.
-    jios = db.get_user_jios(
-        update.effective_user.id,
-        limit=min(50, InlineKeyboardMarkupLimit.TOTAL_BUTTON_NUMBER - 1),
-        allow_closed=True,
+    keyboard = await jio_list_keyboard(
+        _created_jios(update.effective_user.id),
+        CallbackType.VIEW_CREATED_JIOS_PAGE,
+        CallbackType.RESEND_MAIN_MESSAGE,
     )
 
-    if not jios:
+    if keyboard is None:
         # User has not created any jios
         await update.effective_chat.send_message(text="You have not created any jios.")
         await query.answer()
         return
 
-    text = (
-        "Which of your jios do you want to view?\n"
-        "Only the most recent 50 jios can be viewed."
-    )
+    text = "Which of your jios do you want to view?"
+    await update.effective_chat.send_message(text, reply_markup=keyboard)
+    await query.answer()
 
-    keyboard = InlineKeyboardMarkup.from_column(
-        [InlineKeyboardButton("↩ Cancel", callback_data=CallbackType.CANCEL_VIEW)]
-        # Use a list comprehension to generate the rest of the buttons
-        + [
-            InlineKeyboardButton(
-                str(jio),
-                callback_data=join(CallbackType.RESEND_MAIN_MESSAGE, str(jio.id)),
-            )
-            for jio in jios
-        ]
+
+async def view_created_jios_page(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """Shows another page of the jios the user has created, in place of the current one."""
+
+    older, cursor = context.args
+    keyboard = await jio_list_keyboard(
+        _created_jios(update.effective_user.id),
+        CallbackType.VIEW_CREATED_JIOS_PAGE,
+        CallbackType.RESEND_MAIN_MESSAGE,
+        cursor,
+        older,
     )
 
-    await update.effective_chat.send_message(text, reply_markup=keyboard)
-    await query.answer()
+    await update.callback_query.answer()
+    await update.effective_message.edit_reply_markup(keyboard)
 
 
 async def cancel_view(update: Update, _) -> None:
@@ -104,47 +221,47 @@ async def cancel_view(update: Update, _) -> None:
 
 async def view_joined_jios(update: Update, _) -> None:
     """
-    Allow the user to view the jios that they have joined
+    Allow the user to view the open jios that they have joined
     """
 
     query = update.callback_query
 
-    # TODO: Create a next page functionality for the buttons so that more can be viewed
-    # Telegram has a limitation on how many buttons there can be. Currently, it's 100.
-    # However, 100 buttons is still too many. Right now the limit is 50.
     # TODO: Maybe consider only showing orders that the user has ordered something?
-    jios = db.get_joined_jios(
-        update.effective_user.id,
-        limit=min(50, InlineKeyboardMarkupLimit.TOTAL_BUTTON_NUMBER - 1),
+    # TODO: `OWNER_ADD_ORDER` is correct, the function is correct.
+    #       But name isn't nice, should refactor?
+    keyboard = await jio_list_keyboard(
+        _joined_jios(update.effective_user.id),
+        CallbackType.VIEW_JOINED_JIOS_PAGE,
+        CallbackType.OWNER_ADD_ORDER,
     )
 
-    if not jios:
-        # User has not created any jios
+    if keyboard is None:
+        # User has not joined any jios
         await update.effective_chat.send_message(text="You have not joined any jios.")
         await query.answer()
         return
 
-    text = (
-        "Which of the jios do you want to view?\n"
-        "Only the most recent 50 jios can be viewed."
-    )
+    text = "Which of the jios do you want to view?"
+    await update.effective_chat.send_message(text, reply_markup=keyboard)
+    await query.answer()
 
-    keyboard = InlineKeyboardMarkup.from_column(
-        [InlineKeyboardButton("↩ Cancel", callback_data=CallbackType.CANCEL_VIEW)]
-        # Use a list comprehension to generate the rest of the buttons
-        + [
-            InlineKeyboardButton(
-                str(jio),
-                # TODO: `OWNER_ADD_ORDER` is correct, the function is correct.
-                #       But name isn't nice, should refactor?
-                callback_data=join(CallbackType.OWNER_ADD_ORDER, str(jio.id)),
-            )
-            for jio in jios
-        ]
+
+async def view_joined_jios_page(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """Shows another page of the jios the user has joined, in place of the current one."""
+
+    older, cursor = context.args
+    keyboard = await jio_list_keyboard(
+        _joined_jios(update.effective_user.id),
+        CallbackType.VIEW_JOINED_JIOS_PAGE,
+        CallbackType.OWNER_ADD_ORDER,
+        cursor,
+        older,
     )
 
-    await update.effective_chat.send_message(text, reply_markup=keyboard)
-    await query.answer()
+    await update.callback_query.answer()
+    await update.effective_message.edit_reply_markup(keyboard)
 
 
 async def view_favourites(update: Update, _):
@@ -160,13 +277,13 @@ async def view_favourites(update: Update, _):
         await update.callback_query.answer()
 
     # Obtain all restaurants they have favourite items for
-    restaurants = db.get_favourite_restaurants(update.effective_user.id)
+    restaurants = await db.get_favourite_restaurants(update.effective_user.id)
 
     markup = [
         InlineKeyboardButton("↩ Cancel", callback_data=CallbackType.CANCEL_VIEW)
     ] + [
         InlineKeyboardButton(
-            r, callback_data=join(CallbackType.VIEW_FAVOURITE_ITEMS, r)
+            r, callback_data=join(CallbackType.VIEW_FAVOURITE_ITEMS, pack(r))
         )
         for r in restaurants
     ]
@@ -180,7 +297,14 @@ async def view_favourites(update: Update, _):
     await update.effective_chat.send_message(message, reply_markup=keyboard)
 
 
-async def view_restaurant_favourites(update: Update, _):
+async def view_restaurant_favourites(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+):
+    (restaurant,) = context.args
+    await show_restaurant_favourites(update, restaurant)
+
+
+async def show_restaurant_favourites(update: Update, restaurant: str) -> None:
     # try:
     #     await update.effective_message.edit_reply_markup(None)
     # except BadRequest as e:
@@ -191,8 +315,8 @@ async def view_restaurant_favourites(update: Update, _):
     await query.answer()
 
     # Obtain the favourite foods
-    restaurant = parse_callback_data(query.data)[1]
-    favourite = db.get_favourite_orders(update.effective_user.id, restaurant)
+    favourite = await db.get_favourite_orders(update.effective_user.id, restaurant)
+    restaurant_token = pack(restaurant)
 
     markup = [
         InlineKeyboardButton("↩ Cancel", callback_data=CallbackType.CANCEL_VIEW)
@@ -201,8 +325,8 @@ async def view_restaurant_favourites(update: Update, _):
             food,
             callback_data=join(
                 CallbackType.MAIN_MENU_REMOVE_FAV_ITEM,
-                restaurant,
-                str(db.get_fav_id(update.effective_user.id, restaurant, food)),
+                restaurant_token,
+                str(await db.get_fav_id(update.effective_user.id, restaurant, food)),
             ),
         )
         for food in favourite
@@ -217,7 +341,9 @@ async def view_restaurant_favourites(update: Update, _):
     await update.effective_message.edit_text(message, reply_markup=keyboard)
 
 
-async def main_menu_confirm_favourite_action(update: Update, _):
+async def main_menu_confirm_favourite_action(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+):
 
     # try:
     #     await update.effective_message.edit_reply_markup(None)
@@ -228,19 +354,22 @@ async def main_menu_confirm_favourite_action(update: Update, _):
     query = update.callback_query
     await query.answer()
 
-    _, restaurant, idx_str = parse_callback_data(query.data)
-    favourite_order = db.get_favourite(int(idx_str))
+    restaurant, fav_id = context.args
+    favourite_order = await db.get_favourite(fav_id)
+    restaurant_token = pack(restaurant)
 
     markup = [
         InlineKeyboardButton(
             "✅ Yes",
             callback_data=join(
-                CallbackType.MAIN_MENU_CONFIRM_DELETE_FAV_ITEM, restaurant, idx_str
+                CallbackType.MAIN_MENU_CONFIRM_DELETE_FAV_ITEM,
+                restaurant_token,
+                str(fav_id),
             ),
         ),
         InlineKeyboardButton(
             "❌ No",
-            callback_data=join(CallbackType.VIEW_FAVOURITE_ITEMS, restaurant),
+            callback_data=join(CallbackType.VIEW_FAVOURITE_ITEMS, restaurant_token),
         ),
     ]
     keyboard = InlineKeyboardMarkup.from_row(markup)
@@ -254,7 +383,9 @@ async def main_menu_confirm_favourite_action(update: Update, _):
     )
 
 
-async def main_menu_confirm_delete_fav_item(update: Update, _):
+async def main_menu_confirm_delete_fav_item(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+):
     # try:
     #     await update.effective_message.edit_reply_markup(None)
     # except BadRequest as e:
@@ -264,9 +395,9 @@ async def main_menu_confirm_delete_fav_item(update: Update, _):
     query = update.callback_query
     await query.answer()
 
-    _, restaurant, idx_str = parse_callback_data(query.data)
-    db.remove_favourite_order(int(idx_str), update.effective_user.id)
-    await view_restaurant_favourites(update, _)
+    restaurant, fav_id = context.args
+    await db.remove_favourite_order(fav_id, update.effective_user.id)
+    await show_restaurant_favourites(update, restaurant)
 
 
 async def nop(update: Update, _):
@@ -1,96 +1,382 @@
 from __future__ import annotations
 
-from sqlalchemy import select, update, and_, delete
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Iterable
+
+from sqlalchemy import (
+    select,
+    update,
+    and_,
+    bindparam,
+    case,
+    delete,
+    event,
+    func,
+    insert,
+    or_,
+    true,
+    tuple_,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session as SyncSession, joinedload
 
 from supperbot.db.models import (
     Stage,
     PaidStatus,
     SupperJio,
     Order,
+    OrderItem,
     User,
     Message,
     Session,
     FavouriteOrder,
+    FoodAlias,
+    FoodCount,
+    Lease,
+    OutboxEntry,
+    RefreshKind,
 )
+from supperbot.db import search
+
+
+# All queries go through an `AsyncSession`, so that handlers awaiting the database do
+# not block the event loop. Relationships are not lazy loaded under asyncio - queries
+# whose results are used to access `Order.user` or `Order.jio` must eagerly load them.
+# They are joined into the same query, so that rendering N orders does not cost N
+# extra queries.
+# Food items are written with bulk statements, so queries for orders refresh any
+# orders already loaded in the session (`populate_existing`).
+#
+# Each unit of work (typically one incoming update) gets its own short-lived session,
+# which is tracked through a context variable so that concurrently processed updates
+# never share a session or its identity map.
+_session: ContextVar[AsyncSession] = ContextVar("session")
+
+
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[AsyncSession]:
+    """
+    Opens a new session for the duration of the block. All functions in this module
+    called within the block will use this session.
+    """
+    async with Session() as session:
+        token = _session.set(session)
+        try:
+            yield session
+        finally:
+            _session.reset(token)
+
 
+def _get_session() -> AsyncSession:
+    try:
+        return _session.get()
+    except LookupError:
+        raise RuntimeError("Database accessed outside of a `session_scope`") from None
+
+
+#
+# Change tracking
+#
+# Every change to a jio made through this module gives the jio a new version. Changes
+# to an order also record the version at which that order last changed, so that jio
+# messages can be re-rendered incrementally (see `get_changed_orders`).
+#
+# Versions are kept in memory, so every change must go through this process - the bot
+# must only ever run as a single process (see `main.py`). Versions are drawn from one
+# counter for all jios, so a version is never given out twice, even after a jio stops
+# being tracked.
+#
+# Jios stop being tracked once they are closed, or once `MAX_TRACKED_JIOS` other jios
+# changed more recently. Untracked jios are all at the version at which the last of
+# them stopped being tracked, which is newer than any of their changes. The jios listed
+# for each host have a version too, which is tracked in the same way.
+#
+
+# Maximum number of jios whose changes are tracked, and of hosts whose listed jios are
+MAX_TRACKED_JIOS = 1024
+MAX_TRACKED_LISTS = 1024
+
+_last_version = 0
+
+# The version of the last jio which stopped being tracked
+_untracked_version = 0
+
+# The versions of the tracked jios, least recently changed first
+_jio_versions: OrderedDict[int, int] = OrderedDict()
+
+# The version of every untracked jio when each jio started being tracked again
+_tracked_since: dict[int, int] = {}
+
+# The versions of the jios listed for the tracked hosts (see `get_user_jios`), which
+# change whenever one of their jios is created or its status changes, least recently
+# changed first
+_jio_list_versions: OrderedDict[int, int] = OrderedDict()
+
+# The version at which each order of a tracked jio last changed, by user id, oldest
+# first
+_order_versions: dict[int, dict[int, int]] = {}
+
+
+def _mark_changed(jio_id: int, user_id: int | None = None) -> None:
+    global _last_version
+    _last_version += 1
+
+    if jio_id not in _jio_versions:
+        _tracked_since[jio_id] = _untracked_version
+    _jio_versions[jio_id] = _last_version
+    _jio_versions.move_to_end(jio_id)
+
+    if user_id is not None:
+        orders = _order_versions.setdefault(jio_id, {})
+        orders.pop(user_id, None)
+        orders[user_id] = _last_version
+
+    if len(_jio_versions) > MAX_TRACKED_JIOS:
+        _forget_changes(next(iter(_jio_versions)))
+
+
+def _forget_changes(jio_id: int) -> None:
+    # Stops tracking the jio, which is then at a version newer than all its changes
+    global _untracked_version
+    if _jio_versions.pop(jio_id, None) is not None:
+        _untracked_version = _last_version
+    _tracked_since.pop(jio_id, None)
+    _order_versions.pop(jio_id, None)
+
+
+def _mark_listing_changed(owner_id: int) -> None:
+    global _last_version, _untracked_version
+    _last_version += 1
+
+    _jio_list_versions[owner_id] = _last_version
+    _jio_list_versions.move_to_end(owner_id)
+
+    if len(_jio_list_versions) > MAX_TRACKED_LISTS:
+        _jio_list_versions.popitem(last=False)
+        _untracked_version = _last_version
+
+
+def get_jio_version(jio_id: int) -> int:
+    return _jio_versions.get(jio_id, _untracked_version)
+
+
+def get_jio_list_version(owner_id: int) -> int:
+    return _jio_list_versions.get(owner_id, _untracked_version)
+
+
+def get_changed_orders(jio_id: int, since: int) -> set[int] | None:
+    """
+    Returns the ids of the users whose order changed after version `since`, or `None`
+    if that is not known as the jio was not tracked since then.
+    """
+    if since < _tracked_since.get(jio_id, _untracked_version):
+        return None
+
+    changed = set()
+    for user_id, version in reversed(_order_versions.get(jio_id, {}).items()):
+        if version <= since:
+            break
+        changed.add(user_id)
+    return changed
 
-_session = Session()
 
 #
 # Supper Jio
 #
 
 
-def create_jio(owner_id: int, restaurant: str, description: str) -> SupperJio:
+async def create_jio(owner_id: int, restaurant: str, description: str) -> SupperJio:
+    session = _get_session()
     jio = SupperJio(owner_id, restaurant, description)
 
-    _session.add(jio)
-    _session.commit()
+    session.add(jio)
+    await session.commit()
+    _mark_listing_changed(owner_id)
     return jio
 
 
-def get_jio(jio_id: int) -> SupperJio:
+async def get_jio(jio_id: int) -> SupperJio:
+    session = _get_session()
     stmt = select(SupperJio).where(SupperJio.id == jio_id)
-    return _session.scalars(stmt).one()
+    return (await session.scalars(stmt)).one()
 
 
-def update_jio_message_id(jio_id: int, chat_id: int, message_id: int) -> None:
-    _session.execute(
+async def update_jio_message_id(jio_id: int, chat_id: int, message_id: int) -> None:
+    session = _get_session()
+    await session.execute(
         update(SupperJio)
         .where(SupperJio.id == jio_id)
-        .values(chat_id=chat_id, message_id=message_id)
+        .values(chat_id=chat_id, message_id=message_id, message_page=0)
+    )
+    await session.commit()
+
+
+async def update_jio_message_page(jio_id: int, page: int) -> None:
+    """Records the page of the jio shown by the host's message."""
+    session = _get_session()
+    await session.execute(
+        update(SupperJio).where(SupperJio.id == jio_id).values(message_page=page)
     )
-    _session.commit()
+    await session.commit()
 
 
-def update_jio_status(jio_id: int, status: Stage) -> None:
+async def update_jio_status(jio_id: int, status: Stage) -> None:
+    session = _get_session()
+    stmt = select(SupperJio.owner_id).where(SupperJio.id == jio_id)
+    owner_id = (await session.scalars(stmt)).one()
+
     stmt = update(SupperJio).where(SupperJio.id == jio_id).values(status=status)
-    _session.execute(stmt)
-    _session.commit()
+    await session.execute(stmt)
+    stmt = update(Order).where(Order.jio_id == jio_id).values(jio_status=status)
+    await session.execute(stmt)
+    await session.commit()
+    _mark_changed(jio_id)
+    _mark_listing_changed(owner_id)
+
+    # Closed jios rarely change, so their changes are no longer tracked
+    if status == Stage.CLOSED:
+        _forget_changes(jio_id)
 
 
-def delete_jio(jio: SupperJio):
+async def delete_jio(jio: SupperJio):
     raise NotImplementedError
 
 
-def get_user_jios(
+def _after_cursor(
+    stmt,
+    cursor: tuple[datetime, int] | None,
+    desc: bool,
+    columns: tuple = (SupperJio.timestamp, SupperJio.id),
+):
+    # Jios are ordered by `(timestamp, id)`, so that jios created at the same time still
+    # have a fixed order. Pages continue from the last jio of the previous page, which
+    # the indexes can seek to directly, instead of skipping over the jios before it.
+    # `columns` are the timestamp and id to order by, if not the jio's own
+    if cursor is not None:
+        key = tuple_(*columns)
+        stmt = stmt.where(key < tuple_(*cursor) if desc else key > tuple_(*cursor))
+
+    if desc:
+        return stmt.order_by(*(column.desc() for column in columns))
+    return stmt.order_by(*columns)
+
+
+async def get_user_jios(
     owner_id: int,
     *,
     limit: int | None = 10,
     allow_closed: bool = False,
     desc: bool = True,
+    after: tuple[datetime, int] | None = None,
 ) -> list[SupperJio]:
+    """
+    Returns the jios created by the user, latest first unless `desc` is `False`.
+
+    :param after: The `(timestamp, id)` of a jio, to only return the jios which come
+        after it in the order they are returned in.
+    """
+    session = _get_session()
     stmt = select(SupperJio).filter_by(owner_id=owner_id)
 
     if not allow_closed:
         stmt = stmt.where(SupperJio.status != Stage.CLOSED)
 
-    if desc:
-        stmt = stmt.order_by(SupperJio.timestamp.desc())
-    else:
-        stmt = stmt.order_by(SupperJio.timestamp)
+    stmt = _after_cursor(stmt, after, desc).limit(limit)
+    return (await session.scalars(stmt)).all()
+
 
-    if limit is None:
-        return _session.scalars(stmt).fetchall()
-    return _session.scalars(stmt).fetchmany(size=limit)
+async def get_joined_jios(
+    user_id: int,
+    *,
+    limit: int | None = 10,
+    desc: bool = True,
+    after: tuple[datetime, int] | None = None,
+) -> list[SupperJio]:
+    """
+    Returns the open jios which the user has an order in, latest first unless `desc`
+    is `False`.
 
+    The jios are looked up from the user's orders, which carry the status and
+    timestamp of their jio, so a page only reads the orders on it, however many jios
+    there are or the user has joined in the past.
 
-def get_joined_jios(user_id: int, *, limit: int | None = 10) -> list[SupperJio]:
+    :param after: The `(timestamp, id)` of a jio, to only return the jios which come
+        after it in the order they are returned in.
+    """
+    session = _get_session()
     stmt = (
         select(SupperJio)
-        .join(Order)
-        .filter_by(user_id=user_id)
-        .order_by(SupperJio.timestamp.desc())
+        .join(Order, Order.jio_id == SupperJio.id)
+        .where(Order.user_id == user_id, Order.jio_status == Stage.CREATED)
     )
 
-    if limit is None:
-        return _session.scalars(stmt).fetchall()
-    return _session.scalars(stmt).fetchmany(size=limit)
+    columns = Order.jio_timestamp, Order.jio_id
+    stmt = _after_cursor(stmt, after, desc, columns).limit(limit)
+    return (await session.scalars(stmt)).all()
+
+
+async def search_jios(
+    user_id: int, query: str, *, limit: int = 10, offset: int = 0
+) -> list[SupperJio]:
+    """
+    Returns the jios created or joined by the user which match every word of the query
+    in their restaurant, description or food items, best matches first. See
+    `supperbot.db.search`.
+    """
+    session = _get_session()
+    words = search.query_words(query)
+    if not words:
+        return []
+
+    if search.is_indexed():
+        stmt = (
+            select(SupperJio)
+            .join(search.jio_search, search.jio_search.c.rowid == SupperJio.id)
+            .where(
+                search.jio_search.c.jio_search.op("MATCH")(
+                    search.match_expression(user_id, words)
+                )
+            )
+            .order_by(search.jio_search.c.rank)
+        )
+    else:
+        joined = select(Order.jio_id).filter_by(user_id=user_id)
+        stmt = select(SupperJio).where(
+            or_(SupperJio.owner_id == user_id, SupperJio.id.in_(joined))
+        )
+        for word in words:
+            pattern = f"%{word}%"
+            food = (
+                select(OrderItem.id)
+                .where(OrderItem.jio_id == SupperJio.id, OrderItem.food.ilike(pattern))
+                .exists()
+            )
+            stmt = stmt.where(
+                or_(
+                    SupperJio.restaurant.ilike(pattern),
+                    SupperJio.description.ilike(pattern),
+                    food,
+                )
+            )
+        stmt = stmt.order_by(SupperJio.timestamp.desc())
+
+    stmt = stmt.limit(limit).offset(offset)
+    return (await session.scalars(stmt)).all()
 
 
-def edit_jio_description(jio: SupperJio, description: str) -> None:
+async def edit_jio_description(jio: SupperJio, description: str) -> None:
+    # The jio may have been loaded in an earlier session, so update it by id
+    session = _get_session()
+    await session.execute(
+        update(SupperJio).where(SupperJio.id == jio.id).values(description=description)
+    )
+    await session.commit()
     jio.description = description
-    _session.commit()
+    _mark_changed(jio.id)
 
 
 #
@@ -98,26 +384,36 @@ def edit_jio_description(jio: SupperJio, description: str) -> None:
 #
 
 
-def upsert_user(user_id: int, display_name: str, chat_id: int) -> User:
+async def upsert_user(user_id: int, display_name: str, chat_id: int) -> User:
+    session = _get_session()
     # Unfortunately, SQLAlchemy does not seem to support upserts directly.
     stmt = select(User).where(User.id == user_id)
-    user = _session.scalars(stmt).one_or_none()
+    user = (await session.scalars(stmt)).one_or_none()
 
+    renamed = False
     if user is None:
         user = User(id=user_id, display_name=display_name, chat_id=chat_id)
-        _session.add(user)
+        session.add(user)
     else:
+        renamed = user.display_name != display_name
         user.display_name = display_name
         user.chat_id = chat_id
 
-    _session.commit()
+    await session.commit()
+
+    if renamed:
+        # The user's name is shown in the messages of every jio they ordered in
+        stmt = select(Order.jio_id).filter_by(user_id=user_id)
+        for jio_id in (await session.scalars(stmt)).all():
+            _mark_changed(jio_id, user_id)
 
     return user
 
 
-def get_user_name(user_id: int) -> str:
+async def get_user_name(user_id: int) -> str:
+    session = _get_session()
     stmt = select(User.display_name).filter_by(id=user_id)
-    return _session.scalars(stmt).one()
+    return (await session.scalars(stmt)).one()
 
 
 #
@@ -125,79 +421,271 @@ def get_user_name(user_id: int) -> str:
 #
 
 
-def create_order(jio_id: int, user_id: int) -> Order:
+async def create_order(jio_id: int, user_id: int) -> Order:
+    session = _get_session()
     # Check if there exists an existing food order already
     stmt = select(Order).filter_by(jio_id=jio_id, user_id=user_id)
-    order = _session.scalars(stmt).one_or_none()
+    order = (await session.scalars(stmt)).one_or_none()
 
     # If there is no existing order for this jio_io and user, then create a new one
     if order is None:
-        order = Order(jio_id=jio_id, user_id=user_id, food="", paid=PaidStatus.NOT_PAID)
-        _session.add(order)
-        _session.commit()
+        stmt = select(SupperJio.status, SupperJio.timestamp).filter_by(id=jio_id)
+        status, timestamp = (await session.execute(stmt)).one()
+        order = Order(
+            jio_id=jio_id,
+            user_id=user_id,
+            paid=PaidStatus.NOT_PAID,
+            jio_status=status,
+            jio_timestamp=timestamp,
+        )
+        session.add(order)
+        await session.commit()
 
     return order
 
 
-def add_food_order(jio_id: int, user_id: int, food: str) -> Order:
+async def add_food_order(jio_id: int, user_id: int, food: str) -> None:
     """
     Adds one food order to the jio with id `jio_id` for user with id `user_id`.
 
-    The food orders are stored in a single row per user per jio, delimited by tabs.
+    Each distinct food is stored as one `OrderItem` row. Ordering the same food again
+    increments the quantity of the existing row instead.
     """
-    stmt = select(Order).filter_by(jio_id=jio_id, user_id=user_id)
-    order = _session.scalars(stmt).one()
+    session = _get_session()
+    result = await session.execute(
+        update(OrderItem)
+        .filter_by(jio_id=jio_id, user_id=user_id, food=food)
+        .values(quantity=OrderItem.quantity + 1)
+        .execution_options(synchronize_session=False)
+    )
 
-    # If there are existing food orders. Insert a tab to delimit the food orders.
-    if order.food:
-        order.food += "\t"
+    if result.rowcount == 0:
+        # New food item - append it after the user's existing items
+        next_position = (
+            select(func.coalesce(func.max(OrderItem.position) + 1, 0))
+            .filter_by(jio_id=jio_id, user_id=user_id)
+            .scalar_subquery()
+        )
+        await session.execute(
+            insert(OrderItem).values(
+                jio_id=jio_id,
+                user_id=user_id,
+                food=food,
+                quantity=1,
+                position=next_position,
+            )
+        )
+
+    await _add_food_count(jio_id, food, 1)
+    await session.commit()
+    _mark_changed(jio_id, user_id)
+
+
+async def delete_food_order(order: Order, food_idx: int) -> None:
+    """
+    Removes one of the food at index `food_idx` of the order. `order` is updated in
+    place to reflect the change.
+    """
+    session = _get_session()
+    item = order.items[food_idx]
 
-    order.food += food
-    _session.commit()
-    return order
+    if item.quantity > 1:
+        item.quantity -= 1
+    else:
+        order.items.remove(item)
 
+    await _add_food_count(order.jio_id, item.food, -1)
+    await session.commit()
+    _mark_changed(order.jio_id, order.user_id)
 
-def delete_food_order(order: Order, food_idx) -> None:
-    old = order.food_list
-    old.pop(food_idx)
-    order.food = "\t".join(old)
-    _session.commit()
 
+def food_count_key(food: str) -> str:
+    """
+    Returns the name which a food is counted under in `food_counts`. Computed in
+    Python, as SQL's `lower()` only lowercases ASCII on SQLite.
+    """
+    return food.lower()
 
-def update_order_message_id(jio_id: int, user_id: int, message_id: int) -> None:
+
+async def _add_food_count(jio_id: int, food: str, quantity: int) -> None:
+    # Changes the jio's count of the food, in the transaction changing its items, so
+    # that the counts never disagree with the items
+    session = _get_session()
+    food = food_count_key(food)
+
+    result = await session.execute(
+        update(FoodCount)
+        .filter_by(jio_id=jio_id, food=food)
+        .values(quantity=FoodCount.quantity + quantity)
+        .execution_options(synchronize_session=False)
+    )
+
+    if result.rowcount == 0:
+        if quantity > 0:
+            await session.execute(
+                insert(FoodCount).values(jio_id=jio_id, food=food, quantity=quantity)
+            )
+    elif quantity < 0:
+        # Foods no longer ordered are dropped, so the counts only hold ordered foods
+        await session.execute(
+            delete(FoodCount)
+            .filter_by(jio_id=jio_id, food=food)
+            .where(FoodCount.quantity <= 0)
+            .execution_options(synchronize_session=False)
+        )
+
+
+async def update_order_message_id(jio_id: int, user_id: int, message_id: int) -> None:
+    session = _get_session()
     stmt = select(Order).filter_by(jio_id=jio_id, user_id=user_id)
-    order = _session.scalars(stmt).one()
+    order = (await session.scalars(stmt)).one()
 
     order.message_id = message_id
-    _session.commit()
+    await session.commit()
+
+
+async def update_order_message_ids(jio_id: int, message_ids: dict[int, int]) -> None:
+    """
+    Sets the message id of the orders of many users in the jio at once.
+
+    :param message_ids: The new message id of each user's order, by user id.
+    """
+    if not message_ids:
+        return
+
+    session = _get_session()
+    stmt = (
+        update(Order)
+        .where(
+            and_(Order.jio_id == jio_id, Order.user_id == bindparam("order_user_id"))
+        )
+        .values(message_id=bindparam("order_message_id"))
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        stmt,
+        [
+            {"order_user_id": user_id, "order_message_id": message_id}
+            for user_id, message_id in message_ids.items()
+        ],
+    )
+    await session.commit()
 
 
-def get_list_complete_orders(jio_id: int) -> list[Order]:
+async def get_list_complete_orders(jio_id: int) -> list[Order]:
     """
     Returns a list of `Order` objects for the jio with `jio_id`, for users
     who have made at least one food order.
     """
-    stmt = select(Order).filter_by(jio_id=jio_id).where(Order.food != "")
-    return _session.scalars(stmt).fetchall()
+    session = _get_session()
+    stmt = (
+        select(Order)
+        .filter_by(jio_id=jio_id)
+        .where(Order.items.any())
+        .options(joinedload(Order.user))
+        .execution_options(populate_existing=True)
+    )
+    return (await session.scalars(stmt)).fetchall()
 
 
-def get_list_all_orders(jio_id: int) -> list[Order]:
-    stmt = select(Order).filter_by(jio_id=jio_id)
-    return _session.scalars(stmt).fetchall()
+async def get_jio_order_lines(
+    jio_id: int, user_ids: Iterable[int] | None = None
+) -> list[tuple[int, int, str, int, str, int]]:
+    """
+    Returns every food item ordered for the jio, as
+    `(item_id, user_id, display_name, paid, food, quantity)` rows, in the order they
+    were added.
 
+    This is the only query needed to render the orders of a jio.
 
-def get_order(jio_id: int, user_id: int) -> Order:
-    stmt = select(Order).filter_by(jio_id=jio_id, user_id=user_id)
-    return _session.scalars(stmt).one()
+    :param user_ids: If given, only the items of these users are returned.
+    """
+    session = _get_session()
+    stmt = (
+        select(
+            OrderItem.id,
+            Order.user_id,
+            User.display_name,
+            Order.paid,
+            OrderItem.food,
+            OrderItem.quantity,
+        )
+        .join(Order.user)
+        .join(Order.items)
+        .where(Order.jio_id == jio_id)
+        .order_by(OrderItem.id)
+    )
+
+    if user_ids is not None:
+        stmt = stmt.where(Order.user_id.in_(user_ids))
+
+    return (await session.execute(stmt)).all()
+
+
+async def get_list_all_orders(jio_id: int) -> list[Order]:
+    session = _get_session()
+    stmt = (
+        select(Order)
+        .filter_by(jio_id=jio_id)
+        .options(joinedload(Order.user), joinedload(Order.jio))
+        .execution_options(populate_existing=True)
+    )
+    return (await session.scalars(stmt)).fetchall()
 
 
-def update_order_payment(jio_id: int, user_id: int, status: PaidStatus):
-    _session.execute(
+async def get_unpaid_orders(jio_id: int) -> list[Order]:
+    """
+    Returns the orders of the jio which have not been paid for, together with their
+    users, in a single query.
+    """
+    session = _get_session()
+    stmt = (
+        select(Order)
+        .filter_by(jio_id=jio_id)
+        .where(Order.paid != PaidStatus.PAID)
+        .options(joinedload(Order.user), joinedload(Order.jio))
+        .execution_options(populate_existing=True)
+    )
+    return (await session.scalars(stmt)).fetchall()
+
+
+async def get_food_counts(jio_id: int) -> list[tuple[str, int]]:
+    """
+    Returns the total quantity of each food ordered for the jio, in the order they
+    were first added. Foods are compared case-insensitively, and returned in lowercase.
+
+    The totals are kept up to date as foods are added and removed, so this only reads
+    one row per distinct food, however many orders the jio has.
+    """
+    session = _get_session()
+    stmt = (
+        select(FoodCount.food, FoodCount.quantity)
+        .filter_by(jio_id=jio_id)
+        .order_by(FoodCount.id)
+    )
+    return (await session.execute(stmt)).all()
+
+
+async def get_order(jio_id: int, user_id: int) -> Order:
+    session = _get_session()
+    stmt = (
+        select(Order)
+        .filter_by(jio_id=jio_id, user_id=user_id)
+        .options(joinedload(Order.user), joinedload(Order.jio))
+        .execution_options(populate_existing=True)
+    )
+    return (await session.scalars(stmt)).one()
+
+
+async def update_order_payment(jio_id: int, user_id: int, status: PaidStatus):
+    session = _get_session()
+    await session.execute(
         update(Order)
         .where(and_(Order.jio_id == jio_id, Order.user_id == user_id))
         .values(paid=status)
     )
-    _session.commit()
+    await session.commit()
+    _mark_changed(jio_id, user_id)
 
 
 #
@@ -206,37 +694,41 @@ def update_order_payment(jio_id: int, user_id: int, status: PaidStatus):
 #
 
 
-def get_favourite_restaurants(user_id: int) -> set[str]:
+async def get_favourite_restaurants(user_id: int) -> set[str]:
     """
     Returns the list of restaurants for which the user has a favourite item.
     :param user_id:
     :return:
     """
+    session = _get_session()
     stmt = select(FavouriteOrder.restaurant).filter_by(user_id=user_id)
-    return set(_session.scalars(stmt).fetchall())
+    return set((await session.scalars(stmt)).fetchall())
 
 
-def get_favourite_orders(user_id: int, restaurant: str) -> set[str]:
+async def get_favourite_orders(user_id: int, restaurant: str) -> set[str]:
     """
     Returns the user's favourite orders for the restaurant.
     """
+    session = _get_session()
     stmt = select(FavouriteOrder.food).filter_by(user_id=user_id, restaurant=restaurant)
-    return set(_session.scalars(stmt).fetchall())
+    return set((await session.scalars(stmt)).fetchall())
 
 
-def get_fav_id(user_id: int, restaurant: str, food: str) -> int:
+async def get_fav_id(user_id: int, restaurant: str, food: str) -> int:
+    session = _get_session()
     stmt = select(FavouriteOrder.id).filter_by(
         user_id=user_id, restaurant=restaurant, food=food
     )
-    return _session.scalars(stmt).one()
+    return (await session.scalars(stmt)).one()
 
 
-def get_favourite(fav_id: int) -> FavouriteOrder:
+async def get_favourite(fav_id: int) -> FavouriteOrder:
+    session = _get_session()
     stmt = select(FavouriteOrder).filter_by(id=fav_id)
-    return _session.scalars(stmt).one()
+    return (await session.scalars(stmt)).one()
 
 
-def add_favourite_order(user_id: int, restaurant: str, food: str) -> bool:
+async def add_favourite_order(user_id: int, restaurant: str, food: str) -> bool:
     """
     Adds the user's favourite orders for a specified restaurant.
     Each user can only have up to 10 favourite orders per restaurant.
@@ -246,18 +738,19 @@ def add_favourite_order(user_id: int, restaurant: str, food: str) -> bool:
     :param food: The name of the favourite food.
     :return: A boolean indicating whether the upsert was successful.
     """
-    favourite = get_favourite_orders(user_id, restaurant)
+    session = _get_session()
+    favourite = await get_favourite_orders(user_id, restaurant)
     if len(favourite) >= 10:
         return False
 
     if food not in favourite:
-        _session.add(FavouriteOrder(user_id=user_id, restaurant=restaurant, food=food))
-        _session.commit()
+        session.add(FavouriteOrder(user_id=user_id, restaurant=restaurant, food=food))
+        await session.commit()
 
     return True
 
 
-def remove_favourite_order(fav_id: int, user_id: int) -> None:
+async def remove_favourite_order(fav_id: int, user_id: int) -> None:
     """
     Removes one favourite order from a user for a restaurant.
     User id is provided as a sanity check
@@ -265,23 +758,313 @@ def remove_favourite_order(fav_id: int, user_id: int) -> None:
     :param fav_id: The id of the favourite food
     :param user_id: The id of the user
     """
+    session = _get_session()
     stmt = delete(FavouriteOrder).filter_by(id=fav_id, user_id=user_id)
-    _session.execute(stmt)
-    _session.commit()
+    await session.execute(stmt)
+    await session.commit()
+
+
+#
+# Food aliases
+#
+
+
+async def get_food_aliases(restaurant: str) -> list[tuple[str, str]]:
+    """
+    Returns the aliases set for the restaurant, and the name each is for.
+
+    :param restaurant: The restaurant's name, normalized by `normalize_name`.
+    """
+    session = _get_session()
+    stmt = (
+        select(FoodAlias.alias, FoodAlias.name)
+        .filter_by(restaurant=restaurant)
+        .order_by(FoodAlias.alias)
+    )
+    return (await session.execute(stmt)).all()
+
+
+async def set_food_aliases(
+    restaurant: str, aliases: dict[str, str], removed: Iterable[str] = ()
+) -> None:
+    """
+    Sets aliases for the restaurant, replacing the ones already set for the same
+    aliases, and removes the `removed` aliases. All names are normalized by
+    `normalize_name`. `normalize.forget_aliases` must be called afterwards.
+    """
+    session = _get_session()
+    stmt = delete(FoodAlias).where(
+        FoodAlias.restaurant == restaurant,
+        FoodAlias.alias.in_([*aliases, *removed]),
+    )
+    await session.execute(stmt)
+
+    if aliases:
+        await session.execute(
+            insert(FoodAlias),
+            [
+                {"restaurant": restaurant, "alias": alias, "name": name}
+                for alias, name in aliases.items()
+            ],
+        )
+    await session.commit()
 
 
 #
 # Messages
 #
 
+# Number of failed edits in a row after which a shared message is tombstoned. Edits which
+# failed with a transient error, eg a timeout, are not counted
+MAX_MSG_FAILURES = 5
+
 
-def new_msg(jio_id: int, message_id: str) -> Message:
+async def new_msg(jio_id: int, message_id: str) -> Message:
+    session = _get_session()
     msg = Message(jio_id=jio_id, message_id=message_id)
-    _session.add(msg)
-    _session.commit()
+    session.add(msg)
+    await session.commit()
     return msg
 
 
-def get_msg_id(jio_id: int) -> list[str]:
-    stmt = select(Message.message_id).filter_by(jio_id=jio_id)
-    return _session.scalars(stmt).all()
+async def get_msg_id(jio_id: int) -> list[str]:
+    """Returns the ids of the jio's shared messages, except tombstoned ones."""
+    session = _get_session()
+    stmt = select(Message.message_id).filter_by(jio_id=jio_id, tombstoned_at=None)
+    return (await session.scalars(stmt)).all()
+
+
+async def get_msg_pages(jio_id: int) -> list[tuple[str, int]]:
+    """
+    Returns the ids of the jio's shared messages, except tombstoned ones, together with
+    the page of the jio each of them shows.
+    """
+    session = _get_session()
+    stmt = select(Message.message_id, Message.page).filter_by(
+        jio_id=jio_id, tombstoned_at=None
+    )
+    return (await session.execute(stmt)).all()
+
+
+async def update_msg_page(message_id: str, page: int) -> None:
+    """Records the page of the jio shown by a shared message."""
+    session = _get_session()
+    stmt = (
+        update(Message)
+        .filter_by(message_id=message_id)
+        .values(page=page)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(stmt)
+    await session.commit()
+
+
+async def record_msg_successes(message_ids: list[str]) -> None:
+    """Resets the failure count of messages which were edited successfully."""
+    session = _get_session()
+    stmt = (
+        update(Message)
+        .where(Message.message_id.in_(message_ids), Message.failure_count > 0)
+        .values(failure_count=0, last_error=None)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(stmt)
+    await session.commit()
+
+
+async def record_msg_failure(message_id: str, error: str, permanent: bool) -> None:
+    """
+    Records a failed edit of a message. The message is tombstoned if the failure is
+    permanent, or if it has failed `MAX_MSG_FAILURES` times in a row.
+
+    :param message_id: The inline message id of the message.
+    :param error: The class name of the error.
+    :param permanent: Whether the message can never be edited again.
+    """
+    session = _get_session()
+    if permanent:
+        tombstone = true()
+    else:
+        tombstone = Message.failure_count + 1 >= MAX_MSG_FAILURES
+    stmt = (
+        update(Message)
+        .filter_by(message_id=message_id, tombstoned_at=None)
+        .values(
+            failure_count=Message.failure_count + 1,
+            last_error=error,
+            tombstoned_at=case((tombstone, datetime.now()), else_=None),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(stmt)
+    await session.commit()
+
+
+async def delete_tombstoned_msgs(before: datetime) -> int:
+    """
+    Deletes messages tombstoned before the given time.
+
+    :return: The number of messages deleted.
+    """
+    session = _get_session()
+    stmt = delete(Message).where(Message.tombstoned_at < before)
+    result = await session.execute(stmt)
+    await session.commit()
+    return result.rowcount
+
+
+#
+# Outbox
+#
+
+# Called after a transaction which added outbox entries is committed
+_outbox_listeners: list[Callable[[], None]] = []
+
+
+def add_outbox_listener(callback: Callable[[], None]) -> None:
+    _outbox_listeners.append(callback)
+
+
+@event.listens_for(SyncSession, "after_commit")
+def _notify_outbox_listeners(session: SyncSession) -> None:
+    if session.info.pop("outbox", False):
+        for callback in _outbox_listeners:
+            callback()
+
+
+@event.listens_for(SyncSession, "after_rollback")
+def _discard_outbox_flag(session: SyncSession) -> None:
+    session.info.pop("outbox", None)
+
+
+def enqueue_refresh(jio_id: int, kind: RefreshKind, delay: float = 0) -> None:
+    """
+    Adds a refresh of the jio's messages to the outbox, to be made `delay` seconds
+    from now.
+
+    The entry is only written with the next commit of the session, so this should be
+    called right before the change which makes the refresh necessary. Both are then
+    committed in the same transaction.
+    """
+    session = _get_session()
+    session.add(
+        OutboxEntry(
+            jio_id=jio_id,
+            kind=kind,
+            attempts=0,
+            available_at=datetime.now() + timedelta(seconds=delay),
+        )
+    )
+    session.info["outbox"] = True
+
+
+async def get_next_outbox_time(after: datetime) -> datetime | None:
+    """Returns the earliest time after `after` an entry in the outbox is due at."""
+    session = _get_session()
+    stmt = select(func.min(OutboxEntry.available_at)).where(
+        OutboxEntry.available_at > after
+    )
+    return (await session.scalars(stmt)).one()
+
+
+async def get_due_outbox_entries(
+    limit: int, exclude: Iterable[tuple[int, RefreshKind]] = ()
+) -> list[OutboxEntry]:
+    """
+    Returns the outbox entries of up to `limit` refreshes which can be processed now,
+    together with any other entries for the same refreshes (including ones which are
+    not due yet), so that each refresh is only made once.
+
+    :param exclude: The `(jio_id, kind)` of refreshes to leave out, eg because they
+        are already being made.
+    """
+    session = _get_session()
+    due = (
+        select(OutboxEntry.jio_id, OutboxEntry.kind)
+        .where(OutboxEntry.available_at <= datetime.now())
+        .order_by(OutboxEntry.available_at)
+        .limit(limit)
+    )
+    exclude = list(exclude)
+    if exclude:
+        due = due.where(tuple_(OutboxEntry.jio_id, OutboxEntry.kind).notin_(exclude))
+    stmt = select(OutboxEntry).where(
+        tuple_(OutboxEntry.jio_id, OutboxEntry.kind).in_(due)
+    )
+    return (await session.scalars(stmt)).all()
+
+
+async def delete_outbox_entries(ids: list[int]) -> None:
+    session = _get_session()
+    stmt = delete(OutboxEntry).where(OutboxEntry.id.in_(ids))
+    await session.execute(stmt)
+    await session.commit()
+
+
+async def retry_outbox_entries(ids: list[int], available_at: datetime) -> None:
+    """Records a failed attempt at processing the entries, to be retried later."""
+    session = _get_session()
+    stmt = (
+        update(OutboxEntry)
+        .where(OutboxEntry.id.in_(ids))
+        .values(attempts=OutboxEntry.attempts + 1, available_at=available_at)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(stmt)
+    await session.commit()
+
+
+#
+# Leases
+#
+
+
+async def acquire_lease(
+    name: str, holder: str, ttl: timedelta, replace: str | None = None
+) -> bool:
+    """
+    Takes or renews the lease with the given name for `holder`, until `ttl` from now.
+
+    :param replace: Another holder whose lease is taken over even if it has not
+        expired, eg because that holder is known to have stopped.
+    :return: Whether `holder` holds the lease, which it does unless another holder's
+        lease has not expired yet.
+    """
+    session = _get_session()
+    now = datetime.now()
+
+    result = await session.execute(
+        update(Lease)
+        .where(
+            Lease.name == name,
+            or_(Lease.holder.in_([holder, replace or holder]), Lease.expires_at < now),
+        )
+        .values(holder=holder, expires_at=now + ttl)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        try:
+            await session.execute(
+                insert(Lease).values(name=name, holder=holder, expires_at=now + ttl)
+            )
+        except IntegrityError:
+            # Held by someone else
+            await session.rollback()
+            return False
+
+    await session.commit()
+    return True
+
+
+async def get_lease_holder(name: str) -> str | None:
+    """Returns the holder of the lease with the given name, even if it has expired."""
+    session = _get_session()
+    stmt = select(Lease.holder).filter_by(name=name)
+    return (await session.scalars(stmt)).one_or_none()
+
+
+async def release_lease(name: str, holder: str) -> None:
+    """Gives up the lease with the given name, if `holder` holds it."""
+    session = _get_session()
+    await session.execute(delete(Lease).filter_by(name=name, holder=holder))
+    await session.commit()
@@ -0,0 +1,198 @@
+"""Schema and data migrations for existing databases, run when the bot starts."""
+from __future__ import annotations
+
+import logging
+
+from sqlalchemy import DateTime, func, inspect, select, insert, text, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn
+
+from supperbot.db.db import food_count_key
+from supperbot.db.models import (
+    Base,
+    FoodCount,
+    Order,
+    OrderItem,
+    Session,
+    SupperJio,
+    engine,
+)
+
+
+async def upgrade_schema() -> None:
+    """
+    Brings the schema of a database created by an older version of the bot up to date
+    with the models. Every step checks the current schema first, so this is a no-op on
+    an up to date database.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(_upgrade_schema)
+
+
+def _upgrade_schema(conn: Connection) -> None:
+    inspector = inspect(conn)
+
+    # `supper_jios.timestamp` used to be a string column, holding `str(datetime)`.
+    # SQLite stores `DateTime` columns as strings in the same format, so only
+    # PostgreSQL needs the column to be converted.
+    if conn.dialect.name == "postgresql":
+        columns = {col["name"]: col for col in inspector.get_columns("supper_jios")}
+        if not isinstance(columns["timestamp"]["type"], DateTime):
+            logging.info("Converting supper_jios.timestamp to a timestamp column")
+            conn.execute(
+                text(
+                    "ALTER TABLE supper_jios ALTER COLUMN timestamp "
+                    "TYPE TIMESTAMP USING timestamp::timestamp"
+                )
+            )
+
+    # `create_all` does not add columns to existing tables. Added columns must be
+    # nullable or have a server default, so that existing rows are valid
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                logging.info(f"Adding column {table.name}.{column.name}")
+                spec = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {spec}"))
+
+    # `create_all` only creates indexes together with their table, so indexes added to
+    # existing tables have to be created here
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logging.info(f"Creating index {index.name}")
+                index.create(conn)
+
+
+async def backfill_order_items(batch_size: int = 500) -> int:
+    """
+    Moves food orders stored as tab separated strings in `Order.food` into
+    `order_items` rows.
+
+    Orders are migrated in batches, each in its own transaction. An order's `food` is
+    cleared in the same transaction that its items are inserted, so the migration only
+    ever touches unmigrated rows and can safely be interrupted and run again.
+
+    :param batch_size: The number of orders to migrate per transaction.
+    :return: The number of orders migrated.
+    """
+    migrated = 0
+
+    async with Session() as session:
+        while True:
+            stmt = (
+                select(Order.jio_id, Order.user_id, Order.food)
+                .where(Order.food != "")
+                .limit(batch_size)
+            )
+            rows = (await session.execute(stmt)).all()
+
+            if not rows:
+                break
+
+            for jio_id, user_id, food in rows:
+                # Repeated foods are merged into one item, at their first position
+                quantities = {}
+                for item in food.split("\t"):
+                    quantities[item] = quantities.get(item, 0) + 1
+
+                await session.execute(
+                    insert(OrderItem),
+                    [
+                        {
+                            "jio_id": jio_id,
+                            "user_id": user_id,
+                            "position": position,
+                            "food": item,
+                            "quantity": quantity,
+                        }
+                        for position, (item, quantity) in enumerate(quantities.items())
+                    ],
+                )
+                await session.execute(
+                    update(Order)
+                    .filter_by(jio_id=jio_id, user_id=user_id)
+                    .values(food="")
+                )
+
+            await session.commit()
+            migrated += len(rows)
+
+    if migrated:
+        logging.info(f"Migrated {migrated} orders to the order_items table")
+
+    return migrated
+
+
+async def backfill_food_counts() -> bool:
+    """
+    Fills in `food_counts` from the existing order items, for databases created before
+    the counts were kept. Must run after `backfill_order_items`.
+
+    Counts are kept up to date for every change to the items once they exist, so this
+    only does anything while `food_counts` is empty.
+
+    :return: Whether the counts were filled in.
+    """
+    async with Session() as session:
+        if (await session.scalars(select(FoodCount.id).limit(1))).first() is not None:
+            return False
+
+        # Grouped by the exact food first, and then by the key it is counted under,
+        # which `lower()` in SQL does not give for non-ASCII foods
+        stmt = (
+            select(OrderItem.jio_id, OrderItem.food, func.sum(OrderItem.quantity))
+            .group_by(OrderItem.jio_id, OrderItem.food)
+            .order_by(func.min(OrderItem.id))
+        )
+        counts: dict[tuple[int, str], int] = {}
+        for jio_id, food, quantity in await session.execute(stmt):
+            key = jio_id, food_count_key(food)
+            counts[key] = counts.get(key, 0) + quantity
+
+        if counts:
+            await session.execute(
+                insert(FoodCount),
+                [
+                    {"jio_id": jio_id, "food": food, "quantity": quantity}
+                    for (jio_id, food), quantity in counts.items()
+                ],
+            )
+        await session.commit()
+
+    if counts:
+        logging.info(f"Counted {len(counts)} foods ordered for existing jios")
+
+    return True
+
+
+async def backfill_order_jios() -> int:
+    """
+    Copies the status and timestamp of each order's jio into the order, for orders
+    made before they were kept there. See `Order.jio_status`.
+
+    :return: The number of orders filled in.
+    """
+    async with Session() as session:
+        stmt = (
+            update(Order)
+            .where(Order.jio_status.is_(None))
+            .values(
+                jio_status=select(SupperJio.status)
+                .where(SupperJio.id == Order.jio_id)
+                .scalar_subquery(),
+                jio_timestamp=select(SupperJio.timestamp)
+                .where(SupperJio.id == Order.jio_id)
+                .scalar_subquery(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        filled = (await session.execute(stmt)).rowcount
+        await session.commit()
+
+    if filled:
+        logging.info(f"Copied the jio status and timestamp into {filled} orders")
+
+    return filled
@@ -2,21 +2,26 @@ from __future__ import annotations
 
 from datetime import datetime
 from enum import IntEnum
+import os
 
 from sqlalchemy import (
     Column as Col,
     ForeignKey,
+    ForeignKeyConstraint,
     BigInteger,
+    DateTime,
+    Index,
     Integer,
     String,
-    create_engine,
     PrimaryKeyConstraint,
+    Text,
 )
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 
 
-# TODO: Make this configurable
-engine = create_engine("sqlite:///database.db", future=True, echo=False)
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///database.db")
+engine = create_async_engine(DATABASE_URL, future=True, echo=False)
 
 
 Base = declarative_base()
@@ -32,6 +37,17 @@ class PaidStatus(IntEnum):
     PAID = 1
 
 
+class RefreshKind(IntEnum):
+    """The messages of a jio which an `OutboxEntry` refreshes."""
+
+    # The host's jio message and the shared messages
+    CONSOLIDATED = 0
+    # Every user's individual order message
+    INDIVIDUALS = 1
+    # Only the shared messages, for when the host's jio message was already edited
+    SHARED = 2
+
+
 def Column(*args, **kwargs):
     """A helper function to make `sqlalchemy.Column` nullable `False` by default."""
     kwargs["nullable"] = kwargs.get("nullable", False)
@@ -60,21 +76,28 @@ class SupperJio(Base):
     status = Column(Integer)
     chat_id = Column(BigInteger, nullable=True)
     message_id = Column(Integer, unique=True, nullable=True)
-    timestamp = Column(String)
+    timestamp = Column(DateTime)
+    # The page of the jio shown by the host's message, which it stays on when refreshed
+    message_page = Column(Integer, default=0, server_default="0")
+
+    __table_args__ = (
+        Index("ix_supper_jios_owner_timestamp", "owner_id", "timestamp"),
+        Index("ix_supper_jios_status_timestamp", "status", "timestamp"),
+    )
 
     def __init__(self, owner_id: int, restaurant: str, description: str):
         self.owner_id = owner_id
         self.restaurant = restaurant
         self.description = description
         self.status = Stage.CREATED
-        self.timestamp = str(datetime.now())
+        self.timestamp = datetime.now()
 
     def is_closed(self):
         return self.status != Stage.CREATED
 
     def __repr__(self):
         closed = "Closed, " if self.status == Stage.CLOSED else ""
-        return f"Order {self.id}: {self.restaurant} ({closed + self.timestamp[:10]})"
+        return f"Order {self.id}: {self.restaurant} ({closed}{self.timestamp:%Y-%m-%d})"
 
 
 class Message(Base):
@@ -83,8 +106,18 @@ class Message(Base):
     __tablename__ = "shared_messages"
 
     id = Column(Integer, primary_key=True)
-    jio_id = Column(Integer, ForeignKey("supper_jios.id"))
+    jio_id = Column(Integer, ForeignKey("supper_jios.id"), index=True)
     message_id = Column(String, unique=True)
+    # The page of the jio shown by the message, which it stays on when refreshed
+    page = Column(Integer, default=0, server_default="0")
+
+    # Failed edits since the last successful one, and the class of the last error
+    failure_count = Column(Integer, default=0, server_default="0")
+    last_error = Column(String, nullable=True)
+
+    # Set once the message can no longer be edited. Tombstoned messages are not
+    # edited anymore, and are deleted by `db.delete_tombstoned_msgs`
+    tombstoned_at = Column(DateTime, nullable=True, index=True)
 
     jio = relationship("SupperJio", backref="messages")
 
@@ -92,6 +125,60 @@ class Message(Base):
         return f"SharedMessage({self.jio_id=}, {self.message_id=})"
 
 
+def format_food(food: str, quantity: int) -> str:
+    """Formats a food item and its quantity for display."""
+    return food if quantity == 1 else f"{food} (x{quantity})"
+
+
+class OrderItem(Base):
+    """Represents one food item in an order"""
+
+    __tablename__ = "order_items"
+
+    id = Column(Integer, primary_key=True)
+    jio_id = Column(Integer)
+    user_id = Column(BigInteger)
+    position = Column(Integer)
+    food = Column(String)
+    quantity = Column(Integer, default=1)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["jio_id", "user_id"], ["orders.jio_id", "orders.user_id"]
+        ),
+        Index("ix_order_items_order", "jio_id", "user_id", "position"),
+    )
+
+    order = relationship("Order", back_populates="items")
+
+    @property
+    def description(self) -> str:
+        return format_food(self.food, self.quantity)
+
+    def __repr__(self):
+        return f"OrderItem({self.jio_id=}, {self.user_id=}, {self.food=})"
+
+
+class FoodCount(Base):
+    """
+    The total quantity of a food ordered for a jio, over all of its orders. Kept up to
+    date in the same transaction as the order items, see `db.add_food_order`.
+    """
+
+    __tablename__ = "food_counts"
+
+    id = Column(Integer, primary_key=True)
+    jio_id = Column(Integer, ForeignKey("supper_jios.id"))
+    # Lowercase, so that foods are counted case-insensitively
+    food = Column(String)
+    quantity = Column(Integer)
+
+    __table_args__ = (Index("ix_food_counts_jio", "jio_id", "food", unique=True),)
+
+    def __repr__(self):
+        return f"FoodCount({self.jio_id=}, {self.food=}, {self.quantity=})"
+
+
 class Order(Base):
     """Represents an order made by a user"""
 
@@ -99,24 +186,47 @@ class Order(Base):
 
     jio_id = Column(Integer, ForeignKey("supper_jios.id"))
     user_id = Column(BigInteger, ForeignKey("users.id"))
-    food = Column(String)  # Tab separated
+    # Tab separated. Superseded by `order_items`; only read when migrating old rows
+    food = Column(String, default="")
     paid = Column(Integer)
     message_id = Column(Integer, unique=True, nullable=True)
-
-    __table_args__ = (PrimaryKeyConstraint("jio_id", "user_id"),)
+    # Copies of the jio's status and timestamp, so that the jios a user has joined can
+    # be paged through from their orders alone. Kept in sync by `db.update_jio_status`
+    jio_status = Column(Integer, nullable=True)
+    jio_timestamp = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("jio_id", "user_id"),
+        Index("ix_orders_user", "user_id", "jio_id"),
+        Index(
+            "ix_orders_user_jios", "user_id", "jio_status", "jio_timestamp", "jio_id"
+        ),
+    )
 
     user = relationship("User", backref="orders")
     jio = relationship("SupperJio", backref="orders")
+    # Always loaded together with the order, as the items are needed to render it
+    items = relationship(
+        "OrderItem",
+        back_populates="order",
+        order_by=OrderItem.position,
+        lazy="selectin",
+        cascade="all, delete-orphan",
+    )
 
     def has_paid(self):
         return self.paid == PaidStatus.PAID
 
     @property
     def food_list(self) -> list[str]:
-        return self.food.split("\t") if self.food else []
+        return [item.food for item in self.items]
+
+    @property
+    def item_descriptions(self) -> list[str]:
+        return [item.description for item in self.items]
 
     def __repr__(self):
-        return f"Order {self.jio_id}: ({self.user_id=}) {self.food}"
+        return f"Order {self.jio_id}: ({self.user_id=}) {self.food_list}"
 
 
 class FavouriteOrder(Base):
@@ -129,6 +239,10 @@ class FavouriteOrder(Base):
     restaurant = Column(String(32))
     food = Column(String)
 
+    __table_args__ = (
+        Index("ix_favourite_orders_user", "user_id", "restaurant", "food"),
+    )
+
     user = relationship("User", backref="favourite_orders")
 
     def __repr__(self):
@@ -138,5 +252,105 @@ class FavouriteOrder(Base):
         )
 
 
-Base.metadata.create_all(engine)
-Session = sessionmaker(engine)
+class FoodAlias(Base):
+    """
+    Another name for a food at a restaurant, which hosts can set so that orders using
+    either name are counted together. See `supperbot.normalize`.
+    """
+
+    __tablename__ = "food_aliases"
+
+    id = Column(Integer, primary_key=True)
+    # The restaurant, alias and name are stored normalized, see `normalize_name`
+    restaurant = Column(String(32))
+    alias = Column(String)
+    name = Column(String)
+
+    __table_args__ = (
+        Index("ix_food_aliases_restaurant", "restaurant", "alias", unique=True),
+    )
+
+    def __repr__(self):
+        return f"FoodAlias({self.restaurant=}, {self.alias=}, {self.name=})"
+
+
+class OutboxEntry(Base):
+    """
+    A pending refresh of a jio's messages, added in the same transaction as the change
+    which made it necessary. See `supperbot.outbox`.
+    """
+
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True)
+    jio_id = Column(Integer)
+    kind = Column(Integer)
+    attempts = Column(Integer, default=0)
+    available_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_outbox_available_at", "available_at"),
+        Index("ix_outbox_target", "jio_id", "kind"),
+    )
+
+    def __repr__(self):
+        return f"OutboxEntry({self.jio_id=}, {self.kind=}, {self.attempts=})"
+
+
+class UserData(Base):
+    """The `user_data` of a user, as JSON. See `supperbot.persistence`."""
+
+    __tablename__ = "user_data"
+
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    data = Column(Text)
+
+    def __repr__(self):
+        return f"UserData({self.user_id=})"
+
+
+class ConversationState(Base):
+    """
+    The state of an ongoing conversation of a `ConversationHandler`.
+    See `supperbot.persistence`.
+    """
+
+    __tablename__ = "conversation_states"
+
+    name = Column(String(32))
+    # The key of the conversation, as JSON
+    key = Column(String(64))
+    state = Column(String)
+
+    __table_args__ = (PrimaryKeyConstraint("name", "key"),)
+
+    def __repr__(self):
+        return f"ConversationState({self.name=}, {self.key=}, {self.state=})"
+
+
+# Objects are not expired on commit, as refreshing expired attributes would require
+# implicit IO, which is not possible with an `AsyncSession`.
+Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def create_tables() -> None:
+    """Creates any missing tables. Should be awaited once before the bot starts."""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+class Lease(Base):
+    """
+    A lease on running the bot, which only one process can hold at a time.
+    See `SupperApplication.hold_lease`.
+    """
+
+    __tablename__ = "leases"
+
+    name = Column(String(32), primary_key=True)
+    # Identifies the process holding the lease, eg "hostname:pid"
+    holder = Column(String(64))
+    expires_at = Column(DateTime)
+
+    def __repr__(self):
+        return f"Lease({self.name=}, {self.holder=}, {self.expires_at=})"
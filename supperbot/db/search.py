@@ -0,0 +1,139 @@
+"""
+The full-text search index over jios and their orders.
+
+On SQLite, every jio has a row in the FTS5 table `jio_search`, holding its restaurant,
+description and food items, which is kept up to date by triggers on `supper_jios`,
+`order_items` and `orders`. The row also holds a "u<user id>" token for the host and
+every user with an order in the jio, in the `members` column, so that the index itself
+limits a search to the jios of the user searching, however many jios there are.
+
+Other databases have no index, and are searched with `ILIKE` instead, see
+`db.search_jios`.
+"""
+from __future__ import annotations
+
+import logging
+import re
+
+from sqlalchemy import column, table
+from sqlalchemy.engine import Connection
+
+from supperbot.db.models import engine
+
+# Maximum number of words in a search which are looked up
+MAX_QUERY_WORDS = 8
+
+jio_search = table("jio_search", column("rowid"), column("rank"), column("jio_search"))
+
+# The food items and members of the jio with the given id, as stored in `jio_search`.
+# The owner is looked up through an alias, as `{jio_id}` may refer to `supper_jios`
+_FOODS = (
+    "(SELECT coalesce(group_concat(food, ' '), '') "
+    "FROM order_items WHERE jio_id = {jio_id})"
+)
+_ORDER_MEMBERS = (
+    "(SELECT coalesce(group_concat(' u' || user_id, ''), '') "
+    "FROM orders WHERE jio_id = {jio_id})"
+)
+_MEMBERS = (
+    "('u' || (SELECT owner_id FROM supper_jios AS jio WHERE jio.id = {jio_id}) || "
+    + _ORDER_MEMBERS
+    + ")"
+)
+
+# Results are ranked by BM25, with matches in the restaurant weighted the most. The
+# members column only filters results, so it does not count towards the rank
+_CREATE_TABLE = [
+    "CREATE VIRTUAL TABLE jio_search USING fts5("
+    "restaurant, description, foods, members, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    "INSERT INTO jio_search(jio_search, rank) VALUES "
+    "('rank', 'bm25(10.0, 2.0, 5.0, 0.0)')",
+    "INSERT INTO jio_search(rowid, restaurant, description, foods, members) "
+    f"SELECT id, restaurant, description, {_FOODS.format(jio_id='supper_jios.id')}, "
+    f"'u' || owner_id || {_ORDER_MEMBERS.format(jio_id='supper_jios.id')} "
+    "FROM supper_jios",
+]
+
+_CREATE_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS jio_search_jio_insert AFTER INSERT ON supper_jios "
+    "BEGIN "
+    "INSERT INTO jio_search(rowid, restaurant, description, foods, members) "
+    "VALUES (new.id, new.restaurant, new.description, '', 'u' || new.owner_id); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS jio_search_jio_update "
+    "AFTER UPDATE OF restaurant, description ON supper_jios "
+    "BEGIN "
+    "UPDATE jio_search SET restaurant = new.restaurant, description = new.description "
+    "WHERE rowid = new.id; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS jio_search_jio_delete AFTER DELETE ON supper_jios "
+    "BEGIN DELETE FROM jio_search WHERE rowid = old.id; END",
+]
+
+
+def _refresh_trigger(name: str, event: str, table_name: str, column_name: str) -> str:
+    # Recomputes the column of the row of the jio which the changed row belongs to
+    row = "old" if event == "DELETE" else "new"
+    value = (_FOODS if column_name == "foods" else _MEMBERS).format(
+        jio_id=f"{row}.jio_id"
+    )
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table_name} "
+        f"BEGIN UPDATE jio_search SET {column_name} = {value} "
+        f"WHERE rowid = {row}.jio_id; END"
+    )
+
+
+_CREATE_TRIGGERS += [
+    _refresh_trigger("jio_search_item_insert", "INSERT", "order_items", "foods"),
+    _refresh_trigger(
+        "jio_search_item_update", "UPDATE OF food", "order_items", "foods"
+    ),
+    _refresh_trigger("jio_search_item_delete", "DELETE", "order_items", "foods"),
+    _refresh_trigger("jio_search_order_insert", "INSERT", "orders", "members"),
+    _refresh_trigger("jio_search_order_delete", "DELETE", "orders", "members"),
+]
+
+
+def is_indexed() -> bool:
+    """Whether the database has a full-text search index."""
+    return engine.dialect.name == "sqlite"
+
+
+async def create_search_index() -> None:
+    """
+    Creates the search index and the triggers keeping it up to date, if they do not
+    exist yet. Jios created before the index are added to it when it is created.
+    """
+    if is_indexed():
+        async with engine.begin() as conn:
+            await conn.run_sync(_create_search_index)
+
+
+def _create_search_index(conn: Connection) -> None:
+    exists = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'jio_search'"
+    ).first()
+
+    if not exists:
+        logging.info("Creating the search index")
+        for statement in _CREATE_TABLE:
+            conn.exec_driver_sql(statement)
+
+    for statement in _CREATE_TRIGGERS:
+        conn.exec_driver_sql(statement)
+
+
+def query_words(query: str) -> list[str]:
+    """Returns the words of a search which are looked up."""
+    return re.findall(r"[^\W_]+", query)[:MAX_QUERY_WORDS]
+
+
+def match_expression(user_id: int, words: list[str]) -> str:
+    """
+    Returns the FTS5 query matching the user's jios which contain every word, or a
+    word starting with it, in their restaurant, description or food items.
+    """
+    terms = " ".join(f'"{word}"*' for word in words)
+    return f'members : "u{user_id}" AND {{restaurant description foods}} : ({terms})'
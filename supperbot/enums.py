@@ -28,10 +28,17 @@ class CallbackType(str, Enum):
 
     VIEW_CREATED_JIOS = "030"
     CANCEL_VIEW = "031"
+    # The direction is "o" for older jios or "n" for newer ones, and the position is
+    # the jio's timestamp in microseconds and its id - see `commands.start.jio_cursor`
+    VIEW_CREATED_JIOS_PAGE = "032"  # 032:direction:timestamp.jio_id
     VIEW_JOINED_JIOS = "035"
+    VIEW_JOINED_JIOS_PAGE = "037"  # 037:direction:timestamp.jio_id
+    # The query is packed into a token, see `supperbot.payloads`
+    SEARCH_JIOS = "036"  # 036:query:page
 
     RESEND_MAIN_MESSAGE = "040"
     OWNER_ADD_ORDER = "041"
+    VIEW_JIO_PAGE = "042"  # Format - 042:jio_id:page
 
     # Modifying of Orders - starts with 1
     ADD_ORDER = "100"
@@ -50,6 +57,9 @@ class CallbackType(str, Enum):
 
     CREATE_ORDERING_LIST = "210"
     BACK = "211"
+    EDIT_FOOD_ALIASES = "212"
+    CANCEL_EDIT_FOOD_ALIASES = "213"
+    FINISH_EDIT_FOOD_ALIASES = "214"
 
     PING_ALL_UNPAID = "220"
 
@@ -60,11 +70,12 @@ class CallbackType(str, Enum):
 
     # Favourite Order System - starts with 4
     FAVOURITE_ITEM = "400"
-    CONFIRM_FAVOURITE_ITEM = "401"  # Format - 141:jio_id:restaurant:idx
-    REMOVE_FAVOURITE_ITEM = "402"  # Format - 142:jio_id:favourite_item_idx
+    CONFIRM_FAVOURITE_ITEM = "401"  # Format - 401:jio_id:idx
+    REMOVE_FAVOURITE_ITEM = "402"  # Format - 402:jio_id:favourite_item_idx
 
     MAIN_MENU_FAVOURITES = "410"
-    VIEW_FAVOURITE_ITEMS = "411"
+    # The restaurant is packed into a token, see `supperbot.payloads`
+    VIEW_FAVOURITE_ITEMS = "411"  # 411:restaurant
     MAIN_MENU_REMOVE_FAV_ITEM = "412"  # 412:restaurant:favourite_item_idx
     MAIN_MENU_CONFIRM_DELETE_FAV_ITEM = "413"  # 413:restaurant:favourite_item_idx
 
@@ -75,6 +86,11 @@ def regex_pattern(callback_data: str) -> str:
     return "^" + callback_data + "$"
 
 
+def prefix_pattern(callback_type: CallbackType) -> str:
+    """Returns a regex matching callback data of the given type, with any arguments."""
+    return "^" + callback_type + "(:|$)"
+
+
 def join(*args: str) -> str:
     return ":".join(args)
 
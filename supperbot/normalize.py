@@ -0,0 +1,178 @@
+"""
+Normalization of food names, so that the same food written in different ways is
+counted together in the ordering list, eg "M Fries", "medium fries" and "fries (med)".
+
+A food name is split into lowercase words, or tokens, and every run of tokens which is
+an alias of another name is replaced by that name, eg "m" by "medium". Foods whose
+normalized tokens are the same, in any order, are counted as one.
+
+Every restaurant has its own aliases, which hosts can edit (see `db.set_food_aliases`),
+on top of `DEFAULT_ALIASES`. The aliases of a restaurant are compiled into an
+`AliasIndex`, a trie over tokens, which is kept in memory and reused by every jio for
+the restaurant, along with the normalized form of every distinct food name it has seen.
+"""
+from __future__ import annotations
+
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import Iterable
+
+from supperbot.db import db
+
+# Aliases for every restaurant, unless the restaurant's own aliases replace them
+DEFAULT_ALIASES = {
+    "s": "small",
+    "sm": "small",
+    "m": "medium",
+    "med": "medium",
+    "l": "large",
+    "lg": "large",
+    "reg": "regular",
+}
+
+# Maximum number of restaurants whose index is kept, and of food names whose normalized
+# form is kept for each restaurant
+MAX_CACHED_RESTAURANTS = 128
+MAX_CACHED_FOODS = 4096
+
+# Maximum number of aliases of a restaurant, and the length of an alias or the name it
+# stands for
+MAX_ALIASES = 200
+MAX_ALIAS_LENGTH = 64
+
+# Apostrophes are kept within words, so that eg the "s" of "mcdonald's" is not taken
+# for a size
+_TOKEN = re.compile(r"[^\W_]+(?:['’][^\W_]+)*")
+
+# Key of the name replacing the tokens leading to a node of the trie. Tokens are never
+# empty, so it cannot clash with a token
+_NAME = ""
+
+
+def tokenize(text: str) -> tuple[str, ...]:
+    """Splits text into lowercase words, ignoring punctuation other than apostrophes."""
+    text = unicodedata.normalize("NFKC", text).casefold().replace("’", "'")
+    return tuple(_TOKEN.findall(text))
+
+
+def normalize_name(text: str) -> str:
+    """Returns text as its tokens separated by spaces, as aliases are stored."""
+    return " ".join(tokenize(text))
+
+
+class AliasIndex:
+    """
+    The aliases of a restaurant compiled into a trie over tokens, and the normalized
+    form of the food names seen for the restaurant.
+    """
+
+    def __init__(self, aliases: Iterable[tuple[str, str]] = ()):
+        self._trie: dict = {}
+        ends = []
+        for alias, name in [*DEFAULT_ALIASES.items(), *aliases]:
+            tokens = tokenize(alias)
+            if not tokens:
+                continue
+
+            node = self._trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[_NAME] = tokenize(name)
+            ends.append(node)
+
+        # Aliases in the names themselves are replaced too, eg "mf = m fries" counts
+        # "mf" as "medium fries". Only once, so aliases of each other do not loop
+        for node in ends:
+            node[_NAME] = self.replace_aliases(node[_NAME])
+
+        # The grouping key and the displayed name of each food name, least recently
+        # used first
+        self._foods: OrderedDict[str, tuple[tuple[str, ...], str]] = OrderedDict()
+
+    def replace_aliases(self, tokens: tuple[str, ...]) -> tuple[str, ...]:
+        """Replaces the longest alias starting at each token with the name it is for."""
+        result = []
+        start = 0
+        while start < len(tokens):
+            node = self._trie
+            name, end = None, start + 1
+            for i in range(start, len(tokens)):
+                node = node.get(tokens[i])
+                if node is None:
+                    break
+                if _NAME in node:
+                    name, end = node[_NAME], i + 1
+
+            if name is None:
+                result.append(tokens[start])
+            else:
+                result.extend(name)
+            start = end
+
+        return tuple(result)
+
+    def normalize(self, food: str) -> tuple[tuple[str, ...], str]:
+        """
+        Returns the key which the food is counted under, and the name it is shown as.
+        """
+        normalized = self._foods.get(food)
+        if normalized is not None:
+            self._foods.move_to_end(food)
+            return normalized
+
+        tokens = self.replace_aliases(tokenize(food))
+        if tokens:
+            normalized = tuple(sorted(tokens)), " ".join(tokens)
+        else:
+            # Names without any words, eg emoji, are only counted with the same name
+            name = food.strip().lower()
+            normalized = ("", name), name
+
+        self._foods[food] = normalized
+        if len(self._foods) > MAX_CACHED_FOODS:
+            self._foods.popitem(last=False)
+        return normalized
+
+    def count(self, counts: Iterable[tuple[str, int]]) -> list[tuple[str, int]]:
+        """
+        Adds up the quantities of foods which are the same once normalized. Foods are
+        shown as the first of their names, and kept in the order they first appear.
+        """
+        totals: dict[tuple[str, ...], list] = {}
+        for food, quantity in counts:
+            key, name = self.normalize(food)
+            total = totals.get(key)
+            if total is None:
+                totals[key] = [name, quantity]
+            else:
+                total[1] += quantity
+
+        return [(name, quantity) for name, quantity in totals.values()]
+
+
+# Indexes by restaurant, least recently used first
+_indexes: OrderedDict[str, AliasIndex] = OrderedDict()
+
+
+async def get_alias_index(restaurant: str) -> AliasIndex:
+    """
+    Returns the index of the restaurant's aliases, which is only loaded from the
+    database if it is not kept already.
+    """
+    restaurant = normalize_name(restaurant)
+
+    index = _indexes.get(restaurant)
+    if index is not None:
+        _indexes.move_to_end(restaurant)
+        return index
+
+    index = _indexes[restaurant] = AliasIndex(await db.get_food_aliases(restaurant))
+    if len(_indexes) > MAX_CACHED_RESTAURANTS:
+        _indexes.popitem(last=False)
+    return index
+
+
+def forget_aliases(restaurant: str) -> None:
+    """Drops the index of the restaurant's aliases. Must be called once they change."""
+    _indexes.pop(normalize_name(restaurant), None)
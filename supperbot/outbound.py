@@ -0,0 +1,324 @@
+"""Rate limiting and flood control for requests made to the Bot API."""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Hashable, Iterator, Union
+
+from telegram._utils.defaultvalue import DEFAULT_NONE
+from telegram._utils.types import JSONDict, ODVInput
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest, RequestData
+
+
+# Limits documented in https://core.telegram.org/bots/faq#broadcasting-to-users
+GLOBAL_RATE = 30  # Requests per second across all chats
+PRIVATE_CHAT_RATE = 1  # Requests per second to a single private chat
+PRIVATE_CHAT_BURST = 5
+GROUP_CHAT_RATE = 20 / 60  # Requests per second to a single group
+GROUP_CHAT_BURST = 3
+
+# Number of times a request is retried after a `RetryAfter`, before giving up
+MAX_RETRIES = 3
+
+# Once this many per-chat buckets exist, idle ones are dropped
+MAX_CHAT_BUCKETS = 10_000
+
+# Endpoints which do not send or edit messages, and are not subject to the limits
+UNLIMITED_ENDPOINTS = frozenset(
+    {
+        "answerCallbackQuery",
+        "answerInlineQuery",
+        "getMe",
+        "getUpdates",
+        "setMyCommands",
+        "deleteMyCommands",
+        "setWebhook",
+        "deleteWebhook",
+        "getWebhookInfo",
+    }
+)
+
+
+class Priority(IntEnum):
+    """How urgently a request should be made, from most to least urgent."""
+
+    # Edits the user who made the request is waiting on
+    HIGH = 0
+    NORMAL = 1
+    # Edits nobody is actively waiting on, eg other participants' messages
+    BACKGROUND = 2
+
+
+_priority: ContextVar[Priority] = ContextVar("priority", default=Priority.NORMAL)
+
+# Tokens which requests of each priority must leave in the buckets, so that a burst of
+# lower priority requests never makes a higher priority one wait for long. This does
+# not lower throughput, as the buckets still refill at the same rate
+GLOBAL_RESERVE = {Priority.HIGH: 0, Priority.NORMAL: 3, Priority.BACKGROUND: 10}
+CHAT_RESERVE = {Priority.HIGH: 0, Priority.NORMAL: 0, Priority.BACKGROUND: 1}
+
+
+@contextmanager
+def priority(level: Priority) -> Iterator[None]:
+    """
+    Makes requests made within the block, including by tasks started in it, have the
+    given priority.
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """A token bucket holding up to `capacity` tokens, refilled at `rate` per second."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def delay(self, now: float, reserve: float = 0) -> float:
+        """
+        Returns the number of seconds until a token can be taken from the bucket,
+        leaving at least `reserve` tokens in it.
+        """
+        self._refill(now)
+
+        # The reserve cannot be more than the bucket can hold
+        needed = min(1 + reserve, self.capacity)
+
+        delay = self._paused_until - now
+        if self._tokens < needed:
+            delay = max(delay, (needed - self._tokens) / self.rate)
+        return max(delay, 0.0)
+
+    def consume(self) -> None:
+        self._tokens -= 1
+
+    def pause(self, seconds: float, now: float) -> None:
+        """Stops tokens from being taken for `seconds`, and empties the bucket."""
+        self._refill(now)
+        self._tokens = min(self._tokens, 0)
+        self._paused_until = max(self._paused_until, now + seconds)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self.capacity and self._paused_until <= now
+
+
+def chat_key(parameters: JSONDict) -> Hashable | None:
+    """
+    Returns the key of the per-chat bucket for a request, or `None` if the request is
+    not sent to a specific chat.
+
+    Inline messages do not say which chat they are in. They are usually shared into
+    groups, so each one is limited like a group of its own.
+    """
+    if "chat_id" in parameters:
+        return "chat", parameters["chat_id"]
+    if "inline_message_id" in parameters:
+        return "inline", parameters["inline_message_id"]
+    return None
+
+
+def _is_group(key: Hashable) -> bool:
+    kind, chat_id = key
+    if kind == "inline":
+        return True
+
+    # Group ids are negative, and channels may be given by their @username
+    if isinstance(chat_id, str) and not chat_id.lstrip("-").isdigit():
+        return True
+    return int(chat_id) < 0
+
+
+class OutboundScheduler:
+    """
+    Keeps requests to the Bot API within Telegram's rate limits.
+
+    A request has to take a token from the global bucket, and from the bucket of the
+    chat it is sent to, before it is made. Requests wait (without blocking requests to
+    other chats) until both buckets have a token.
+
+    The scheduler also keeps track of how many requests are waiting, and for how long.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self._chats: dict[Hashable, TokenBucket] = {}
+
+        # Number of requests currently waiting for a token
+        self.waiting = 0
+
+        self._requests = 0
+        self._retries = 0
+        self._max_waiting = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _bucket(self, key: Hashable, now: float) -> TokenBucket:
+        bucket = self._chats.get(key)
+        if bucket is not None:
+            return bucket
+
+        if len(self._chats) >= MAX_CHAT_BUCKETS:
+            self._chats = {
+                key: bucket
+                for key, bucket in self._chats.items()
+                if not bucket.idle(now)
+            }
+
+        if _is_group(key):
+            bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+        else:
+            bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+        self._chats[key] = bucket
+        return bucket
+
+    async def acquire(
+        self, key: Hashable | None, level: Priority = Priority.NORMAL
+    ) -> None:
+        """
+        Waits until a request to the chat with the given key can be made. Requests of a
+        lower priority have to leave more tokens in the buckets.
+        """
+        start = time.monotonic()
+        buckets = [(self._global, GLOBAL_RESERVE[level])]
+        if key is not None:
+            buckets.append((self._bucket(key, start), CHAT_RESERVE[level]))
+
+        self.waiting += 1
+        self._max_waiting = max(self._max_waiting, self.waiting)
+        try:
+            while True:
+                now = time.monotonic()
+                delay = max(bucket.delay(now, reserve) for bucket, reserve in buckets)
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+
+            # There is no `await` between checking and taking the tokens, so no other
+            # request can take them in between
+            for bucket, _ in buckets:
+                bucket.consume()
+        finally:
+            self.waiting -= 1
+
+        wait = time.monotonic() - start
+        self._requests += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+
+    def retry_after(self, key: Hashable | None, seconds: float) -> None:
+        """
+        Pauses requests after Telegram responded with `RetryAfter`. If the request was
+        to a chat, only that chat is paused, otherwise all requests are.
+        """
+        self._retries += 1
+
+        now = time.monotonic()
+        if key is None:
+            self._global.pause(seconds, now)
+        else:
+            self._bucket(key, now).pause(seconds, now)
+
+    def stats(self, reset: bool = False) -> dict[str, float]:
+        """
+        Returns the number of requests made, retries, the current and maximum number of
+        waiting requests, and the average and maximum time spent waiting for a token.
+
+        :param reset: Whether to reset the counters after reading them.
+        """
+        stats = {
+            "requests": self._requests,
+            "retries": self._retries,
+            "waiting": self.waiting,
+            "max_waiting": self._max_waiting,
+            "avg_wait": self._total_wait / self._requests if self._requests else 0.0,
+            "max_wait": self._max_wait,
+        }
+
+        if reset:
+            self._requests = self._retries = 0
+            self._max_waiting = self.waiting
+            self._total_wait = self._max_wait = 0.0
+
+        return stats
+
+
+class ScheduledRequest(BaseRequest):
+    """
+    Wraps another `BaseRequest`, making every request through it wait for the
+    scheduler first, and retrying requests which fail with `RetryAfter`.
+
+    Requests have the priority set with `priority` where they are made.
+    """
+
+    __slots__ = ("_request", "scheduler")
+
+    def __init__(self, request: BaseRequest, scheduler: OutboundScheduler):
+        self._request = request
+        self.scheduler = scheduler
+
+    async def initialize(self) -> None:
+        await self._request.initialize()
+
+    async def shutdown(self) -> None:
+        await self._request.shutdown()
+
+    async def do_request(self, *args, **kwargs) -> tuple[int, bytes]:
+        return await self._request.do_request(*args, **kwargs)
+
+    async def post(
+        self,
+        url: str,
+        request_data: RequestData = None,
+        read_timeout: ODVInput[float] = DEFAULT_NONE,
+        write_timeout: ODVInput[float] = DEFAULT_NONE,
+        connect_timeout: ODVInput[float] = DEFAULT_NONE,
+        pool_timeout: ODVInput[float] = DEFAULT_NONE,
+    ) -> Union[JSONDict, bool]:
+        endpoint = url.rsplit("/", 1)[-1]
+        limited = endpoint not in UNLIMITED_ENDPOINTS
+        key = chat_key(request_data.parameters) if request_data else None
+        level = _priority.get()
+
+        for attempt in range(MAX_RETRIES + 1):
+            if limited:
+                await self.scheduler.acquire(key, level)
+
+            try:
+                return await super().post(
+                    url,
+                    request_data,
+                    read_timeout=read_timeout,
+                    write_timeout=write_timeout,
+                    connect_timeout=connect_timeout,
+                    pool_timeout=pool_timeout,
+                )
+            except RetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    raise
+
+                logging.warning(
+                    f"{endpoint} hit flood control, retrying in {e.retry_after}s"
+                )
+                self.scheduler.retry_after(key, e.retry_after)
+                if not limited:
+                    await asyncio.sleep(e.retry_after)
@@ -0,0 +1,171 @@
+"""
+The outbox of pending refreshes to jio messages.
+
+Handlers which change a jio do not edit the jio's messages themselves. Instead, they add
+a refresh to the outbox with `db.enqueue_refresh`, which is committed in the same
+transaction as the change. The `OutboxWorker` then makes the refreshes in the
+background, and only removes them from the outbox once they are done, so no refresh is
+lost if the bot restarts while editing a jio's messages.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from telegram import Bot
+
+from supperbot.db import db
+from supperbot.db.models import OutboxEntry, RefreshKind
+from supperbot.outbound import Priority, priority
+from supperbot.commands.helper import (
+    is_transient_edit_error,
+    update_consolidated_orders,
+    update_individuals_order,
+)
+
+
+# Seconds to wait after an order changes before refreshing the jio's consolidated
+# messages, so that changes made in quick succession are shown with one round of edits
+REFRESH_DELAY = float(os.environ.get("REFRESH_DELAY", "0.5"))
+
+# Maximum number of refreshes being made at once, and of those, the number of each
+# priority which may be editing messages at the same time. Refreshes of different
+# priorities do not wait for each other, so a large jio's individual messages do not
+# hold up the shared messages of other jios
+MAX_RUNNING_REFRESHES = 64
+MAX_CONCURRENT_REFRESHES = 4
+
+# Refreshes which fail are retried after `RETRY_DELAY` seconds, doubling with every
+# attempt, and dropped after `MAX_ATTEMPTS` attempts
+RETRY_DELAY = 2
+MAX_ATTEMPTS = 5
+
+# Maximum number of seconds between checks of the outbox
+POLL_INTERVAL = 30
+
+# The priority of the edits made by each kind of refresh. Users' individual messages
+# are only updated once the messages in groups have had their turn
+REFRESH_PRIORITIES = {
+    RefreshKind.CONSOLIDATED: Priority.NORMAL,
+    RefreshKind.SHARED: Priority.NORMAL,
+    RefreshKind.INDIVIDUALS: Priority.BACKGROUND,
+}
+
+
+class OutboxWorker:
+    """Makes the refreshes in the outbox, as soon as each of them is due."""
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+        # Refreshes being made, by `(jio_id, kind)`. A refresh is never made twice at
+        # the same time, so an older render never overwrites a newer one
+        self._running: dict[tuple[int, RefreshKind], asyncio.Task] = {}
+        self._lanes = {
+            level: asyncio.Semaphore(MAX_CONCURRENT_REFRESHES) for level in Priority
+        }
+
+        # Check the outbox again whenever new refreshes are committed
+        db.add_outbox_listener(self._wake.set)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            timeout = POLL_INTERVAL
+
+            try:
+                if len(self._running) < MAX_RUNNING_REFRESHES:
+                    if await self._start_due_refreshes():
+                        continue
+
+                    async with db.session_scope():
+                        now = datetime.now()
+                        next_time = await db.get_next_outbox_time(now)
+                    if next_time is not None:
+                        timeout = min(timeout, (next_time - now).total_seconds())
+            except Exception:
+                logging.exception("Unable to process the outbox")
+                timeout = RETRY_DELAY
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _start_due_refreshes(self) -> bool:
+        """
+        Starts making the refreshes which are due, and not already being made.
+
+        :return: Whether any refresh was started.
+        """
+        async with db.session_scope():
+            entries = await db.get_due_outbox_entries(
+                MAX_RUNNING_REFRESHES - len(self._running), self._running
+            )
+
+        # Entries for the same refresh are only processed once
+        refreshes: dict[tuple[int, RefreshKind], list[OutboxEntry]] = {}
+        for entry in entries:
+            key = entry.jio_id, RefreshKind(entry.kind)
+            refreshes.setdefault(key, []).append(entry)
+
+        for key, entries in refreshes.items():
+            task = asyncio.create_task(self._refresh(*key, entries))
+            self._running[key] = task
+            task.add_done_callback(lambda _, key=key: self._finish(key))
+
+        return bool(refreshes)
+
+    def _finish(self, key: tuple[int, RefreshKind]) -> None:
+        del self._running[key]
+
+        # Entries added for the refresh while it was being made can be processed now
+        self._wake.set()
+
+    async def _refresh(
+        self, jio_id: int, kind: RefreshKind, entries: list[OutboxEntry]
+    ) -> None:
+        level = REFRESH_PRIORITIES[kind]
+
+        # Each refresh runs in its own task, with its own session
+        try:
+            async with self._lanes[level]:
+                with priority(level):
+                    async with db.session_scope():
+                        if kind == RefreshKind.INDIVIDUALS:
+                            results = await update_individuals_order(self.bot, jio_id)
+                        else:
+                            results = await update_consolidated_orders(
+                                self.bot, jio_id, kind == RefreshKind.CONSOLIDATED
+                            )
+
+            # Edits which succeeded are skipped when retrying, as the messages are
+            # already up to date
+            failed = any(is_transient_edit_error(result) for result in results)
+        except Exception:
+            logging.exception(f"Unable to refresh {kind.name} messages of jio {jio_id}")
+            failed = True
+
+        ids = [entry.id for entry in entries]
+        attempts = max(entry.attempts for entry in entries) + 1
+
+        async with db.session_scope():
+            if not failed:
+                await db.delete_outbox_entries(ids)
+            elif attempts >= MAX_ATTEMPTS:
+                logging.error(
+                    f"Giving up on refreshing {kind.name} messages of jio {jio_id} "
+                    f"after {attempts} attempts"
+                )
+                await db.delete_outbox_entries(ids)
+            else:
+                delay = timedelta(seconds=RETRY_DELAY * 2 ** (attempts - 1))
+                await db.retry_outbox_entries(ids, datetime.now() + delay)
@@ -0,0 +1,96 @@
+"""
+Storage of callback data arguments which are too long to be sent to Telegram.
+
+Telegram limits callback data to 64 bytes, so arguments of arbitrary length, such as
+restaurant names, are kept on the server instead. The callback data then only holds a
+short token for the argument, which is looked up when the button is pressed.
+
+Ids are sent as they are, as they are already short. Tokens are only kept in memory,
+for up to `TOKEN_TTL` seconds, so buttons holding a token stop working after that or
+once the bot restarts. They should only be used for menus which are short-lived anyway.
+"""
+from __future__ import annotations
+
+import secrets
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+# Number of random bytes in a token. Tokens are base64 encoded, taking 8 characters
+TOKEN_BYTES = 6
+
+# Maximum number of tokens kept, and the number of seconds each is kept for
+MAX_TOKENS = 10_000
+TOKEN_TTL = 24 * 60 * 60
+
+
+class PayloadStore:
+    """
+    A store of values by token, which drops the least recently used values once it is
+    full, and values which have not been used for `ttl` seconds.
+    """
+
+    def __init__(self, max_size: int = MAX_TOKENS, ttl: float = TOKEN_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # `(value, expiry)` by token, least recently used first
+        self._values: OrderedDict[str, tuple[Hashable, float]] = OrderedDict()
+        # The same value is always given the same token while it is stored, so that
+        # rendering a menu again does not fill the store
+        self._tokens: dict[Hashable, str] = {}
+
+    def put(self, value: Hashable) -> str:
+        """Stores the value, and returns the token to look it up by."""
+        token = self._tokens.get(value)
+        if token is None:
+            token = secrets.token_urlsafe(TOKEN_BYTES)
+            while token in self._values:
+                token = secrets.token_urlsafe(TOKEN_BYTES)
+            self._tokens[value] = token
+
+        self._values[token] = value, time.monotonic() + self.ttl
+        self._values.move_to_end(token)
+
+        while len(self._values) > self.max_size:
+            self._drop(next(iter(self._values)))
+
+        return token
+
+    def get(self, token: str) -> Hashable:
+        """
+        Returns the value stored with the token.
+
+        :raises KeyError: If the token is unknown, or has expired.
+        """
+        value, expiry = self._values[token]
+        if expiry < time.monotonic():
+            self._drop(token)
+            raise KeyError(token)
+
+        self._values[token] = value, time.monotonic() + self.ttl
+        self._values.move_to_end(token)
+        return value
+
+    def _drop(self, token: str) -> None:
+        value, _ = self._values.pop(token)
+        del self._tokens[value]
+
+
+store = PayloadStore()
+
+
+def pack(value: Hashable) -> str:
+    """Returns a token for the value, to be used as a callback data argument."""
+    return store.put(value)
+
+
+def token(argument: str) -> Hashable:
+    """
+    Returns the value of a token packed with `pack`. Used as the type of an argument
+    in `CallbackRouter.add_route`.
+    """
+    try:
+        return store.get(argument)
+    except KeyError:
+        raise ValueError(f"unknown or expired token {argument!r}") from None
@@ -0,0 +1,231 @@
+"""Persistence of `user_data` and conversation states in the database."""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Any
+
+from sqlalchemy import delete, insert, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram.ext import BasePersistence, PersistenceInput
+
+from supperbot.db.models import (
+    Base,
+    ConversationState,
+    Session,
+    UserData,
+    engine,
+)
+from supperbot.enums import CallbackType
+
+
+# Seconds between the application handing changed data to the persistence, which is
+# then written to the database in a single transaction
+UPDATE_INTERVAL = 30
+
+
+def _decode_state(state: Any) -> Any:
+    # Conversation states are `CallbackType`s, which are stored as their value
+    if isinstance(state, str):
+        try:
+            return CallbackType(state)
+        except ValueError:
+            pass
+    return state
+
+
+class SQLPersistence(BasePersistence):
+    """
+    Stores `user_data`, and the states of persistent `ConversationHandler`s, in the
+    database, so that conversations in progress survive restarts.
+
+    Values in `user_data` are stored as JSON, so only ids and other plain values should
+    be kept there - never objects such as a `SupperJio` or a `telegram.Message`.
+
+    Nothing is written while an update is handled. The application hands over the data
+    which changed every `update_interval` seconds, and all of it is written in one
+    transaction. `user_data` is not loaded up front either; a user's data is loaded
+    when the first update from them is processed.
+    """
+
+    def __init__(self, update_interval: float = UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, callback_data=False
+            ),
+            update_interval=update_interval,
+        )
+
+        self._tables_created = False
+        self._loaded_users: set[int] = set()
+
+        # Changes waiting to be written, as JSON, or `None` if the row is to be deleted
+        self._pending_users: dict[int, str | None] = {}
+        self._pending_states: dict[tuple[str, str], str | None] = {}
+        self._write_task: asyncio.Task | None = None
+
+    async def _create_tables(self) -> None:
+        # Data is loaded before `post_init` creates the rest of the tables
+        if not self._tables_created:
+            async with engine.begin() as conn:
+                await conn.run_sync(
+                    Base.metadata.create_all,
+                    tables=[UserData.__table__, ConversationState.__table__],
+                )
+            self._tables_created = True
+
+    #
+    # Loading
+    #
+
+    async def get_user_data(self) -> dict[int, dict]:
+        # Loaded lazily, see `refresh_user_data`
+        await self._create_tables()
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+
+        # Data changed since the bot started is newer than what is in the database
+        if user_id in self._pending_users:
+            return
+
+        async with Session() as session:
+            stmt = select(UserData.data).filter_by(user_id=user_id)
+            data = (await session.scalars(stmt)).one_or_none()
+
+        if data is not None:
+            for key, value in json.loads(data).items():
+                user_data.setdefault(key, value)
+
+    async def get_conversations(self, name: str) -> dict[tuple, Any]:
+        await self._create_tables()
+
+        async with Session() as session:
+            stmt = select(ConversationState.key, ConversationState.state).filter_by(
+                name=name
+            )
+            rows = (await session.execute(stmt)).all()
+
+        return {
+            tuple(json.loads(key)): _decode_state(json.loads(state))
+            for key, state in rows
+        }
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    #
+    # Saving
+    #
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._pending_users[user_id] = json.dumps(data)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    async def update_conversation(
+        self, name: str, key: tuple, new_state: object | None
+    ) -> None:
+        state = None if new_state is None else json.dumps(new_state)
+        self._pending_states[name, json.dumps(key)] = state
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    def _schedule_write(self) -> None:
+        # The application hands over all changed data at once, so the write is started
+        # in a task which runs once all of it has been staged
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        users, self._pending_users = self._pending_users, {}
+        states, self._pending_states = self._pending_states, {}
+
+        try:
+            async with Session() as session:
+                await self._write_users(session, users)
+                await self._write_states(session, states)
+                await session.commit()
+        except Exception:
+            logging.exception("Unable to write persisted data to the database")
+
+            # Retried with the next write, unless newer data has been staged since
+            for user_id, data in users.items():
+                self._pending_users.setdefault(user_id, data)
+            for key, state in states.items():
+                self._pending_states.setdefault(key, state)
+        finally:
+            self._write_task = None
+
+    @staticmethod
+    async def _write_users(session: AsyncSession, users: dict[int, str | None]) -> None:
+        if not users:
+            return
+
+        await session.execute(delete(UserData).where(UserData.user_id.in_(users)))
+
+        rows = [
+            {"user_id": user_id, "data": data}
+            for user_id, data in users.items()
+            if data is not None
+        ]
+        if rows:
+            await session.execute(insert(UserData), rows)
+
+    @staticmethod
+    async def _write_states(
+        session: AsyncSession, states: dict[tuple[str, str], str | None]
+    ) -> None:
+        if not states:
+            return
+
+        await session.execute(
+            delete(ConversationState).where(
+                tuple_(ConversationState.name, ConversationState.key).in_(states)
+            )
+        )
+
+        rows = [
+            {"name": name, "key": key, "state": state}
+            for (name, key), state in states.items()
+            if state is not None
+        ]
+        if rows:
+            await session.execute(insert(ConversationState), rows)
+
+    async def flush(self) -> None:
+        """Writes all staged changes. Called by the application when it stops."""
+        if self._write_task is not None:
+            await self._write_task
+        if self._pending_users or self._pending_states:
+            await self._write_pending()
@@ -0,0 +1,154 @@
+"""Dispatching of callback queries to their handlers by their `CallbackType`."""
+from __future__ import annotations
+
+import logging
+from collections import Counter
+from typing import Any, Callable, Coroutine
+
+from telegram import Update
+from telegram.ext import BaseHandler, CallbackContext
+
+from supperbot.enums import CallbackType, parse_callback_data
+
+HandlerCallback = Callable[[Update, CallbackContext], Coroutine[Any, Any, Any]]
+
+# Converts an argument of a callback from its string form, raising `ValueError` if it
+# is not valid
+ArgumentType = Callable[[str], Any]
+
+
+class Route:
+    """A handler for one `CallbackType`, and the types of its arguments."""
+
+    __slots__ = ("callback_type", "callback", "argument_types")
+
+    def __init__(
+        self,
+        callback_type: CallbackType,
+        callback: HandlerCallback,
+        argument_types: tuple[ArgumentType, ...],
+    ):
+        self.callback_type = callback_type
+        self.callback = callback
+        self.argument_types = argument_types
+
+    def parse_arguments(self, arguments: list[str]) -> list[Any]:
+        """
+        Converts the arguments of a callback to their types.
+
+        :raises ValueError: If the wrong number of arguments is given, or any of them
+            is not valid.
+        """
+        if len(arguments) != len(self.argument_types):
+            raise ValueError(
+                f"expected {len(self.argument_types)} arguments, got {len(arguments)}"
+            )
+        return [
+            argument_type(argument)
+            for argument_type, argument in zip(self.argument_types, arguments)
+        ]
+
+
+class CallbackRouter(BaseHandler[Update, CallbackContext]):
+    """
+    Handles callback queries for every registered `CallbackType` with a single
+    handler.
+
+    The callback type at the start of the callback data is looked up in a dict, instead
+    of testing the data against a regex for each type. The arguments are then checked
+    against the route's argument types before the route's callback is called, so that
+    callbacks can rely on `context.args` holding valid, converted arguments.
+
+    Callback queries of types without a route are left for other handlers.
+    """
+
+    __slots__ = ("_routes", "_counts", "_invalid")
+
+    def __init__(self):
+        super().__init__(self._dispatch)
+
+        self._routes: dict[str, Route] = {}
+        self._counts: Counter[CallbackType] = Counter()
+        self._invalid = 0
+
+    def add_route(
+        self,
+        callback_type: CallbackType,
+        callback: HandlerCallback,
+        *argument_types: ArgumentType,
+    ) -> None:
+        """
+        Routes callback queries of the given type to `callback`.
+
+        :param argument_types: The types of the arguments which follow the callback
+            type in the callback data, eg `int` for a jio id.
+        """
+        if callback_type.value in self._routes:
+            raise ValueError(f"{callback_type.name} already has a route")
+
+        self._routes[callback_type.value] = Route(
+            callback_type, callback, argument_types
+        )
+
+    def check_update(self, update: object) -> tuple[Route, list[str]] | None:
+        if not isinstance(update, Update) or not update.callback_query:
+            return None
+
+        data = update.callback_query.data
+        if not isinstance(data, str):
+            return None
+
+        callback_type, *arguments = parse_callback_data(data)
+        route = self._routes.get(callback_type)
+        if route is None:
+            return None
+
+        return route, arguments
+
+    def collect_additional_context(
+        self,
+        context: CallbackContext,
+        update: Update,
+        application: Any,
+        check_result: tuple[Route, list[str]],
+    ) -> None:
+        # The arguments are converted by `_dispatch`, which can answer the query if
+        # they are not valid
+        _, context.args = check_result
+
+    async def _dispatch(self, update: Update, context: CallbackContext) -> Any:
+        # Looked up again, as only `context` is passed on from `check_update`
+        route = self._routes[parse_callback_data(update.callback_query.data)[0]]
+
+        try:
+            context.args = route.parse_arguments(context.args)
+        except ValueError as e:
+            self._invalid += 1
+            logging.error(
+                f"Invalid callback data for {route.callback_type.name}: "
+                f"{update.callback_query.data} ({e})"
+            )
+            await update.callback_query.answer("This button is no longer valid!")
+            return None
+
+        self._counts[route.callback_type] += 1
+        return await route.callback(update, context)
+
+    def stats(self, reset: bool = False) -> dict[str, int]:
+        """
+        Returns the number of callback queries handled by each route, by the name of
+        its callback type, and the number rejected for having invalid arguments.
+
+        :param reset: Whether to reset the counters after reading them.
+        """
+        stats = {
+            callback_type.name: count
+            for callback_type, count in self._counts.most_common()
+        }
+        stats["invalid"] = self._invalid
+
+        if reset:
+            self._counts.clear()
+            self._invalid = 0
+
+        return stats
@@ -0,0 +1,163 @@
+"""
+Receiving updates from Telegram through a webhook, instead of polling for them.
+
+Telegram sends each update in a POST request to the webhook, along with the secret
+token given when the webhook was set. Requests without the token are rejected, so only
+Telegram can send updates to the bot.
+
+Updates are put on the application's update queue, which is bounded. Once it is full,
+requests are answered with 503 Service Unavailable instead of waiting for space, and
+Telegram delivers the update again later. This keeps the number of updates held in
+memory bounded when updates arrive faster than they are processed.
+
+The webhook is served by the single process running the bot; it cannot be spread over
+several processes behind a load balancer (see `SupperApplication.hold_lease`).
+"""
+from __future__ import annotations
+
+import asyncio
+import hmac
+import json
+import logging
+import secrets
+import signal
+from http import HTTPStatus
+from typing import Sequence
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+from telegram.ext import Application
+
+# Header which Telegram sends the secret token in
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Seconds Telegram is asked to wait before sending an update again when the update
+# queue is full
+RETRY_AFTER = 1
+
+# Maximum number of connections Telegram opens to the webhook at the same time
+MAX_CONNECTIONS = 40
+
+DEFAULT_STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGABRT)
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """Puts the updates sent to the webhook on the application's update queue."""
+
+    SUPPORTED_METHODS = ("POST",)
+
+    def initialize(self, bot_application: Application, secret_token: str) -> None:
+        self.bot_application = bot_application
+        self.secret_token = secret_token.encode()
+
+    async def post(self) -> None:
+        secret_token = self.request.headers.get(SECRET_TOKEN_HEADER, "").encode()
+        if not hmac.compare_digest(secret_token, self.secret_token):
+            logging.warning(
+                f"Rejected a webhook request without a valid secret token "
+                f"from {self.request.remote_ip}"
+            )
+            raise tornado.web.HTTPError(HTTPStatus.FORBIDDEN)
+
+        try:
+            update = Update.de_json(
+                json.loads(self.request.body), self.bot_application.bot
+            )
+        except Exception:
+            logging.exception("Unable to parse an update received on the webhook")
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+
+        if update is None:
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+
+        try:
+            self.bot_application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logging.warning(
+                f"Update queue is full, Telegram will resend update {update.update_id}"
+            )
+            self.set_header("Retry-After", str(RETRY_AFTER))
+            self.set_status(HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+
+        self.set_status(HTTPStatus.OK)
+
+    def log_exception(self, typ, value, tb) -> None:
+        # Rejected requests are already logged, without a traceback
+        if not isinstance(value, tornado.web.HTTPError):
+            super().log_exception(typ, value, tb)
+
+
+class _WebhookApp(tornado.web.Application):
+    def log_request(self, handler: tornado.web.RequestHandler) -> None:
+        # Every update would otherwise be logged
+        pass
+
+
+async def run_webhook(
+    application: Application,
+    webhook_url: str,
+    listen: str = "127.0.0.1",
+    port: int = 8443,
+    url_path: str = "",
+    secret_token: str | None = None,
+    max_connections: int = MAX_CONNECTIONS,
+    stop_signals: Sequence[int] | None = DEFAULT_STOP_SIGNALS,
+) -> None:
+    """
+    Runs the application, receiving updates through a webhook until one of the stop
+    signals is received.
+
+    The webhook is not deleted when stopping, so updates sent while the bot restarts
+    are held by Telegram and delivered once it is back up.
+
+    :param webhook_url: The URL Telegram sends updates to, which should reach the
+        server listening on `listen`, `port` and `url_path`, eg through a reverse proxy.
+    :param secret_token: The token Telegram must send with every update. If not given,
+        a random token is used.
+    :param max_connections: The maximum number of connections Telegram opens to the
+        webhook at the same time.
+    """
+    if secret_token is None:
+        secret_token = secrets.token_urlsafe(32)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in stop_signals or ():
+        loop.add_signal_handler(sig, stop.set)
+
+    app = _WebhookApp(
+        [
+            (
+                rf"/{url_path.strip('/')}/?",
+                WebhookHandler,
+                {"bot_application": application, "secret_token": secret_token},
+            )
+        ]
+    )
+    server = HTTPServer(app)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+        # Updates can only be put on the queue once the application is processing it
+        server.listen(port, listen)
+        await application.bot.set_webhook(
+            webhook_url,
+            max_connections=max_connections,
+            api_kwargs={"secret_token": secret_token},
+        )
+        logging.info(f"Receiving updates on {listen}:{port} through {webhook_url}")
+
+        await stop.wait()
+    finally:
+        server.stop()
+        await server.close_all_connections()
+
+        if application.running:
+            await application.stop()
+        await application.shutdown()